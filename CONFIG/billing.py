@@ -122,4 +122,15 @@ CREDIT_PACKAGES = [
         'show' : True,
         'credits' : 50,
     },
-]
\ No newline at end of file
+]
+
+# Every time credits are added or consumed, a credit action is logged (shown in the credit history of the user).
+# By default the credit action is written together with the balance. For high-frequency metered features (e.g. credits per API call),
+# set BUFFER_CREDIT_ACTIONS to True: the credit actions are then collected in Redis and written in batches of CREDIT_ACTIONS_FLUSH_BATCH_SIZE
+# by a periodic task (every minute), which halves the database writes. The balance itself is always updated immediately, so credit checks stay exact.
+BUFFER_CREDIT_ACTIONS = False
+CREDIT_ACTIONS_FLUSH_BATCH_SIZE = 1000
+
+# The subscription of the user is cached (in Redis) for this amount of seconds, so it isn't loaded on every request (see request.entitlements).
+# The cache is cleared when the subscription is saved. Set to 0 to always load the subscription from the database.
+ENTITLEMENTS_CACHE_TIMEOUT = 300
@@ -10,6 +10,33 @@ EMAIL_PROVIDER = 'smtp' # 'smtp' or 'sendgrid'
 # If you set this to False, emails will be sent synchronously and the main thread will be blocked until the email is sent.
 EMAIL_USE_TASK_QUEUE = True
 
+# SMTP connections are kept open and reused for the next emails (per process), instead of connecting and logging in for every email.
+# - EMAIL_SMTP_POOL_SIZE: The maximum amount of idle connections per process. Set this to the amount of task queue worker threads.
+# - EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION: The amount of emails after which a connection is closed. Most SMTP servers limit this (often to 100).
+# - EMAIL_SMTP_KEEPALIVE_SECONDS: Connections that were idle for longer than this are checked (with NOOP) before they are reused.
+EMAIL_SMTP_POOL_SIZE = 4
+EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+EMAIL_SMTP_KEEPALIVE_SECONDS = 30
+
+# Emails sent with the task queue are rate limited per provider, shared by all task queue workers (through Redis).
+# The limit is in emails per second for SMTP, and in API requests per second for SendGrid (one request sends a bulk email to up to 1000 recipients).
+# Set the limit of a provider to None to disable rate limiting for it.
+# Bulk emails (send_bulk_email) leave EMAIL_BULK_RESERVED_CAPACITY (a fraction) of the rate limit to transactional emails (password resets, activation emails, ...).
+EMAIL_RATE_LIMITS = {
+    'smtp' : 10,
+    'sendgrid' : 100,
+}
+EMAIL_BULK_RESERVED_CAPACITY = 0.2
+
+# Transactional emails are picked from the task queue before bulk emails (a higher priority runs first).
+EMAIL_PRIORITY_TRANSACTIONAL = 10
+EMAIL_PRIORITY_BULK = 0
+
+# Failed emails are retried after EMAIL_RETRY_BACKOFF_BASE seconds, doubled after every attempt (with random jitter), up to EMAIL_RETRY_BACKOFF_MAX seconds.
+# If the provider asks to wait longer (Retry-After), that is honored.
+EMAIL_RETRY_BACKOFF_BASE = 30
+EMAIL_RETRY_BACKOFF_MAX = 3600
+
 EMAIL_HOST = secret_manager.get_secret('EMAIL_HOST')
 EMAIL_PORT = secret_manager.get_secret('EMAIL_PORT')
 EMAIL_HOST_USER_NAME = secret_manager.get_secret('EMAIL_HOST_USER_NAME')
@@ -8,4 +8,9 @@ SENTRY_DSN = None
 
 # Better Stack/Logtail Configuration
 USE_BETTERSTACK = False
-BETTERSTACK_SOURCE_TOKEN = None
\ No newline at end of file
+BETTERSTACK_SOURCE_TOKEN = None
+
+# Context processor timings
+# If enabled, the time spent in the context processors (and in computing their lazy values) is measured per request, and added
+# to the response as a Server-Timing header (shown in the network tab of the browser). See modules.context_processors.instrumentation.
+LOG_CONTEXT_PROCESSOR_TIMINGS = False
@@ -9,4 +9,35 @@ STRIPE_TEST_PUBLIC_KEY = secret_manager.get_secret('STRIPE_TEST_PUBLIC_API_KEY')
 STRIPE_TEST_SECRET_KEY = secret_manager.get_secret('STRIPE_TEST_SECRET_API_KEY')
 
 STRIPE_TEST_WEBHOOK_SECRET = secret_manager.get_secret('STRIPE_TEST_WEBHOOK_SECRET')
-STRIPE_LIVE_WEBHOOK_SECRET = secret_manager.get_secret('STRIPE_WEBHOOK_SECRET')
\ No newline at end of file
+STRIPE_LIVE_WEBHOOK_SECRET = secret_manager.get_secret('STRIPE_WEBHOOK_SECRET')
+# Stripe webhook events are stored and acknowledged immediately, and processed by the task queue (see modules.payments.tasks).
+# Events of the same customer are processed in the order Stripe created them. A failing event is retried (with backoff)
+# up to STRIPE_WEBHOOK_MAX_ATTEMPTS times, after which it's marked as failed and the next events of the customer are processed.
+STRIPE_WEBHOOK_MAX_ATTEMPTS = 5
+
+# Processed events are kept for this amount of days, so events that Stripe sends again are recognized and not processed twice.
+STRIPE_WEBHOOK_EVENT_RETENTION_DAYS = 30
+
+# Customers retrieved from Stripe are cached for this amount of seconds (see modules.payments.client).
+# They are removed from the cache when Stripe sends a customer.updated/deleted webhook event.
+STRIPE_CACHE_TIMEOUT = 300
+
+# The line items of a checkout session don't change after the checkout, so they can be cached longer.
+STRIPE_LINE_ITEMS_CACHE_TIMEOUT = 3600
+
+# The HTTP connections to Stripe are kept alive and shared by the threads of a process, up to this amount of connections.
+STRIPE_HTTP_POOL_SIZE = 10
+STRIPE_HTTP_TIMEOUT = 30 # Seconds
+STRIPE_MAX_NETWORK_RETRIES = 2 # Retries of requests that failed because of a network error (Stripe makes them idempotent)
+
+# The base URL of the Stripe API. Set it to e.g. 'http://localhost:12111' to test against stripe-mock. None uses the Stripe API.
+STRIPE_API_BASE = None
+
+# The handlers of a webhook event that don't depend on each other run at the same time, in a thread pool of this size per process.
+STRIPE_WEBHOOK_HANDLER_WORKERS = 4
+
+# The subscriptions, invoices and customers are reconciled with Stripe every night, for changes of which a webhook event was missed
+# (see modules.payments.reconciliation). The invoices of the last STRIPE_RECONCILIATION_INVOICE_DAYS days are checked.
+STRIPE_RECONCILIATION_HOUR = 3
+STRIPE_RECONCILIATION_INVOICE_DAYS = 7
+STRIPE_RECONCILIATION_BATCH_SIZE = 500 # Rows per bulk_update/bulk_create
@@ -6,4 +6,8 @@ from modules.secrets import secret_manager
 
 HUEY_CLASS = 'huey.PriorityRedisHuey'
 REDIS_HOST = secret_manager.get_secret('REDIS_HOST')
-REDIS_PORT = 6379
\ No newline at end of file
+REDIS_PORT = 6379
+# Files generated by background export jobs (see modules.views.BackgroundExportMixin) are stored in this folder of the default storage.
+# They are kept so they can be downloaded more than once, and are deleted by a periodic task after EXPORT_JOB_FILES_MAX_AGE_HOURS.
+EXPORT_JOB_DIRECTORY = 'exports'
+EXPORT_JOB_FILES_MAX_AGE_HOURS = 24
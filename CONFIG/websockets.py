@@ -0,0 +1,17 @@
+# Messages to many channel groups (e.g. a user_{id} group per user) are sent in batches of this amount of groups (see modules.websockets.broadcast).
+# With the Redis channel layer, a batch takes a few Redis round trips instead of a few round trips per group.
+WEBSOCKET_BROADCAST_BATCH_SIZE = 500
+
+# A websocket connection can subscribe to the messages of this amount of page IDs at most (see modules.websockets.consumers).
+WEBSOCKET_MAX_PAGE_SUBSCRIPTIONS = 20
+
+# The codec of the websocket messages: 'json', 'orjson' (faster, pip install orjson) or 'msgpack' (binary, needs a msgpack decoder in the browser).
+# Consumers can use another codec with their codec attribute. Group messages are encoded once with this codec when they're sent,
+# and forwarded as-is to every connection of a consumer that uses the same codec.
+WEBSOCKET_CODEC = 'json'
+
+# Consumers in coalescing mode (coalesce = True) buffer the messages of a connection and send them at most every
+# WEBSOCKET_COALESCE_INTERVAL seconds. Messages with the same action, page ID and coalesce key replace older unsent ones (e.g. progress updates),
+# and when more than WEBSOCKET_MAX_BUFFERED_MESSAGES are waiting for a slow client, the oldest ones are dropped.
+WEBSOCKET_COALESCE_INTERVAL = 0.1 # Seconds
+WEBSOCKET_MAX_BUFFERED_MESSAGES = 100
@@ -19,34 +19,21 @@ class BaseUser(AbstractUser):
         return cancel_subscription_for_user(self)
 
     def get_subscription(self) -> dict | None:
-        from modules.billing.utils import get_subscription_by_key
+        from modules.billing.entitlements import get_entitlements
 
-        if self.subscription and self.subscription.is_active():
-            subscription_key = self.subscription.subscription_key
-        else:
-            subscription_key = 'default'
-
-        subscription_metadata = get_subscription_by_key(subscription_key)
-        subscription_dict = self.subscription.to_dict() if self.subscription else {}
-
-        data = {
-            **subscription_dict,
-            **subscription_metadata,
-        }
-        data.update({'key' : subscription_key})
-
-        return data
+        # The subscription and plan are resolved once per user object (see modules.billing.entitlements)
+        return get_entitlements(self).subscription
 
     def get_initials(self):
         return f'{self.first_name[0]}{self.last_name[0]}'.upper() if self.first_name and self.last_name else f'{self.username[0]}{self.username[1]}'.upper()
 
     def send_forgot_password_email(self):
         from modules.emails.utils import send_user_forgot_password_email
-        send_user_forgot_password_email(self)
+        send_user_forgot_password_email(self, background=True) # The request doesn't wait for the email provider
 
     def send_activation_email(self):
         from modules.emails.utils import send_user_activation_email
-        send_user_activation_email(self)
+        send_user_activation_email(self, background=True)
 
     def add_credits(self, amount: int, reason: str = 'Added credits to account'):
         from modules.billing.utils import add_credits_to_user
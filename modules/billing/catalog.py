@@ -0,0 +1,116 @@
+from types import MappingProxyType
+
+from CONFIG.billing import SUBSCRIPTIONS, CREDIT_PACKAGES
+from modules.utils.config import get_config_version
+
+SUBSCRIPTION_REQUIRED_KEYS = ['key', 'name', 'description', 'icon', 'price', 'show']
+CREDIT_PACKAGE_REQUIRED_KEYS = ['key', 'name', 'description', 'price']
+
+def _freeze(value):
+    """ Returns a read-only copy of the value: dictionaries become read-only mappings and lists become tuples. """
+
+    if isinstance(value, dict):
+        return MappingProxyType({key : _freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+class BillingCatalog:
+    """ The subscription plans and credit packages of CONFIG/billing.py, indexed by key and by Stripe price ID.
+
+        The catalog is built once per process. The plans and packages are read-only (the nested dictionaries are read-only
+        mappings and the lists are tuples), so they can be shared by all requests without being copied.
+        The version is a hash of the configuration, which changes whenever a plan or package is changed.
+    """
+
+    def __init__(self, subscriptions: list, credit_packages: list):
+        self.subscriptions = tuple(_freeze(subscription) for subscription in subscriptions)
+        self.credit_packages = tuple(_freeze(credit_package) for credit_package in credit_packages)
+
+        self.errors = []
+        self._subscriptions_by_key = self._index(self.subscriptions, 'key', 'Subscription')
+        self._subscriptions_by_price_id = self._index(self.subscriptions, 'stripe_price_id', 'Subscription')
+        self._credit_packages_by_key = self._index(self.credit_packages, 'key', 'Credit package')
+        self._credit_packages_by_price_id = self._index(self.credit_packages, 'stripe_price_id', 'Credit package')
+
+        self._price_ids = {
+            **{price_id : (credit_package, 'credit_package') for price_id, credit_package in self._credit_packages_by_price_id.items()},
+            **{price_id : (subscription, 'subscription') for price_id, subscription in self._subscriptions_by_price_id.items()}, # Subscriptions take precedence, like before
+        }
+        for price_id in self._subscriptions_by_price_id.keys() & self._credit_packages_by_price_id.keys():
+            self.errors.append(f'The Stripe price ID "{price_id}" is used by a subscription and a credit package.')
+
+        self.subscription_keys = frozenset(self._subscriptions_by_key)
+        self.credit_package_keys = frozenset(self._credit_packages_by_key)
+        self.version = get_config_version([subscriptions, credit_packages])
+
+    def _index(self, items: tuple, field: str, label: str) -> dict:
+        index = {}
+        for item in items:
+            value = item.get(field)
+            if value is None:
+                continue
+            if value in index:
+                self.errors.append(f'{label}s "{index[value].get("key")}" and "{item.get("key")}" have the same {field} "{value}".')
+                continue # The first one is kept, like the linear search did
+            index[value] = item
+        return index
+
+    def get_subscription(self, key: str) -> MappingProxyType | None:
+        return self._subscriptions_by_key.get(key)
+
+    def get_subscription_by_price_id(self, price_id: str) -> MappingProxyType | None:
+        return self._subscriptions_by_price_id.get(price_id)
+
+    def get_credit_package(self, key: str) -> MappingProxyType | None:
+        return self._credit_packages_by_key.get(key)
+
+    def get_credit_package_by_price_id(self, price_id: str) -> MappingProxyType | None:
+        return self._credit_packages_by_price_id.get(price_id)
+
+    def get_data_and_type_for_price_id(self, price_id: str) -> tuple[MappingProxyType, str] | tuple[None, None]:
+        return self._price_ids.get(price_id, (None, None))
+
+    def validate(self, billing_model: str) -> list:
+        """ Returns the errors in the configuration of the plans and packages used by the billing model (for the power on self test).
+
+            :param billing_model: The BILLING_MODEL setting.
+            :type billing_model: str
+            :return: The errors, empty if the configuration is valid.
+            :rtype: list
+        """
+
+        errors = list(self.errors)
+
+        if billing_model in ['subscriptions', 'both']:
+            if len(self.subscriptions) == 0:
+                errors.append('No subscription plans found. Please add at least one subscription plan to the SUBSCRIPTIONS list in CONFIG/billing.py.')
+
+            errors.extend(self._validate_items(self.subscriptions, SUBSCRIPTION_REQUIRED_KEYS, 'Subscription'))
+
+            if self.get_subscription('default') is None:
+                errors.append('No subscription with key "default" found. Please add a subscription with the key "default" to the SUBSCRIPTIONS list in CONFIG/billing.py.')
+
+        if billing_model in ['credits', 'both']:
+            if len(self.credit_packages) == 0:
+                errors.append('No credit packages found. Please add at least one credit package to the CREDIT_PACKAGES list in CONFIG/billing.py.')
+
+            errors.extend(self._validate_items(self.credit_packages, CREDIT_PACKAGE_REQUIRED_KEYS, 'Credit package'))
+
+        return errors
+
+    def _validate_items(self, items: tuple, required_keys: list, label: str) -> list:
+        errors = []
+        for item in items:
+            for key in required_keys:
+                if key not in item:
+                    errors.append(f'{label} with key "{item.get("key")}" is missing the key "{key}".')
+
+            if 'price' in item:
+                if 'value' not in item['price']:
+                    errors.append(f'{label} with key "{item.get("key")}" is missing the key "value" in the price dictionary.')
+                if 'currency_symbol' not in item['price']:
+                    errors.append(f'{label} with key "{item.get("key")}" is missing the key "currency_symbol" in the price dictionary.')
+        return errors
+
+BILLING_CATALOG = BillingCatalog(SUBSCRIPTIONS, CREDIT_PACKAGES)
@@ -0,0 +1,123 @@
+from functools import cached_property
+
+from django.core.cache import cache
+from django.db import transaction
+
+from CONFIG.billing import ENTITLEMENTS_CACHE_TIMEOUT
+from modules.billing.catalog import BILLING_CATALOG
+from modules.billing.models import Subscription
+
+def get_entitlements_cache_key(user_pk) -> str:
+    return f'entitlements_{user_pk}'
+
+class Entitlements:
+    """ What a user is entitled to: their subscription and the plan that applies to them.
+
+        The entitlements are resolved once per request (see EntitlementsMiddleware) and shared by the views, mixins,
+        the subnav and the templates (as request.entitlements), instead of each of them loading and converting the subscription.
+    """
+
+    def __init__(self, user, subscription: Subscription | None):
+        self.user = user
+        self.is_authenticated = user.is_authenticated
+        self.is_staff = user.is_staff
+        self.is_superuser = user.is_superuser
+        self.subscription_object = subscription
+
+        # The key of the subscription of the user (also if it isn't active), used for the required_subscription checks
+        self.subscription_key = subscription.subscription_key if subscription else None
+        self.is_active = subscription.is_active() if subscription else False
+
+        # The plan that applies to the user: the subscription if it's active, the default plan otherwise
+        self.plan_key = self.subscription_key if self.is_active else 'default'
+
+    @property
+    def plan(self):
+        """ The plan that applies to the user, from the billing catalog (read-only). """
+        return BILLING_CATALOG.get_subscription(self.plan_key)
+
+    def has_subscription(self, subscription_keys: str | list) -> bool:
+        """ Returns whether the subscription of the user is one of the subscription keys. """
+
+        if isinstance(subscription_keys, str):
+            return self.subscription_key == subscription_keys
+        return self.subscription_key in subscription_keys
+
+    @cached_property
+    def subscription(self) -> dict:
+        """ The subscription fields and methods, merged with the plan (see BaseUser.get_subscription). """
+
+        data = {
+            **(self.subscription_object.to_dict() if self.subscription_object else {}),
+            **(self.plan or {}),
+        }
+        data.update({'key' : self.plan_key})
+        return data
+
+def _load_subscription(user) -> Subscription | None:
+    """ Returns the subscription of the user from the cache, or from the database (and then caches it). """
+
+    key = get_entitlements_cache_key(user.pk)
+    if ENTITLEMENTS_CACHE_TIMEOUT:
+        fields = cache.get(key)
+        if fields is not None:
+            if not fields: # The user doesn't have a subscription
+                return None
+            # Not attached to the user, so a stale copy can't be saved by accident
+            return Subscription.from_db('default', list(fields), list(fields.values()))
+
+    subscription = Subscription.objects.filter(user_id=user.pk).first()
+
+    # The subscription is attached to the user, so request.user.subscription doesn't load it again
+    if subscription is not None:
+        user._state.fields_cache['subscription'] = subscription
+        subscription._state.fields_cache['user'] = user
+
+    if ENTITLEMENTS_CACHE_TIMEOUT:
+        fields = {field.attname : getattr(subscription, field.attname) for field in Subscription._meta.concrete_fields} if subscription else {}
+        cache.set(key, fields, ENTITLEMENTS_CACHE_TIMEOUT)
+
+    return subscription
+
+def get_entitlements(user) -> Entitlements:
+    """ Returns the entitlements of the user. They are computed once per user object, so once per request for request.user.
+
+        :param user: The user (may be anonymous).
+        :type user: User
+        :return: The entitlements of the user.
+        :rtype: Entitlements
+    """
+
+    entitlements = getattr(user, '_entitlements', None)
+    if entitlements is not None:
+        return entitlements
+
+    if not user.is_authenticated:
+        entitlements = Entitlements(user, None)
+    elif 'subscription' in user._state.fields_cache: # Already loaded (e.g. with select_related)
+        entitlements = Entitlements(user, user._state.fields_cache['subscription'])
+    else:
+        entitlements = Entitlements(user, _load_subscription(user))
+
+    user._entitlements = entitlements
+    return entitlements
+
+def invalidate_entitlements(subscription: Subscription, using: str | None = None) -> None:
+    """ Removes the cached entitlements of the user of the subscription (when the subscription is saved or deleted).
+        The cache is cleared once the transaction is committed, so a request in the meantime can't cache the old subscription again.
+    """
+
+    key = get_entitlements_cache_key(subscription.user_id)
+    transaction.on_commit(lambda: cache.delete(key), using=using)
+
+    user = subscription._state.fields_cache.get('user')
+    if user is not None:
+        user.__dict__.pop('_entitlements', None)
+
+def invalidate_entitlements_for_users(user_ids, using: str | None = None) -> None:
+    """ Removes the cached entitlements of the users, for changes that don't send signals (e.g. bulk_update of subscriptions).
+        Like invalidate_entitlements, the cache is cleared once the transaction is committed.
+    """
+
+    keys = [get_entitlements_cache_key(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys), using=using)
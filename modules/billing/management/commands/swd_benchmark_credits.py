@@ -0,0 +1,57 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, close_old_connections
+
+from modules.billing.models import CreditAction
+from modules.billing.utils import consume_credit_for_user, consume_credits_for_users
+
+class Command(BaseCommand):
+    help = 'Consumes credits of one user from many parallel workers and checks that the balance and the credit actions are correct'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumers', type=int, default=500, help='Amount of parallel consume requests')
+        parser.add_argument('--workers', type=int, default=50, help='Amount of threads (each thread uses its own database connection)')
+        parser.add_argument('--credits', type=int, default=400, help='Starting balance of the benchmark user. Lower than --consumers, so some requests must fail')
+
+    def consume(self, user_id):
+        try:
+            user = get_user_model().objects.get(pk=user_id)
+            return consume_credit_for_user(user, 1, 'Benchmark')
+        finally:
+            close_old_connections()
+            connection.close()
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            raise CommandError('SQLite locks the whole database on writes, run the benchmark against the production database engine.')
+
+        user = get_user_model().objects.create(username=f'credits-benchmark-{uuid.uuid4().hex[:8]}', credits_balance=options['credits'])
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                results = list(executor.map(self.consume, [user.pk] * options['consumers']))
+            duration = time.perf_counter() - start
+
+            user.refresh_from_db(fields=['credits_balance'])
+            consumed = results.count(True)
+            expected_consumed = min(options['consumers'], options['credits'])
+            actions = CreditAction.objects.filter(user=user).count()
+
+            self.stdout.write(f'{options["consumers"]} consumers, {options["workers"]} workers: {duration:.2f}s ({options["consumers"] / duration:.0f} consumes/s)')
+            self.stdout.write(f'Consumed: {consumed} (expected {expected_consumed}), balance: {user.credits_balance} (expected {options["credits"] - expected_consumed}), credit actions: {actions}')
+
+            start = time.perf_counter()
+            batch = consume_credits_for_users({user.pk: 1}, 'Benchmark (batch)')
+            self.stdout.write(f'Batch consume: {batch} in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+            if consumed != expected_consumed or user.credits_balance != options['credits'] - expected_consumed or actions != consumed:
+                raise CommandError('The credit balance is inconsistent.')
+
+            self.stdout.write(self.style.SUCCESS('The credit balance is consistent'))
+        finally:
+            user.delete()
@@ -0,0 +1,15 @@
+from django.utils.functional import SimpleLazyObject
+
+from modules.billing.entitlements import get_entitlements
+
+class EntitlementsMiddleware:
+    """ Adds the entitlements of the user to the request (request.entitlements), see modules.billing.entitlements.
+        The entitlements are only resolved when they are used. Must come after the authentication (and impersonation) middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.entitlements = SimpleLazyObject(lambda: get_entitlements(request.user))
+        return self.get_response(request)
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='creditaction',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='creditaction_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stripeinvoice',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='stripeinvoice_user_created_idx'),
+        ),
+    ]
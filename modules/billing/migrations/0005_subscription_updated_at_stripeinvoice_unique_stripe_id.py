@@ -0,0 +1,36 @@
+# Generated by Django 5.0.2 on 2026-10-18 14:05
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_invoices(apps, schema_editor):
+    """ Keeps the first invoice of every Stripe invoice, so the stripe_id can be made unique. """
+
+    StripeInvoice = apps.get_model('billing', 'StripeInvoice')
+    duplicates = StripeInvoice.objects.values('stripe_id').annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1).order_by()
+    for duplicate in duplicates:
+        StripeInvoice.objects.filter(stripe_id=duplicate['stripe_id']).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0004_creditaction_created_at_creditbalancesnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(remove_duplicate_invoices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stripeinvoice',
+            name='stripe_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
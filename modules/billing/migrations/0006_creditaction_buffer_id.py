@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0005_subscription_updated_at_stripeinvoice_unique_stripe_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='creditaction',
+            name='buffer_id',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+    ]
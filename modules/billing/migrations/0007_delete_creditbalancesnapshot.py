@@ -0,0 +1,16 @@
+# Generated by Django 5.0.2 on 2026-10-18 12:18
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0006_creditaction_buffer_id'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='CreditBalanceSnapshot',
+        ),
+    ]
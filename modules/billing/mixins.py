@@ -4,6 +4,8 @@ from django.contrib import messages
 from django.utils.translation import gettext_lazy as _
 from django.http import HttpResponseRedirect
 
+from modules.billing.entitlements import get_entitlements
+
 class UserHasSubscriptionMixin:
     required_subscription = None
     
@@ -25,12 +27,13 @@ class UserHasSubscriptionMixin:
         if not request.user.is_authenticated:
             return redirect('authentication:login')
         
-        # User doesn't have a valid subscription
-        if not hasattr(request.user, 'subscription'):
+        # User doesn't have a valid subscription (the subscription is resolved once per request, see modules.billing.entitlements)
+        entitlements = get_entitlements(request.user)
+        if entitlements.subscription_key is None:
             raise PermissionDenied()
         
         # User doesn't have the required permission
-        if not request.user.subscription.subscription_key in self.get_required_subscription():
+        if not entitlements.has_subscription(self.get_required_subscription()):
             raise PermissionDenied()
         
         return super().dispatch(request, *args, **kwargs)
@@ -79,9 +82,8 @@ class CreditActionMixin:
             return redirect('authentication:login')
         
         if self.get_consume_credits_on() == request.method.lower():
-            if request.user.credits_balance < self.get_amount_of_credits():
+            # The balance is checked and updated in one query, so concurrent requests can't consume the same credits
+            if not request.user.consume_credits(self.get_amount_of_credits(), self.get_action()):
                 return redirect(self.get_failed_url())
-            
-            request.user.consume_credits(self.get_amount_of_credits(), self.get_action())
         
         return super().dispatch(request, *args, **kwargs)
\ No newline at end of file
@@ -17,20 +17,16 @@ class Subscription(models.Model):
     cancel_at_period_end = models.BooleanField(default=False)
     lifetime = models.BooleanField(default=False)
 
+    updated_at = models.DateTimeField(auto_now=True)
+
     def __str__(self):
         return f"{self.user} - Subscription: {self.subscription_key}"
     
     def to_dict(self):
-        fields = [field.name for field in self._meta.get_fields() if field.name != 'user'] # remove the user field, as it's a ForeignKey
+        fields = [field.name for field in self._meta.concrete_fields if field.name != 'user'] # remove the user field, as it's a ForeignKey
         methods = ['is_default', 'can_be_cancelled', 'marked_for_cancellation', 'cancels_at', 'renews_at', 'is_active']
 
-        result = {}
-        for field in fields:
-            if callable(field):
-                result[field] = getattr(self, field)()
-            else:
-                result[field] = getattr(self, field)
-
+        result = {field : getattr(self, field) for field in fields}
         for method in methods:
             result[method] = getattr(self, method)()
         
@@ -70,7 +66,7 @@ class Subscription(models.Model):
     
 class StripeInvoice(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='invoices')
-    stripe_id = models.CharField(max_length=255)
+    stripe_id = models.CharField(max_length=255, unique=True)
 
     number = models.CharField(max_length=255)
     hosted_invoice_url = models.URLField(null=True, blank=True)
@@ -79,6 +75,9 @@ class StripeInvoice(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='stripeinvoice_user_created_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user} - {self.number}'
@@ -91,10 +90,14 @@ class CreditAction(models.Model):
     credits_before = models.IntegerField()
     credits_after = models.IntegerField()
 
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False) # Not auto_now_add, so buffered credit actions keep the time they happened
+    buffer_id = models.UUIDField(unique=True, null=True, blank=True, editable=False) # The ID of a buffered credit action, so it's written only once
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='creditaction_user_created_idx'),
+        ]
 
     def __str__(self):
-        return f'{self.user} - {self.amount} - {self.action}'
\ No newline at end of file
+        return f'{self.user} - {self.amount} - {self.action}'
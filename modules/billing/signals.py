@@ -1,10 +1,17 @@
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from modules.billing.models import Subscription
+from modules.billing.entitlements import invalidate_entitlements
 
 
 def create_subscription(sender, instance, created, **kwargs):
     if not hasattr(instance, 'subscription'):
         Subscription.objects.create(user=instance, subscription_key='default')
 
-post_save.connect(create_subscription, sender=get_user_model())
\ No newline at end of file
+post_save.connect(create_subscription, sender=get_user_model())
+
+def clear_entitlements(sender, instance, using=None, **kwargs):
+    invalidate_entitlements(instance, using=using)
+
+post_save.connect(clear_entitlements, sender=Subscription)
+post_delete.connect(clear_entitlements, sender=Subscription)
@@ -0,0 +1,15 @@
+from huey import crontab
+from huey.contrib.djhuey import periodic_task
+
+from CONFIG.billing import BUFFER_CREDIT_ACTIONS
+from .utils import flush_credit_actions
+
+@periodic_task(crontab(minute='*'))
+def flush_credit_actions_buffer():
+    """ (Task queue) Write the buffered credit actions to the database. """
+
+    if not BUFFER_CREDIT_ACTIONS:
+        return
+
+    while flush_credit_actions():
+        pass
@@ -1,11 +1,25 @@
+import json
+import uuid
+import logging
+import datetime
+
 import stripe
+from huey.contrib.djhuey import HUEY
+from redis.exceptions import LockError
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction, DataError, IntegrityError
+from django.db.models import F, Case, When, Value
 
-from CONFIG.billing import SUBSCRIPTIONS, CREDIT_PACKAGES
+from CONFIG.billing import BUFFER_CREDIT_ACTIONS, CREDIT_ACTIONS_FLUSH_BATCH_SIZE
+from modules.billing.catalog import BILLING_CATALOG
+from modules.views import bump_table_version
 from .models import CreditAction
 
+logger = logging.getLogger(__name__)
+
 stripe.api_key = settings.STRIPE_SECRET_KEY
-VALID_SUBSCRIPTION_KEYS = [subscription['key'] for subscription in SUBSCRIPTIONS]
+VALID_SUBSCRIPTION_KEYS = BILLING_CATALOG.subscription_keys
 
 def cancel_subscription_for_user(user) -> bool:
     """ Cancels the subscription for the user. 
@@ -32,6 +46,9 @@ def cancel_subscription_for_user(user) -> bool:
 def add_credits_to_user(user, amount: int, reason: str) -> None:
     """ Adds credits to the user and logs the reason.
 
+        The balance is updated in the database with a single UPDATE (credits_balance = credits_balance + amount),
+        so concurrent updates of the balance are never lost.
+
         :param user: The user to add the credits to.
         :type user: User
         :param amount: The amount of credits to add.
@@ -40,25 +57,29 @@ def add_credits_to_user(user, amount: int, reason: str) -> None:
         :type reason: str
     """
 
-    credits_before = user.credits_balance
+    users = get_user_model().objects.filter(pk=user.pk)
 
-    user.credits_balance += amount
-    user.save()
+    with transaction.atomic():
+        users.update(credits_balance=F('credits_balance') + amount)
+        credits_after = users.values_list('credits_balance', flat=True).get() # The row is locked by the update until the transaction ends
 
-    credits_after = user.credits_balance
+        log_credit_actions([CreditAction(
+            user_id=user.pk,
+            amount=amount,
+            action=reason,
+            credits_before=credits_after - amount,
+            credits_after=credits_after
+        )])
 
-    CreditAction.objects.create(
-        user=user,
-        amount=amount,
-        action=reason,
-        credits_before=credits_before,
-        credits_after=credits_after
-    )
+    user.credits_balance = credits_after
 
 def consume_credit_for_user(user, amount: int, action: str) -> bool:
     """ Consumes the credit for the user and logs the action.
         Returns True if the user had enough credit to consume, False otherwise.
 
+        The check and the update are done in a single conditional UPDATE (... WHERE credits_balance >= amount),
+        so concurrent requests can't consume the same credits twice.
+
         :param user: The user to consume the credit for.
         :type user: User
         :param amount: The amount of credit to consume.
@@ -70,66 +91,201 @@ def consume_credit_for_user(user, amount: int, action: str) -> bool:
 
     """
 
-    if user.credits_balance >= amount:
-        credits_before = user.credits_balance
+    users = get_user_model().objects.filter(pk=user.pk)
 
-        user.credits_balance -= amount
-        user.save()
+    with transaction.atomic():
+        consumed = users.filter(credits_balance__gte=amount).update(credits_balance=F('credits_balance') - amount)
+        credits_after = users.values_list('credits_balance', flat=True).get()
 
-        credits_after = user.credits_balance
+        if consumed:
+            log_credit_actions([CreditAction(
+                user_id=user.pk,
+                amount=amount,
+                action=action,
+                credits_before=credits_after + amount,
+                credits_after=credits_after
+            )])
 
-        CreditAction.objects.create(
-            user=user,
-            amount=amount,
-            action=action,
-            credits_before=credits_before,
-            credits_after=credits_after
-        )
+    user.credits_balance = credits_after
+    return bool(consumed)
 
-        return True
+def consume_credits_for_users(amounts: dict, action: str) -> dict:
+    """ Consumes credits for many users at once and logs the action for each user.
+        The amount of queries doesn't depend on the amount of users: the rows are locked, updated and logged with one query each.
+        Users that don't have enough credits are skipped.
 
-    return False
+        :param amounts: The amount of credits to consume per user id.
+        :type amounts: dict[int, int]
+        :param action: The action to log.
+        :type action: str
+        :return: Whether the credits were consumed, per user id.
+        :rtype: dict[int, bool]
+    """
 
-def get_subscription_by_key(subscription_key: str) -> dict | None:
-    """ Get subscription by key. Returns None if not found. """
+    if not amounts:
+        return {}
+
+    with transaction.atomic():
+        # Lock the rows in a fixed order, so concurrent batches can't deadlock
+        balances = dict(get_user_model().objects.select_for_update().filter(pk__in=amounts.keys()).order_by('pk').values_list('pk', 'credits_balance'))
+        consume = {user_id: amount for user_id, amount in amounts.items() if user_id in balances and balances[user_id] >= amount}
+
+        if consume:
+            get_user_model().objects.filter(pk__in=consume.keys()).update(
+                credits_balance=F('credits_balance') - Case(*[When(pk=user_id, then=Value(amount)) for user_id, amount in consume.items()])
+            )
+
+            log_credit_actions([
+                CreditAction(
+                    user_id=user_id,
+                    amount=amount,
+                    action=action,
+                    credits_before=balances[user_id],
+                    credits_after=balances[user_id] - amount
+                ) for user_id, amount in consume.items()
+            ])
+
+    return {user_id: user_id in consume for user_id in amounts}
+
+CREDIT_ACTIONS_BUFFER_KEY = 'credit_actions_buffer'
+CREDIT_ACTIONS_PROCESSING_KEY = 'credit_actions_buffer:processing' # The batch that is being written
+CREDIT_ACTIONS_FAILED_KEY = 'credit_actions_buffer:failed' # Batches that can't be written, kept for inspection
+CREDIT_ACTIONS_FLUSH_LOCK_TIMEOUT = 60 # Seconds after which the lock of a flush expires, e.g. when the worker died
+
+def _get_credit_actions_buffer():
+    """ Returns the Redis connection of the task queue, or None if the task queue doesn't use Redis (e.g. in immediate mode). """
+    return getattr(HUEY.storage, 'conn', None)
+
+def log_credit_actions(credit_actions: list[CreditAction]) -> None:
+    """ Logs the credit actions.
+        If BUFFER_CREDIT_ACTIONS is True, the credit actions are pushed to a buffer in Redis once the transaction is committed,
+        and written later by the flush_credit_actions_buffer task. Otherwise they are written immediately.
+
+        :param credit_actions: The (unsaved) credit actions to log.
+        :type credit_actions: list[CreditAction]
+    """
+
+    buffer = _get_credit_actions_buffer() if BUFFER_CREDIT_ACTIONS else None
+    if buffer is None:
+        CreditAction.objects.bulk_create(credit_actions)
+        transaction.on_commit(lambda: bump_table_version(CreditAction)) # bulk_create doesn't send the post_save signal
+        return
+
+    payloads = [json.dumps({
+        'buffer_id' : str(uuid.uuid4()),
+        'user_id' : credit_action.user_id,
+        'amount' : credit_action.amount,
+        'action' : str(credit_action.action),
+        'credits_before' : credit_action.credits_before,
+        'credits_after' : credit_action.credits_after,
+        'created_at' : credit_action.created_at.isoformat(),
+    }) for credit_action in credit_actions]
+
+    transaction.on_commit(lambda: buffer.rpush(CREDIT_ACTIONS_BUFFER_KEY, *payloads))
+
+def _write_credit_actions(credit_actions: list[CreditAction]) -> None:
+    """ Writes buffered credit actions. Credit actions that were already written (e.g. by a flush that died before it
+        removed its batch from Redis) are skipped, because of the unique buffer_id.
+    """
 
-    for subscription in SUBSCRIPTIONS:
-        if subscription.get('key') == subscription_key:
-            return subscription
-    return None
+    with transaction.atomic():
+        CreditAction.objects.bulk_create(credit_actions, ignore_conflicts=True)
+
+def _without_deleted_users(credit_actions: dict) -> dict:
+    """ Returns the credit actions (per payload) of the users that still exist, and logs how many were dropped. """
+
+    user_ids = set(get_user_model().objects.filter(pk__in={credit_action.user_id for credit_action in credit_actions.values()}).values_list('pk', flat=True))
+    remaining = {payload: credit_action for payload, credit_action in credit_actions.items() if credit_action.user_id in user_ids}
+    if len(remaining) < len(credit_actions):
+        logger.warning(f'Dropped {len(credit_actions) - len(remaining)} buffered credit actions of deleted users')
+    return remaining
+
+def flush_credit_actions(batch_size: int = CREDIT_ACTIONS_FLUSH_BATCH_SIZE) -> int:
+    """ Writes a batch of buffered credit actions to the database.
+        Returns the amount of buffered credit actions that were handled (written, or dropped because the user was deleted).
+
+        Credit actions that can't be written (e.g. invalid data) are moved to the CREDIT_ACTIONS_FAILED_KEY list and logged, so they
+        don't block the buffer. When the database is unavailable the error is raised, and the batch is written by the next flush.
+
+        :param batch_size: The maximum amount of credit actions to write.
+        :type batch_size: int
+        :return: The amount of buffered credit actions that were handled.
+        :rtype: int
+    """
+
+    buffer = _get_credit_actions_buffer()
+    if buffer is None:
+        return 0
+
+    # One flush at a time, as they share the processing list. The lock expires, so a worker that died doesn't block the flushes.
+    lock = buffer.lock(f'{CREDIT_ACTIONS_BUFFER_KEY}:lock', timeout=CREDIT_ACTIONS_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+
+    try:
+        # The batch is moved to the processing list, and only removed once it's written. A batch that is left behind
+        # (because the worker died or the database was unavailable) is written by the next flush, so no credit actions are lost.
+        payloads = buffer.lrange(CREDIT_ACTIONS_PROCESSING_KEY, 0, -1)
+        if not payloads:
+            pipeline = buffer.pipeline()
+            for _ in range(batch_size):
+                pipeline.lmove(CREDIT_ACTIONS_BUFFER_KEY, CREDIT_ACTIONS_PROCESSING_KEY, 'LEFT', 'RIGHT')
+            payloads = [payload for payload in pipeline.execute() if payload is not None]
+
+        if not payloads:
+            return 0
+
+        credit_actions = {}
+        for payload in payloads:
+            data = json.loads(payload)
+            data['created_at'] = datetime.datetime.fromisoformat(data['created_at'])
+            credit_actions[payload] = CreditAction(**data)
+
+        pipeline = buffer.pipeline()
+        try:
+            _write_credit_actions(list(credit_actions.values()))
+        except (IntegrityError, DataError):
+            # E.g. a user that was deleted after the credit actions were buffered. The credit actions are written one by one,
+            # and the ones that still fail are moved to the failed list.
+            credit_actions = _without_deleted_users(credit_actions)
+            for payload, credit_action in list(credit_actions.items()):
+                try:
+                    _write_credit_actions([credit_action])
+                except (IntegrityError, DataError):
+                    logger.exception(f'Failed to write a buffered credit action, it is moved to {CREDIT_ACTIONS_FAILED_KEY}: {payload}')
+                    pipeline.rpush(CREDIT_ACTIONS_FAILED_KEY, payload)
+                    del credit_actions[payload]
+
+        pipeline.delete(CREDIT_ACTIONS_PROCESSING_KEY)
+        pipeline.execute()
+    finally:
+        try:
+            lock.release()
+        except LockError: # Expired
+            pass
+
+    if credit_actions:
+        bump_table_version(CreditAction)
+    return len(payloads)
+
+def get_subscription_by_key(subscription_key: str) -> dict | None:
+    """ Get subscription by key (read-only). Returns None if not found. """
+    return BILLING_CATALOG.get_subscription(subscription_key)
 
 def get_subscription_by_price_id(price_id: str) -> dict | None:
-    """ Get subscription by price ID. Returns None if not found. """
-    for subscription in SUBSCRIPTIONS:
-        if subscription.get('stripe_price_id') == price_id:
-            return subscription
-    return None
+    """ Get subscription by price ID (read-only). Returns None if not found. """
+    return BILLING_CATALOG.get_subscription_by_price_id(price_id)
 
 def get_credit_package_by_key(credit_package_key: str) -> dict | None:
-    """ Get credit package by key. Returns None if not found. """
-    for credit_package in CREDIT_PACKAGES:
-        if credit_package.get('key') == credit_package_key:
-            return credit_package
-    return None
+    """ Get credit package by key (read-only). Returns None if not found. """
+    return BILLING_CATALOG.get_credit_package(credit_package_key)
 
 def get_credit_package_by_price_id(price_id: str) -> dict | None:
-    """ Get credit package by price ID. Returns None if not found. """
-    for credit_package in CREDIT_PACKAGES:
-        if credit_package.get('stripe_price_id') == price_id:
-            return credit_package
-    return None
+    """ Get credit package by price ID (read-only). Returns None if not found. """
+    return BILLING_CATALOG.get_credit_package_by_price_id(price_id)
 
 def get_data_and_type_for_price_id(price_id: str) -> tuple[dict, str]:
     """ Get subscription or credit package by price ID. 
         Returns (data, type) where type is either 'subscription' or 'credit_package'. Data is the subscription or credit package.
     """
-
-    subscription = get_subscription_by_price_id(price_id)
-    if subscription:
-        return subscription, 'subscription'
-    
-    credit_package = get_credit_package_by_price_id(price_id)
-    if credit_package:
-        return credit_package, 'credit_package'
-    
-    return None, None
\ No newline at end of file
+    return BILLING_CATALOG.get_data_and_type_for_price_id(price_id)
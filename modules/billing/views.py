@@ -19,6 +19,8 @@ class InvoiceTableData(LoginRequiredMixin, DynamicTableData):
     sort_options = [{ 'name': 'Number', 'field': 'number', }, { 'name': 'Date', 'field': 'created_at', }]
     sort_default = '-created_at'
     search_fields = ['number']
+    cursor_pagination = True
+    cache_timeout = 300
 
     def get_queryset(self):
         return self.request.user.invoices.all()
@@ -30,6 +32,8 @@ class CreditActionsTableData(LoginRequiredMixin, DynamicTableData):
     sort_options = [{ 'name': 'Date', 'field': 'created_at', }, { 'name': 'Amount', 'field': 'amount', }]
     sort_default = '-created_at'
     search_fields = ['action', 'amount']
+    cursor_pagination = True
+    cache_timeout = 300
 
     def get_queryset(self):
         return self.request.user.credit_actions.all()
@@ -42,8 +46,8 @@ class ManageBilling(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['billing_model'] = settings.BILLING_MODEL
-        context['subscriptions'] = billing.SUBSCRIPTIONS
-        context['credit_packages'] = billing.CREDIT_PACKAGES
+        context['subscriptions'] = billing.BILLING_CATALOG.subscriptions
+        context['credit_packages'] = billing.BILLING_CATALOG.credit_packages
         return context
 
 class SubscripeToSubscription(LoginRequiredMixin, View):
@@ -68,7 +72,7 @@ class SubscripeToSubscription(LoginRequiredMixin, View):
             messages.error(request, _('Invalid subscription key'))
             return redirect('billing:manage_billing')
         
-        if subscription_key == request.user.get_subscription()['key']:
+        if subscription_key == request.entitlements.subscription['key']:
             messages.info(request, _('You are already subscribed to this subscription'))
             return redirect('billing:manage_billing')
 
@@ -84,7 +88,7 @@ class CancelSubscription(LoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
         context = {
-            'subscription': request.user.get_subscription(),
+            'subscription': request.entitlements.subscription,
         }
         return render(request, self.template_name, context)
 
@@ -1,13 +1,21 @@
 from modules.utils.subnav import get_visible_subnav_for_user
+from modules.context_processors.instrumentation import timed_context_processor, LazyContextValue
 
 from django.conf import settings
 from CONFIG.authentication import ALLOW_GITHUB_LOGIN, ALLOW_LINKED_IN_LOGIN, ALLOW_THIRD_PARTY_LOGIN, ALLOW_REGISTRATIONS
 
+@timed_context_processor
 def add_global_subnav(request):
+    # The subnav (and the user it depends on) is only loaded when a template uses it, once per request
+    subnav = getattr(request, '_global_subnav', None)
+    if subnav is None:
+        subnav = request._global_subnav = LazyContextValue(request, 'GLOBAL_SUBNAV', lambda: get_visible_subnav_for_user(request.user))
+
     return {
-        'GLOBAL_SUBNAV': get_visible_subnav_for_user(request.user)
+        'GLOBAL_SUBNAV': subnav
     }
 
+@timed_context_processor
 def add_platform_config(request):
     return {
         'PLATFORM_NAME' : settings.PLATFORM_NAME,
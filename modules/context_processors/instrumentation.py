@@ -0,0 +1,90 @@
+import time
+import logging
+import functools
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.dispatch import Signal
+from django.utils.functional import SimpleLazyObject
+
+from CONFIG.logging import LOG_CONTEXT_PROCESSOR_TIMINGS
+
+logger = logging.getLogger(__name__)
+
+# Sent at the end of every request when LOG_CONTEXT_PROCESSOR_TIMINGS is enabled, with the request and its ContextProcessorTimings.
+# Connect to it to send the timings to a metrics backend.
+context_processor_timings_recorded = Signal()
+
+class ContextProcessorTimings:
+    """ The number of calls and the time spent per context processor (and per lazy context value) during a request. """
+
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.seconds.values())
+
+    def get_server_timing(self) -> str:
+        """ Returns the timings as Server-Timing header value (durations in milliseconds). """
+
+        metrics = [f'context-processors;dur={self.total_seconds * 1000:.2f}']
+        for name, seconds in self.seconds.items():
+            metrics.append(f'{name.replace(".", "-")};dur={seconds * 1000:.2f};desc="{self.calls[name]}x"')
+        return ', '.join(metrics)
+
+def _record(request, name: str, seconds: float) -> None:
+    timings = getattr(request, 'context_processor_timings', None)
+    if timings is not None:
+        timings.record(name, seconds)
+
+def timed_context_processor(context_processor):
+    """ Decorator that records the time spent in the context processor, when the timings are enabled. Each call is one template render. """
+
+    @functools.wraps(context_processor)
+    def wrapper(request):
+        if getattr(request, 'context_processor_timings', None) is None:
+            return context_processor(request)
+
+        start = time.perf_counter()
+        context = context_processor(request)
+        _record(request, context_processor.__name__, time.perf_counter() - start)
+        return context
+    return wrapper
+
+class LazyContextValue(SimpleLazyObject):
+    """ A context value that is only computed when a template uses it (once per request), so renders that don't use it
+        (e.g. partials and emails rendered with the request) don't pay for it. The computation is timed like a context processor.
+    """
+
+    def __init__(self, request, name: str, func):
+        def setup():
+            start = time.perf_counter()
+            value = func()
+            _record(request, name, time.perf_counter() - start)
+            return value
+
+        super().__init__(setup)
+
+class ContextProcessorTimingMiddleware:
+    """ Measures the time spent in the context processors per request (see LOG_CONTEXT_PROCESSOR_TIMINGS). Place it first in MIDDLEWARE. """
+
+    def __init__(self, get_response):
+        if not LOG_CONTEXT_PROCESSOR_TIMINGS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.context_processor_timings = timings = ContextProcessorTimings()
+        response = self.get_response(request)
+
+        if timings.calls:
+            response['Server-Timing'] = timings.get_server_timing() if 'Server-Timing' not in response else f'{response["Server-Timing"]}, {timings.get_server_timing()}'
+            logger.debug('Context processors took %.2f ms for %s %s: %s', timings.total_seconds * 1000, request.method, request.path, timings.calls)
+
+        context_processor_timings_recorded.send(sender=self.__class__, request=request, timings=timings)
+        return response
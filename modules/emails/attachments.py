@@ -0,0 +1,166 @@
+import os
+import base64
+import smtplib
+import mimetypes
+import functools
+import threading
+from collections import OrderedDict
+from email import policy
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from typing import Callable, Iterator
+
+from django.contrib.staticfiles import finders
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+
+ATTACHMENT_CHUNK_SIZE = 57 * 1024 # A multiple of 57 bytes, which is encoded to complete 76 character base64 lines
+ENCODED_ATTACHMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024 # The maximum size of the cached encoded static file attachments (per process)
+
+_encoded_attachments = OrderedDict()
+_encoded_attachments_size = 0
+_encoded_attachments_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=256)
+def find_static_file(path: str) -> str | None:
+    """ Returns the absolute path of a static file, or None if it isn't a static file. The lookups are cached per process. """
+
+    try:
+        return finders.find(path)
+    except SuspiciousFileOperation: # Absolute paths are not static files
+        return None
+
+def _read_exact(file, size: int) -> bytes:
+    """ Reads size bytes (less only at the end of the file), as some storages return less than asked. """
+
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = file.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+class EmailAttachment:
+    """ An email attachment, from the static files, a local path or the default storage (in that order).
+        The content is read and base64 encoded in chunks, so the file is never fully loaded in memory.
+    """
+
+    def __init__(self, attachment: str):
+        self.name = attachment
+        self.file_name = attachment.split('/')[-1]
+        self.in_storage = False
+        self.is_static = False
+
+        self.path = find_static_file(attachment)
+        if self.path:
+            self.is_static = True
+        elif os.path.exists(attachment):
+            self.path = attachment
+        elif default_storage.exists(attachment):
+            self.path = attachment
+            self.in_storage = True
+        else:
+            raise FileNotFoundError(f'Attachment {attachment} not found.')
+
+        self.mimetype = mimetypes.guess_type(self.path)[0] or 'application/octet-stream'
+
+    def open(self):
+        return default_storage.open(self.path, 'rb') if self.in_storage else open(self.path, 'rb')
+
+    def iter_base64(self, line_ending: bytes = b'\n') -> Iterator[bytes]:
+        """ Yields the content as base64, in lines of 76 characters. """
+
+        with self.open() as file:
+            while chunk := _read_exact(file, ATTACHMENT_CHUNK_SIZE):
+                encoded = base64.encodebytes(chunk)
+                yield encoded if line_ending == b'\n' else encoded.replace(b'\n', line_ending)
+
+    def get_base64(self) -> str:
+        """ Returns the content as base64 (without line breaks).
+            The encoded content of static files is cached, as the same static files (e.g. terms and conditions) are attached to many emails.
+        """
+
+        global _encoded_attachments_size
+
+        if not self.is_static:
+            return self._encode()
+
+        stat = os.stat(self.path)
+        key = (self.path, stat.st_mtime, stat.st_size)
+        with _encoded_attachments_lock:
+            if key in _encoded_attachments:
+                _encoded_attachments.move_to_end(key)
+                return _encoded_attachments[key]
+
+        encoded = self._encode()
+        if len(encoded) > ENCODED_ATTACHMENT_CACHE_MAX_BYTES:
+            return encoded
+
+        with _encoded_attachments_lock:
+            _encoded_attachments[key] = encoded
+            _encoded_attachments_size += len(encoded)
+            while _encoded_attachments_size > ENCODED_ATTACHMENT_CACHE_MAX_BYTES:
+                _, removed = _encoded_attachments.popitem(last=False)
+                _encoded_attachments_size -= len(removed)
+
+        return encoded
+
+    def _encode(self) -> str:
+        with self.open() as file:
+            # Every chunk is a multiple of 3 bytes, so the encoded chunks can be joined without padding in between
+            return ''.join(base64.b64encode(chunk).decode('ascii') for chunk in iter(lambda: _read_exact(file, ATTACHMENT_CHUNK_SIZE), b''))
+
+    def remove(self) -> None:
+        if self.in_storage:
+            default_storage.delete(self.path)
+        else:
+            os.remove(self.path)
+
+def get_message_chunks(message: MIMEMultipart, attachments: list[EmailAttachment]) -> Callable[[], Iterator[bytes]]:
+    """ Adds the attachments to the message, and returns a function that yields the message in chunks,
+        ready to be sent as SMTP DATA (CRLF line endings and dot-stuffed).
+
+        The message is generated once with a placeholder for the content of each attachment. The content of the attachments
+        is streamed in base64 encoded chunks at the place of the placeholders, every time the message is sent.
+
+        :param message: The message, without the attachments.
+        :type message: MIMEMultipart
+        :param attachments: The attachments to add.
+        :type attachments: list[EmailAttachment]
+        :return: A function that returns an iterator with the chunks of the message.
+        :rtype: Callable[[], Iterator[bytes]]
+    """
+
+    placeholders = []
+    for index, attachment in enumerate(attachments):
+        placeholder = f'SWD-ATTACHMENT-{index}-PLACEHOLDER'
+        part = MIMEBase(*attachment.mimetype.split('/', 1))
+        part.set_payload(placeholder)
+        part.add_header('Content-Transfer-Encoding', 'base64')
+        part.add_header('Content-Disposition', 'attachment; filename="{}"'.format(attachment.file_name))
+        message.attach(part)
+        placeholders.append(placeholder + '\r\n')
+
+    content = smtplib.quotedata(message.as_string(policy=policy.SMTP))
+
+    def iter_chunks():
+        remaining = content
+        for placeholder, attachment in zip(placeholders, attachments):
+            before, remaining = remaining.split(placeholder, 1)
+            yield before.encode('utf-8')
+            yield from attachment.iter_base64(line_ending=b'\r\n')
+        yield remaining.encode('utf-8')
+
+    return iter_chunks
+
+def remove_attachments(attachments: list | None) -> None:
+    """ Removes the attachment files (from the local file system or the default storage). Missing files are skipped. """
+
+    for attachment in attachments or []:
+        try:
+            EmailAttachment(attachment).remove()
+        except FileNotFoundError:
+            pass
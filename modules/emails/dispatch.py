@@ -0,0 +1,227 @@
+import time
+import random
+
+from huey.contrib.djhuey import HUEY
+from huey.exceptions import RetryTask
+
+from CONFIG.emails import EMAIL_RATE_LIMITS, EMAIL_BULK_RESERVED_CAPACITY, EMAIL_RETRY_BACKOFF_BASE, EMAIL_RETRY_BACKOFF_MAX
+
+LANE_TRANSACTIONAL = 'transactional'
+LANE_BULK = 'bulk'
+RATE_LIMIT_MAX_SLEEP = 1 # Waits for the rate limiter up to this amount of seconds are slept in the worker, longer waits reschedule the task
+METRICS_RETENTION_MINUTES = 120
+
+# Token bucket, refilled with `rate` tokens per second up to `capacity`. Takes a token if at least `required` tokens are available,
+# and returns the seconds to wait otherwise. Runs in Redis, so the bucket is shared by all workers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local required = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= required then
+    tokens = tokens - 1
+else
+    wait = (required - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+class EmailRateLimitedError(Exception):
+    """ Raised when the email provider refuses an email because of its rate limit. """
+
+    def __init__(self, retry_after: float | None = None):
+        self.retry_after = retry_after
+        super().__init__(f'Rate limited by the email provider (retry after {retry_after} seconds)')
+
+class EmailSendError(Exception):
+    """ Raised in a task queue task when an email couldn't be sent, so the task is retried. """
+
+def get_retry_after(headers) -> float | None:
+    """ Returns the seconds to wait from the Retry-After or X-RateLimit-Reset (SendGrid) response header. """
+
+    if not headers:
+        return None
+
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return None
+
+    reset = headers.get('X-RateLimit-Reset')
+    if reset:
+        try:
+            return max(0, float(reset) - time.time())
+        except ValueError:
+            return None
+
+    return None
+
+def _get_redis():
+    """ Returns the Redis connection of the task queue, or None if the task queue doesn't use Redis (e.g. in immediate mode). """
+    return getattr(HUEY.storage, 'conn', None)
+
+_token_bucket_script = None
+
+def acquire_send_slot(provider: str, lane: str = LANE_TRANSACTIONAL) -> float:
+    """ Takes a token from the rate limiter of the provider.
+        Returns 0 if the email can be sent, or the seconds to wait otherwise.
+        Bulk emails leave EMAIL_BULK_RESERVED_CAPACITY of the bucket to transactional emails, so a campaign can't delay password resets.
+
+        :param provider: The email provider ('smtp' or 'sendgrid').
+        :type provider: str
+        :param lane: LANE_TRANSACTIONAL or LANE_BULK.
+        :type lane: str
+        :return: The seconds to wait before the email can be sent.
+        :rtype: float
+    """
+
+    global _token_bucket_script
+
+    rate = EMAIL_RATE_LIMITS.get(provider)
+    redis = _get_redis()
+    if not rate or redis is None:
+        return 0
+
+    # Allow bursts of one second of sending, plus the reserved capacity. Bulk emails are only sent if the reserved capacity stays available.
+    reserved = max(1, rate) * EMAIL_BULK_RESERVED_CAPACITY
+    capacity = max(1, rate) + reserved
+    required = 1 + reserved if lane == LANE_BULK else 1
+
+    if _token_bucket_script is None:
+        _token_bucket_script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    while True:
+        wait = float(_token_bucket_script(keys=[f'email_rate_limit:{provider}'], args=[rate, capacity, time.time(), required]))
+        if wait == 0 or wait > RATE_LIMIT_MAX_SLEEP:
+            return wait
+        time.sleep(wait)
+
+def get_retry_delay(attempt: int, retry_after: float | None = None) -> float:
+    """ Returns the delay before the next attempt: exponential backoff with jitter, but never shorter than the Retry-After of the provider.
+
+        :param attempt: The number of the failed attempt (0 for the first attempt).
+        :type attempt: int
+        :param retry_after: The seconds the provider asked to wait, if any.
+        :type retry_after: float | None
+        :return: The delay in seconds.
+        :rtype: float
+    """
+
+    backoff = min(EMAIL_RETRY_BACKOFF_MAX, EMAIL_RETRY_BACKOFF_BASE * 2 ** attempt)
+    return max(retry_after or 0, random.uniform(backoff / 2, backoff))
+
+def record_sent_emails(provider: str, lane: str, sent: int, failed: int = 0) -> None:
+    """ Counts the sent and failed emails per minute, for get_email_metrics. """
+
+    redis = _get_redis()
+    if redis is None:
+        return
+
+    minute = int(time.time() // 60)
+    pipeline = redis.pipeline()
+    for status, count in (('sent', sent), ('failed', failed)):
+        if count:
+            key = f'email_metrics:{provider}:{lane}:{status}:{minute}'
+            pipeline.incrby(key, count)
+            pipeline.expire(key, METRICS_RETENTION_MINUTES * 60)
+    pipeline.execute()
+
+def get_email_metrics(minutes: int = 5) -> dict:
+    """ Returns the task queue depth and the amount of sent and failed emails (and the send rate) per provider and lane over the last minutes.
+
+        :param minutes: The amount of minutes to compute the send rate over (max. METRICS_RETENTION_MINUTES).
+        :type minutes: int
+        :return: The metrics.
+        :rtype: dict
+    """
+
+    metrics = {
+        'queue' : {
+            'pending' : HUEY.pending_count(), # All tasks waiting in the queue, not only emails
+            'scheduled' : HUEY.scheduled_count(), # Tasks waiting for a retry or the rate limiter
+        },
+        'providers' : {},
+    }
+
+    redis = _get_redis()
+    if redis is None:
+        return metrics
+
+    current_minute = int(time.time() // 60)
+    minutes = min(minutes, METRICS_RETENTION_MINUTES)
+
+    for provider in EMAIL_RATE_LIMITS:
+        metrics['providers'][provider] = {}
+        for lane in (LANE_TRANSACTIONAL, LANE_BULK):
+            counts = {}
+            for status in ('sent', 'failed'):
+                keys = [f'email_metrics:{provider}:{lane}:{status}:{minute}' for minute in range(current_minute - minutes + 1, current_minute + 1)]
+                counts[status] = sum(int(value) for value in redis.mget(keys) if value)
+
+            metrics['providers'][provider][lane] = {
+                **counts,
+                'per_minute' : round(counts['sent'] / minutes, 1),
+                'rate_limit_per_second' : EMAIL_RATE_LIMITS[provider],
+            }
+
+    return metrics
+
+def throttle(provider: str, lane: str = LANE_BULK) -> None:
+    """ Waits until the rate limiter of the provider allows to send an email (used to send bulk emails one by one). """
+
+    while wait := acquire_send_slot(provider, lane):
+        time.sleep(wait)
+
+def dispatch_email(task, provider: str, lane: str, send_function, *args, rate_limit: bool = True):
+    """ Sends an email from a task queue task, within the rate limit of the provider.
+
+        - If the rate limiter has no capacity, the task is rescheduled for when it has (this doesn't count as a retry).
+        - If the email can't be sent, the task is retried with exponential backoff and jitter, honoring the Retry-After of the provider.
+          After the last retry, False is returned.
+        - Results per recipient (bulk emails) are returned as they are, as retrying would send the email twice to the other recipients.
+
+        :param task: The task (passed to tasks with context=True).
+        :param provider: The email provider ('smtp' or 'sendgrid').
+        :type provider: str
+        :param lane: LANE_TRANSACTIONAL or LANE_BULK.
+        :type lane: str
+        :param send_function: The function that sends the email.
+        :param rate_limit: Whether to take a token from the rate limiter. Set this to False if the send function throttles itself.
+        :type rate_limit: bool
+        :return: The result of the send function.
+    """
+
+    wait = acquire_send_slot(provider, lane) if rate_limit else 0
+    if wait:
+        raise RetryTask(delay=wait + random.uniform(0, 1)) # The jitter spreads the rescheduled tasks
+
+    retry_after = None
+    try:
+        result = send_function(*args)
+    except EmailRateLimitedError as e:
+        result, retry_after = False, e.retry_after
+
+    if isinstance(result, dict):
+        sent = sum(1 for value in result.values() if value)
+        record_sent_emails(provider, lane, sent, len(result) - sent)
+        return result
+
+    record_sent_emails(provider, lane, 1 if result else 0, 0 if result else 1)
+    if result or task is None or not task.retries:
+        return result
+
+    from modules.emails.tasks import DEFAULT_RETRY_COUNT
+    task.retry_delay = get_retry_delay(DEFAULT_RETRY_COUNT - task.retries, retry_after) # The task queue requeues the task with this delay
+    raise EmailSendError(f'The email could not be sent with {provider}, retrying in {task.retry_delay:.0f} seconds.')
@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.loader import get_template
+
+from modules.emails.rendering import get_compiled_email_template
+
+class Command(BaseCommand):
+    help = 'Compares rendering the base email template with Django templates and with the compiled email template (render only, nothing is sent)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--emails', type=int, default=10000, help='Amount of emails to render')
+
+    def handle(self, *args, **options):
+        template_data = {
+            'heading' : 'Reset your password',
+            'subheading' : 'Forgot your password?',
+            'content' : 'Click the button below to reset your password.',
+            'buttons' : [{'text' : 'Reset password', 'url' : 'https://example.com/reset/MQ/abc-123/'}],
+        }
+
+        compiled_template = get_compiled_email_template()
+        if compiled_template.parts is None:
+            self.stdout.write(self.style.WARNING('The base template could not be compiled, so it is rendered with Django templates.'))
+
+        def render_with_django():
+            get_template('emails/base.html').render({**template_data, 'PLATFORM_NAME' : settings.PLATFORM_NAME})
+
+        def render_compiled():
+            get_compiled_email_template().render(template_data)
+
+        results = {}
+        for name, render in [('Django templates', render_with_django), ('Compiled template', render_compiled)]:
+            start = time.perf_counter()
+            for _ in range(options['emails']):
+                render()
+            results[name] = (time.perf_counter() - start) / options['emails'] * 1000000
+            self.stdout.write(f'{name}: {results[name]:.1f} µs per email')
+
+        self.stdout.write(self.style.SUCCESS(f'The compiled template is {results["Django templates"] / results["Compiled template"]:.1f}x faster'))
@@ -0,0 +1,67 @@
+import smtplib
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+
+from django.core.management.base import BaseCommand, CommandError
+
+from modules.emails.smtp import SMTPConnectionPool
+
+class Command(BaseCommand):
+    help = 'Compares sending emails with a new SMTP connection per email and with the SMTP connection pool, against a local aiosmtpd server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000, help='Amount of emails to send per run')
+        parser.add_argument('--threads', type=int, default=4, help='Amount of sending threads (like task queue worker threads)')
+        parser.add_argument('--max-messages-per-connection', type=int, default=100)
+
+    def handle(self, *args, **options):
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            raise CommandError('The benchmark needs a local SMTP server: pip install aiosmtpd')
+
+        class Handler:
+            received = 0
+
+            async def handle_DATA(self, server, session, envelope):
+                Handler.received += 1
+                return '250 OK'
+
+        with socket.socket() as sock: # Find a free port
+            sock.bind(('127.0.0.1', 0))
+            host, port = sock.getsockname()
+
+        controller = Controller(Handler(), hostname=host, port=port)
+        controller.start()
+
+        message = MIMEText('<p>Benchmark</p>' * 50, 'html')
+        message['Subject'] = 'Benchmark'
+        message = message.as_string()
+        recipients = [f'user{index}@example.com' for index in range(options['messages'])]
+
+        def send_unpooled(recipient):
+            server = smtplib.SMTP(host, port)
+            server.sendmail('benchmark@example.com', [recipient], message)
+            server.quit()
+
+        pool = SMTPConnectionPool(host, port, max_size=options['threads'], max_messages_per_connection=options['max_messages_per_connection'])
+
+        def send_pooled(recipient):
+            pool.send('benchmark@example.com', [recipient], message)
+
+        try:
+            for name, send in [('New connection per email', send_unpooled), ('Connection pool', send_pooled)]:
+                Handler.received = 0
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                    list(executor.map(send, recipients))
+                duration = time.perf_counter() - start
+
+                self.stdout.write(f'{name}: {options["messages"]} emails in {duration:.2f}s ({options["messages"] / duration:.0f} emails/s, {Handler.received} received)')
+
+            self.stdout.write(f'Connections opened by the pool: {pool.connections_opened}')
+        finally:
+            pool.close()
+            controller.stop()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from modules.emails.dispatch import get_email_metrics
+
+class Command(BaseCommand):
+    help = 'Shows the task queue depth and the email send rate per provider and lane'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=5, help='Amount of minutes to compute the send rate over')
+
+    def handle(self, *args, **options):
+        metrics = get_email_metrics(options['minutes'])
+
+        self.stdout.write(f'Task queue: {metrics["queue"]["pending"]} pending, {metrics["queue"]["scheduled"]} scheduled (retries and rate limited)')
+
+        if not metrics['providers']:
+            self.stdout.write(self.style.WARNING('Send rates are only available when the task queue uses Redis.'))
+
+        for provider, lanes in metrics['providers'].items():
+            for lane, lane_metrics in lanes.items():
+                self.stdout.write(
+                    f'{provider} ({lane}): {lane_metrics["sent"]} sent, {lane_metrics["failed"]} failed in the last {options["minutes"]} minutes '
+                    f'({lane_metrics["per_minute"]}/min, limit {lane_metrics["rate_limit_per_second"]}/s)'
+                )
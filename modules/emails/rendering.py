@@ -0,0 +1,173 @@
+import re
+import html
+import threading
+
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils import translation
+
+# The variable fields of the base email template: None for text fields, or the keys of the items for list fields
+BASE_TEMPLATE_FIELDS = {
+    'heading' : None,
+    'subheading' : None,
+    'content' : None,
+    'buttons' : ['text', 'url'],
+}
+
+# Markers are made of private use characters, so they can't appear in the template itself
+_MARKER_START = '\ue000'
+_MARKER_END = '\ue001'
+_MARKER_PATTERN = re.compile(f'{_MARKER_START}([^<&{_MARKER_END}]+)(<|&lt;){_MARKER_END}|{_MARKER_START}([^<&{_MARKER_END}]+)\\[\\]{_MARKER_END}')
+
+def _marker(name: str) -> str:
+    """ Returns the marker of a field. The '<' shows whether the template escapes the field (it's rendered as '&lt;' then). """
+    return f'{_MARKER_START}{name}<{_MARKER_END}'
+
+def _list_marker(name: str) -> str:
+    return f'{_MARKER_START}{name}[]{_MARKER_END}'
+
+def _parse(output: str, bodies: dict) -> list:
+    """ Splits a rendered template with markers into static text, fields and lists. """
+
+    parts = []
+    position = 0
+    for match in _MARKER_PATTERN.finditer(output):
+        if match.start() > position:
+            parts.append(('text', output[position:match.start()]))
+
+        if match.group(1):
+            parts.append(('field', match.group(1), match.group(2) == '&lt;'))
+        else:
+            name = match.group(3)
+            parts.append(('list', name, _parse(bodies[name], {})))
+
+        position = match.end()
+
+    if position < len(output):
+        parts.append(('text', output[position:]))
+
+    return parts
+
+class CompiledEmailTemplate:
+    """ An email template of which everything except the variable fields is rendered in advance.
+
+        The template is rendered once (in the current language) with a marker for each field, and split into the static parts
+        (head with the inline CSS, header, footer, platform name, translations) and the fields. Rendering an email then only joins
+        the static parts with the (escaped) values, instead of rendering the whole template.
+        List fields (e.g. buttons) must be rendered by a plain {% for %} loop, as the loop body is repeated for each item.
+
+        The compiled template is checked against a normal render when it's built. If the template can't be compiled
+        (e.g. a field is passed through a filter), it's rendered normally.
+    """
+
+    def __init__(self, template_path: str, fields: dict, static_data: dict = None):
+        self.template = get_template(template_path)
+        self.fields = fields
+        self.static_data = static_data or {}
+
+        try:
+            self.parts = self.compile()
+        except KeyError:
+            self.parts = None
+
+        if self.parts is not None and not self.is_valid():
+            self.parts = None
+
+    def compile(self) -> list:
+        text_fields = {name : _marker(name) for name, keys in self.fields.items() if keys is None}
+        output = self.template.render({**self.static_data, **text_fields, **{name : [] for name, keys in self.fields.items() if keys is not None}})
+
+        # Render each list with one item, and take the difference with the render without items as the loop body
+        insertions = []
+        bodies = {}
+        for name, keys in self.fields.items():
+            if keys is None:
+                continue
+
+            item = {key : _marker(f'{name}.{key}') for key in keys}
+            with_item = self.template.render({**self.static_data, **text_fields, **{other : ([item] if other == name else []) for other, other_keys in self.fields.items() if other_keys is not None}})
+
+            prefix = 0
+            while prefix < len(output) and output[prefix] == with_item[prefix]:
+                prefix += 1
+            body_length = len(with_item) - len(output)
+
+            bodies[name] = with_item[prefix:prefix + body_length]
+            insertions.append((prefix, name))
+
+        for position, name in sorted(insertions, reverse=True):
+            output = output[:position] + _list_marker(name) + output[position:]
+
+        return _parse(output, bodies)
+
+    def is_valid(self) -> bool:
+        """ Returns whether the compiled template renders the same as the template, for sample data with characters that need escaping. """
+
+        sample = {}
+        for name, keys in self.fields.items():
+            if keys is None:
+                sample[name] = f'<{name} & "{name}">'
+            else:
+                sample[name] = [{key : f'<{name} {index} {key} & \'{key}\'>' for key in keys} for index in range(2)]
+
+        return self.render(sample) == self.template.render({**self.static_data, **sample})
+
+    def _render_parts(self, parts: list, data: dict) -> str:
+        output = []
+        for part in parts:
+            kind = part[0]
+            if kind == 'text':
+                output.append(part[1])
+            elif kind == 'field':
+                value = data.get(part[1].rpartition('.')[2], '')
+                if not part[2]:
+                    output.append(str(value))
+                elif hasattr(value, '__html__'): # Safe strings aren't escaped, like in templates
+                    output.append(value.__html__())
+                else:
+                    output.append(html.escape(str(value)))
+            else:
+                for item in data.get(part[1]) or []:
+                    output.append(self._render_parts(part[2], item))
+        return ''.join(output)
+
+    def render(self, data: dict) -> str:
+        """ Renders the template with the values of the fields. """
+
+        if self.parts is None:
+            return self.template.render({**self.static_data, **data})
+        return self._render_parts(self.parts, data)
+
+_compiled_templates = {}
+_compiled_templates_lock = threading.Lock()
+
+def get_compiled_email_template(template_path: str = 'emails/base.html', fields: dict = BASE_TEMPLATE_FIELDS, static_data: dict = None) -> CompiledEmailTemplate:
+    """ Returns the compiled email template for the current language. Templates are compiled once per language and process.
+        In DEBUG mode, the template is compiled every time, so changes to the template are shown immediately.
+
+        :param template_path: Path to the HTML template (starting from the templates folder).
+        :type template_path: str
+        :param fields: The variable fields of the template (see BASE_TEMPLATE_FIELDS).
+        :type fields: dict
+        :param static_data: The data that is the same for every email. Defaults to the platform config.
+        :type static_data: dict
+        :return: The compiled template.
+        :rtype: CompiledEmailTemplate
+    """
+
+    key = (template_path, translation.get_language(), tuple((name, keys and tuple(keys)) for name, keys in fields.items()), static_data and tuple(sorted(static_data.items())))
+    compiled_template = _compiled_templates.get(key)
+    if compiled_template is not None and not settings.DEBUG:
+        return compiled_template
+
+    if static_data is None:
+        static_data = {'PLATFORM_NAME' : settings.PLATFORM_NAME}
+
+    with _compiled_templates_lock:
+        compiled_template = _compiled_templates[key] = CompiledEmailTemplate(template_path, fields, static_data)
+    return compiled_template
+
+def render_base_email_template(template_data: dict) -> str:
+    """ Renders the base email template (emails/base.html) with the heading, subheading, content and buttons in template_data. """
+
+    return get_compiled_email_template().render(template_data)
@@ -0,0 +1,239 @@
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+from django.conf import settings
+
+class PooledSMTPConnection:
+    """ An SMTP connection that keeps track of how many messages it sent and when it was last used. """
+
+    def __init__(self, host: str, port: int, username: str | None = None, password: str | None = None, use_tls: bool = False, timeout: int | None = None):
+        self.server = smtplib.SMTP(host, port, timeout=timeout)
+
+        if use_tls:
+            self.server.starttls()
+
+        if username:
+            self.server.login(username, password)
+
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+        self.in_data = False # Whether the message is being sent, in which case the server reads every command as part of the message
+
+    def is_alive(self) -> bool:
+        """ Returns whether the server still accepts commands on this connection. """
+        try:
+            return self.server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def send(self, from_email: str, to_emails: list, message: str) -> None:
+        self.server.sendmail(from_email, to_emails, message)
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+
+    def send_stream(self, from_email: str, to_emails: list, chunks: Iterable[bytes]) -> None:
+        """ Sends a message that is streamed in chunks, instead of building the whole message in memory.
+            The chunks must already be in the SMTP DATA format (CRLF line endings, lines starting with a dot doubled).
+        """
+
+        server = self.server
+        server.ehlo_or_helo_if_needed()
+
+        code, response = server.mail(from_email)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_email)
+
+        refused = {}
+        for to_email in to_emails:
+            code, response = server.rcpt(to_email)
+            if code not in (250, 251):
+                refused[to_email] = (code, response)
+        if len(refused) == len(to_emails):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        server.putcmd('data')
+        code, response = server.getreply()
+        if code != 354:
+            server.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+        self.in_data = True
+        last_chunk = b''
+        for chunk in chunks:
+            if chunk:
+                server.send(chunk)
+                last_chunk = chunk
+        server.send(b'.\r\n' if last_chunk.endswith(b'\r\n') else b'\r\n.\r\n')
+
+        code, response = server.getreply()
+        self.in_data = False
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+
+    def reset(self) -> bool:
+        """ Resets the mail transaction after a failed send. Returns whether the connection can still be used. """
+        if self.in_data:
+            return False
+        try:
+            return self.server.rset()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self) -> None:
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+def is_broken_connection_error(error: BaseException) -> bool:
+    """ Returns whether the error means the connection is broken. SMTP errors (e.g. a refused recipient) are OSErrors too, but leave the connection usable. """
+    return isinstance(error, smtplib.SMTPServerDisconnected) or (isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException))
+
+class SMTPConnectionPool:
+    """ Pool of open SMTP connections, so the connection, STARTTLS and login aren't repeated for every message.
+
+        The pool is per process: every thread (e.g. a Huey worker thread) takes a connection from the pool, and gives it back after sending.
+        Connections that were idle for longer than keepalive_seconds are checked with NOOP before they are used, and connections
+        that sent max_messages_per_connection messages are closed, as most servers limit the amount of messages per connection.
+    """
+
+    def __init__(self, host: str, port: int, username: str | None = None, password: str | None = None, use_tls: bool = False, max_size: int = 4, max_messages_per_connection: int = 100, keepalive_seconds: int = 30, timeout: int | None = 30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.max_size = max_size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.keepalive_seconds = keepalive_seconds
+        self.timeout = timeout
+
+        self._idle = [] # The last used connection is reused first, as it's the least likely to be closed by the server
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    def open(self) -> PooledSMTPConnection:
+        connection = PooledSMTPConnection(self.host, self.port, self.username, self.password, self.use_tls, self.timeout)
+        self.connections_opened += 1
+        return connection
+
+    def acquire(self) -> PooledSMTPConnection:
+        """ Returns an idle connection that is still alive, or a new connection. """
+
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+
+            if connection is None:
+                return self.open()
+
+            if time.monotonic() - connection.last_used < self.keepalive_seconds or connection.is_alive():
+                return connection
+
+            connection.close()
+
+    def release(self, connection: PooledSMTPConnection) -> None:
+        """ Gives the connection back to the pool, or closes it if it sent too many messages or the pool is full. """
+
+        if connection.messages_sent < self.max_messages_per_connection:
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append(connection)
+                    return
+
+        connection.close()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except BaseException as e:
+            # A broken connection isn't given back to the pool. After other errors (e.g. a refused recipient), the mail transaction is reset.
+            broken = is_broken_connection_error(e) or not connection.reset()
+            raise
+        finally:
+            if broken:
+                connection.server.close()
+            else:
+                self.release(connection)
+
+    def send(self, from_email: str, to_emails: list, message: str) -> None:
+        """ Sends a message over a pooled connection.
+            If the server closed the connection in the meantime, the message is sent again over a new connection.
+
+            :param from_email: The email address of the sender.
+            :type from_email: str
+            :param to_emails: The email addresses of all recipients (including cc and bcc).
+            :type to_emails: list
+            :param message: The message (as string).
+            :type message: str
+        """
+
+        try:
+            with self.connection() as connection:
+                connection.send(from_email, to_emails, message)
+        except smtplib.SMTPServerDisconnected:
+            with self.connection() as connection:
+                connection.send(from_email, to_emails, message)
+
+    def send_stream(self, from_email: str, to_emails: list, get_chunks: Callable[[], Iterable[bytes]]) -> None:
+        """ Sends a message that is streamed in chunks over a pooled connection (see PooledSMTPConnection.send_stream).
+            If the server closed the connection in the meantime, the message is streamed again over a new connection.
+
+            :param from_email: The email address of the sender.
+            :type from_email: str
+            :param to_emails: The email addresses of all recipients (including cc and bcc).
+            :type to_emails: list
+            :param get_chunks: A function that returns the chunks of the message (called again when the message is sent again).
+            :type get_chunks: Callable[[], Iterable[bytes]]
+        """
+
+        try:
+            with self.connection() as connection:
+                connection.send_stream(from_email, to_emails, get_chunks())
+        except smtplib.SMTPServerDisconnected:
+            with self.connection() as connection:
+                connection.send_stream(from_email, to_emails, get_chunks())
+
+    def close(self) -> None:
+        """ Closes all idle connections. """
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            connection.close()
+
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+
+def get_smtp_pool() -> SMTPConnectionPool:
+    """ Returns the SMTP connection pool of this process, configured with the email settings. """
+
+    global _smtp_pool
+    with _smtp_pool_lock:
+        if _smtp_pool is None:
+            _smtp_pool = SMTPConnectionPool(
+                host=settings.EMAIL_HOST,
+                port=settings.EMAIL_PORT,
+                username=settings.EMAIL_HOST_USER,
+                password=settings.EMAIL_HOST_PASSWORD,
+                use_tls=settings.EMAIL_USE_TLS,
+                max_size=settings.EMAIL_SMTP_POOL_SIZE,
+                max_messages_per_connection=settings.EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION,
+                keepalive_seconds=settings.EMAIL_SMTP_KEEPALIVE_SECONDS,
+            )
+        return _smtp_pool
@@ -1,19 +1,51 @@
 from typing import Union
-from modules.emails.utils import send_email_with_smtp, send_email_with_sendgrid
+from modules.emails.utils import send_email_with_smtp, send_email_with_sendgrid, send_bulk_email_with_smtp, send_bulk_email_with_sendgrid
+from modules.emails.smtp import get_smtp_pool
+from modules.emails.attachments import remove_attachments
+from modules.emails.dispatch import dispatch_email, throttle, LANE_TRANSACTIONAL, LANE_BULK
 
-from huey.contrib.djhuey import task
+from huey.contrib.djhuey import task, on_shutdown
 
-DEFAULT_RETRY_COUNT = 3 # How many times to retry the task before giving up
-DEFAULT_RETRY_DELAY = 60 # How many seconds to wait between retries
+from CONFIG.emails import EMAIL_PRIORITY_TRANSACTIONAL, EMAIL_PRIORITY_BULK
 
-@task(retries=DEFAULT_RETRY_COUNT, retry_delay=DEFAULT_RETRY_DELAY)
-def async_send_email_with_smtp(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
-    """ (Task queue) Send an email using the SMTP protocol. """
+DEFAULT_RETRY_COUNT = 3 # How many times to retry the task before giving up (the delay between retries is set by dispatch_email, with exponential backoff)
+
+@task(retries=DEFAULT_RETRY_COUNT, priority=EMAIL_PRIORITY_TRANSACTIONAL, context=True)
+def async_send_email_with_smtp(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False, task=None) -> bool:
+    """ (Task queue) Send an email using the SMTP protocol. The SMTP connection is reused by the next tasks of this worker process. """
     
-    return send_email_with_smtp(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+    # The attachments are removed after the last attempt, so they are still available when the task is retried
+    result = dispatch_email(task, 'smtp', LANE_TRANSACTIONAL, send_email_with_smtp, to_emails, subject, html_content, attachments, cc_emails, bcc_emails, False)
+    if remove_attachments_after_send:
+        remove_attachments(attachments)
+    return result
 
-@task(retries=DEFAULT_RETRY_COUNT, retry_delay=DEFAULT_RETRY_DELAY)
-def async_send_email_with_sendgrid(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
+@task(retries=DEFAULT_RETRY_COUNT, priority=EMAIL_PRIORITY_TRANSACTIONAL, context=True)
+def async_send_email_with_sendgrid(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False, task=None) -> bool:
     """ (Task queue) Send an email using the SendGrid API. """
     
-    return send_email_with_sendgrid(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
\ No newline at end of file
+    result = dispatch_email(task, 'sendgrid', LANE_TRANSACTIONAL, send_email_with_sendgrid, to_emails, subject, html_content, attachments, cc_emails, bcc_emails, False)
+    if remove_attachments_after_send:
+        remove_attachments(attachments)
+    return result
+
+@task(priority=EMAIL_PRIORITY_BULK, context=True)
+def async_send_bulk_email_with_smtp(recipients: list, subject: str, html_content: str, task=None) -> dict:
+    """ (Task queue) Send a bulk email to a chunk of recipients using the SMTP protocol.
+        Failures are returned per recipient instead of retrying the task, so recipients that already got the email don't get it twice.
+    """
+
+    # Every recipient gets a separate email, so the rate limiter is applied per recipient
+    return dispatch_email(task, 'smtp', LANE_BULK, send_bulk_email_with_smtp, recipients, subject, html_content, lambda: throttle('smtp', LANE_BULK), rate_limit=False)
+
+@task(retries=DEFAULT_RETRY_COUNT, priority=EMAIL_PRIORITY_BULK, context=True)
+def async_send_bulk_email_with_sendgrid(recipients: list, subject: str, html_content: str, task=None) -> dict:
+    """ (Task queue) Send a bulk email to a chunk of recipients using the SendGrid API. The chunk is retried if SendGrid rate limits the request. """
+
+    return dispatch_email(task, 'sendgrid', LANE_BULK, send_bulk_email_with_sendgrid, recipients, subject, html_content)
+
+@on_shutdown()
+def close_smtp_connections():
+    """ (Task queue) Close the pooled SMTP connections when the worker stops. """
+
+    get_smtp_pool().close()
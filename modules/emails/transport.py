@@ -0,0 +1,396 @@
+import time
+import atexit
+import logging
+import asyncio
+import threading
+import weakref
+from concurrent.futures import Future, wait
+from email import policy
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import COMMASPACE, formatdate
+from typing import Coroutine, Union
+
+import aiosmtplib
+import httpx
+from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, Bcc, Cc
+
+from django.conf import settings
+
+from modules.emails.attachments import EmailAttachment
+from modules.emails.dispatch import EmailRateLimitedError, get_retry_after
+
+SENDGRID_API_URL = 'https://api.sendgrid.com'
+BACKGROUND_EMAILS_SHUTDOWN_TIMEOUT = 10 # Seconds to wait at exit for the emails that are still being sent in the background
+
+logger = logging.getLogger(__name__)
+
+class AsyncPooledSMTPConnection:
+    """ An asyncio SMTP connection that keeps track of how many messages it sent and when it was last used. """
+
+    def __init__(self, host: str, port: int, username: str | None = None, password: str | None = None, use_tls: bool = False, timeout: int | None = None):
+        self.server = aiosmtplib.SMTP(hostname=host, port=port, timeout=timeout, start_tls=False)
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+    async def connect(self) -> None:
+        await self.server.connect()
+
+        if self.use_tls:
+            await self.server.starttls()
+
+        if self.username:
+            await self.server.login(self.username, self.password)
+
+    async def is_alive(self) -> bool:
+        """ Returns whether the server still accepts commands on this connection. """
+        if not self.server.is_connected:
+            return False
+        try:
+            return (await self.server.noop()).code == 250
+        except (aiosmtplib.SMTPException, OSError):
+            return False
+
+    async def send(self, from_email: str, to_emails: list, message: bytes) -> None:
+        await self.server.sendmail(from_email, to_emails, message)
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+
+    async def close(self) -> None:
+        try:
+            await self.server.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            self.server.close()
+
+class AsyncSMTPConnectionPool:
+    """ Pool of open asyncio SMTP connections, the asyncio counterpart of modules.emails.smtp.SMTPConnectionPool.
+
+        Connections belong to the event loop they were opened in, so there is one pool per event loop (see get_async_smtp_pool).
+        Coroutines of the same event loop never take a connection from the pool at the same time, so the pool doesn't need a lock.
+        At most max_size messages are sent at the same time, so concurrent emails reuse the pooled connections instead of opening new ones.
+    """
+
+    def __init__(self, host: str, port: int, username: str | None = None, password: str | None = None, use_tls: bool = False, max_size: int = 4, max_messages_per_connection: int = 100, keepalive_seconds: int = 30, timeout: int | None = 30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.max_size = max_size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.keepalive_seconds = keepalive_seconds
+        self.timeout = timeout
+
+        self._idle = [] # The last used connection is reused first, as it's the least likely to be closed by the server
+        self._slots = asyncio.Semaphore(max_size)
+        self.connections_opened = 0
+
+    async def open(self) -> AsyncPooledSMTPConnection:
+        connection = AsyncPooledSMTPConnection(self.host, self.port, self.username, self.password, self.use_tls, self.timeout)
+        await connection.connect()
+        self.connections_opened += 1
+        return connection
+
+    async def acquire(self) -> AsyncPooledSMTPConnection:
+        """ Returns an idle connection that is still alive, or a new connection. """
+
+        while self._idle:
+            connection = self._idle.pop()
+            if time.monotonic() - connection.last_used < self.keepalive_seconds or await connection.is_alive():
+                return connection
+            await connection.close()
+
+        return await self.open()
+
+    async def release(self, connection: AsyncPooledSMTPConnection) -> None:
+        """ Gives the connection back to the pool, or closes it if it sent too many messages or the pool is full. """
+
+        if connection.messages_sent < self.max_messages_per_connection and len(self._idle) < self.max_size:
+            self._idle.append(connection)
+        else:
+            await connection.close()
+
+    async def _send(self, from_email: str, to_emails: list, message: bytes) -> None:
+        async with self._slots:
+            connection = await self.acquire()
+            try:
+                await connection.send(from_email, to_emails, message)
+            except (aiosmtplib.SMTPServerDisconnected, OSError):
+                connection.server.close() # The connection is broken, so it isn't given back to the pool
+                raise
+            except BaseException:
+                await self.release(connection)
+                raise
+            await self.release(connection)
+
+    async def send(self, from_email: str, to_emails: list, message: bytes) -> None:
+        """ Sends a message over a pooled connection.
+            If the server closed the connection in the meantime, the message is sent again over a new connection.
+
+            :param from_email: The email address of the sender.
+            :type from_email: str
+            :param to_emails: The email addresses of all recipients (including cc and bcc).
+            :type to_emails: list
+            :param message: The message (as bytes).
+            :type message: bytes
+        """
+
+        try:
+            await self._send(from_email, to_emails, message)
+        except aiosmtplib.SMTPServerDisconnected:
+            await self._send(from_email, to_emails, message)
+
+    async def close(self) -> None:
+        """ Closes all idle connections. """
+
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await connection.close()
+
+# The pools and clients are bound to the event loop they were created in, and are removed with it
+_async_smtp_pools = weakref.WeakKeyDictionary()
+_async_http_clients = weakref.WeakKeyDictionary()
+
+def get_async_smtp_pool() -> AsyncSMTPConnectionPool:
+    """ Returns the SMTP connection pool of the running event loop, configured with the email settings. """
+
+    loop = asyncio.get_running_loop()
+    pool = _async_smtp_pools.get(loop)
+    if pool is None:
+        pool = _async_smtp_pools[loop] = AsyncSMTPConnectionPool(
+            host=settings.EMAIL_HOST,
+            port=settings.EMAIL_PORT,
+            username=settings.EMAIL_HOST_USER,
+            password=settings.EMAIL_HOST_PASSWORD,
+            use_tls=settings.EMAIL_USE_TLS,
+            max_size=settings.EMAIL_SMTP_POOL_SIZE,
+            max_messages_per_connection=settings.EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION,
+            keepalive_seconds=settings.EMAIL_SMTP_KEEPALIVE_SECONDS,
+        )
+    return pool
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """ Returns the HTTP client of the running event loop for the SendGrid API. The client keeps the connections to the API open. """
+
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        client = _async_http_clients[loop] = httpx.AsyncClient(
+            base_url=SENDGRID_API_URL,
+            headers={'Authorization' : f'Bearer {settings.SENDGRID_API_KEY}'},
+            limits=httpx.Limits(max_connections=settings.EMAIL_SMTP_POOL_SIZE * 4, keepalive_expiry=settings.EMAIL_SMTP_KEEPALIVE_SECONDS),
+            timeout=30,
+        )
+    return client
+
+async def close_async_email_connections() -> None:
+    """ Closes the SMTP connections and HTTP client of the running event loop. """
+
+    loop = asyncio.get_running_loop()
+    pool = _async_smtp_pools.pop(loop, None)
+    if pool is not None:
+        await pool.close()
+
+    client = _async_http_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+def _as_list(emails: Union[list, str, None]) -> list:
+    if emails is None:
+        return []
+    return [emails] if isinstance(emails, str) else list(emails)
+
+def _build_smtp_message(to_emails: list, subject: str, html_content: str, attachments: list, cc_emails: list, bcc_emails: list) -> bytes:
+    """ Builds the message (the same as send_email_with_smtp). Reads the attachments, so it's run in a thread. """
+
+    message = MIMEMultipart(policy=policy.SMTP)
+    message['From'] = settings.EMAIL_HOST_USER
+    message['Date'] = formatdate(localtime=True)
+    message['Subject'] = subject
+    message.attach(MIMEText(html_content, 'html'))
+
+    if cc_emails:
+        message['Cc'] = COMMASPACE.join(cc_emails)
+
+    if bcc_emails:
+        message['Bcc'] = COMMASPACE.join(bcc_emails)
+
+    message['To'] = COMMASPACE.join(to_emails + cc_emails)
+
+    for attachment in attachments:
+        part = MIMEBase(*attachment.mimetype.split('/', 1))
+        part.set_payload(b''.join(attachment.iter_base64()).decode('ascii'))
+        part.add_header('Content-Transfer-Encoding', 'base64')
+        part.add_header('Content-Disposition', 'attachment; filename="{}"'.format(attachment.file_name))
+        message.attach(part)
+
+    return message.as_bytes(policy=policy.SMTP)
+
+def _remove_attachments(attachments: list) -> None:
+    for attachment in attachments:
+        attachment.remove()
+
+async def send_email_with_smtp_async(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
+    """ Send email using SMTP, without blocking the event loop.
+        The attachments are read in a thread. Unlike send_email_with_smtp, they are loaded in memory, so send large attachments with the task queue.
+
+        :param to_emails: List of email addresses OR single email address to send email to.
+        :type to_emails: list or str
+        :param subject: Subject of the email.
+        :type subject: str
+        :param html_content: HTML content of the email.
+        :type html_content: str
+        :param attachments: List of file paths to attach to the email.
+        :type attachments: list
+        :param cc_emails: List of email addresses OR single email address to send email to.
+        :type cc_emails: list or str
+        :param bcc_emails: List of email addresses OR single email address to send email to.
+        :type bcc_emails: list or str
+        :param remove_attachments_after_send: Whether to remove the attachments after the email is sent.
+        :type remove_attachments_after_send: bool
+        :return: True if email is sent successfully, False otherwise.
+        :rtype: bool
+    """
+
+    to_emails, cc_emails, bcc_emails = _as_list(to_emails), _as_list(cc_emails), _as_list(bcc_emails)
+    email_attachments = []
+
+    try:
+        if attachments:
+            email_attachments = await asyncio.to_thread(lambda: [EmailAttachment(attachment) for attachment in attachments])
+            message = await asyncio.to_thread(_build_smtp_message, to_emails, subject, html_content, email_attachments, cc_emails, bcc_emails)
+        else:
+            message = _build_smtp_message(to_emails, subject, html_content, [], cc_emails, bcc_emails)
+
+        await get_async_smtp_pool().send(settings.EMAIL_HOST_USER, to_emails + cc_emails + bcc_emails, message)
+        return True
+    except Exception:
+        logger.exception('Sending an email over SMTP failed')
+        return False
+    finally:
+        if remove_attachments_after_send and email_attachments:
+            await asyncio.to_thread(_remove_attachments, email_attachments)
+
+async def send_email_with_sendgrid_async(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
+    """ Send email using the SendGrid API, without blocking the event loop. The HTTP connections to the API are reused.
+
+        :param to_emails: List of email addresses OR single email address to send email to.
+        :type to_emails: list or str
+        :param subject: Subject of the email.
+        :type subject: str
+        :param html_content: HTML content of the email.
+        :type html_content: str
+        :param attachments: List of file paths to attach to the email.
+        :type attachments: list
+        :param cc_emails: List of email addresses OR single email address to send email to.
+        :type cc_emails: list or str
+        :param bcc_emails: List of email addresses OR single email address to send email to.
+        :type bcc_emails: list or str
+        :param remove_attachments_after_send: Whether to remove the attachments after the email is sent.
+        :type remove_attachments_after_send: bool
+        :return: True if email is sent successfully, False otherwise.
+        :rtype: bool
+        :raises EmailRateLimitedError: If SendGrid rate limited the request (HTTP 429).
+    """
+
+    message = Mail(
+        from_email=settings.EMAIL_HOST_USER,
+        to_emails=to_emails,
+        subject=subject,
+        html_content=html_content
+    )
+
+    for cc_email in _as_list(cc_emails):
+        message.add_cc(Cc(cc_email))
+
+    for bcc_email in _as_list(bcc_emails):
+        message.add_bcc(Bcc(bcc_email))
+
+    email_attachments = []
+    if attachments:
+        email_attachments = await asyncio.to_thread(lambda: [EmailAttachment(attachment) for attachment in attachments])
+        for email_attachment in email_attachments:
+            message.add_attachment(Attachment(
+                FileContent(await asyncio.to_thread(email_attachment.get_base64)),
+                FileName(email_attachment.file_name),
+                FileType(email_attachment.mimetype),
+                Disposition('attachment')
+            ))
+
+    try:
+        response = await get_async_http_client().post('/v3/mail/send', json=message.get())
+    except httpx.HTTPError:
+        logger.exception('Sending an email with SendGrid failed')
+        return False
+    finally:
+        if remove_attachments_after_send and email_attachments:
+            await asyncio.to_thread(_remove_attachments, email_attachments)
+
+    if response.status_code == 429:
+        raise EmailRateLimitedError(get_retry_after(response.headers))
+
+    return response.status_code == 202
+
+# Emails sent in the background from synchronous code are sent by an event loop in a separate thread
+_background_loop = None
+_background_loop_lock = threading.Lock()
+_background_tasks = set()
+_background_futures = set()
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    global _background_loop
+
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='background-emails', daemon=True).start()
+            atexit.register(_wait_for_background_emails)
+        return _background_loop
+
+def _wait_for_background_emails() -> None:
+    """ Waits (at exit) for the emails that are still being sent in the background. """
+
+    wait(list(_background_futures), timeout=BACKGROUND_EMAILS_SHUTDOWN_TIMEOUT)
+
+def _log_background_exception(result: asyncio.Task | Future) -> None:
+    if not result.cancelled() and result.exception() is not None:
+        logger.error('Sending an email in the background failed', exc_info=result.exception())
+
+def in_event_loop() -> bool:
+    """ Returns whether the code runs in an event loop (in async code). """
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+def run_in_background(coroutine: Coroutine) -> asyncio.Task | Future:
+    """ Runs the coroutine without waiting for it (fire and forget).
+        In an event loop (async views, consumers), the coroutine runs as a task of that loop. In synchronous code, it runs
+        in the event loop of the background email thread, so the calling thread isn't blocked either.
+
+        :param coroutine: The coroutine to run (e.g. send_email_async(...)).
+        :type coroutine: Coroutine
+        :return: The task (in an event loop) or future (in synchronous code) of the coroutine.
+        :rtype: asyncio.Task | Future
+    """
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        future = asyncio.run_coroutine_threadsafe(coroutine, _get_background_loop())
+        _background_futures.add(future)
+        future.add_done_callback(_background_futures.discard)
+        future.add_done_callback(_log_background_exception)
+        return future
+
+    # The event loop only keeps weak references to tasks, so a reference is kept until the task is done
+    task = loop.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_background_exception)
+    return task
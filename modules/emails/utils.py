@@ -1,33 +1,41 @@
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, Bcc, Cc
+from python_http_client.exceptions import TooManyRequestsError
+from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, Bcc, Cc, To, Personalization, Substitution
 
-import smtplib
+import logging
+from email import policy
 from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
-from email import encoders
-from typing import Union
-import os
-import mimetypes
-import base64
+from typing import Callable, Union
 
 
 from django.urls import reverse
 from django.template.loader import get_template
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
+from django.utils.html import escape
 from django.http import HttpRequest
-from django.contrib.staticfiles import finders
 from django.conf import settings
-from django.core.exceptions import SuspiciousFileOperation
 from django.utils.translation import gettext as _
 
 from modules.authentication.tokens import account_activation_token
+from modules.emails.smtp import get_smtp_pool
+from modules.emails.rendering import render_base_email_template
+from modules.emails.attachments import EmailAttachment, get_message_chunks
+from modules.emails.dispatch import EmailRateLimitedError, get_retry_after
+from modules.emails.transport import send_email_with_smtp_async, send_email_with_sendgrid_async, run_in_background, in_event_loop
+from asgiref.sync import sync_to_async
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth import get_user_model
 
-def send_user_forgot_password_email(user: get_user_model, current_domain: str | None = None) -> bool:
+logger = logging.getLogger(__name__)
+
+MERGE_FIELD_FORMAT = '[[{}]]' # Merge fields are written as [[field]] in the subject and template data of bulk emails
+SENDGRID_MAX_PERSONALIZATIONS = 1000 # The maximum amount of personalizations (recipients) per SendGrid request
+BULK_EMAIL_SMTP_CHUNK_SIZE = 500 # The amount of recipients per task queue task when sending bulk emails with SMTP
+
+def send_user_forgot_password_email(user: get_user_model, current_domain: str | None = None, background: bool = False) -> bool:
     """ Send forgot password email to user.
 
         The forgot password email contains a link to the password reset page, which is used to reset the user's password.
@@ -38,7 +46,9 @@ def send_user_forgot_password_email(user: get_user_model, current_domain: str |
         :type user: User
         :param current_domain: Domain to use in the reset link. If not provided, the PLATFORM_URL setting will be used.
         :type current_domain: str
-        :return: True if email is sent successfully, False otherwise.
+        :param background: Whether to send the email in the background (see send_email_in_background), instead of waiting for it.
+        :type background: bool
+        :return: True if email is sent successfully (or is sent in the background), False otherwise.
         :rtype: bool
     """
     
@@ -63,9 +73,13 @@ def send_user_forgot_password_email(user: get_user_model, current_domain: str |
     }
 
     subject = _('Reset your password')
+    if background:
+        send_email_in_background(user.email, subject, render_base_email_template(data))
+        return True
+
     return send_email_from_base_template(user.email, subject, data)
 
-def send_user_activation_email(user: get_user_model, current_domain: str | None = None) -> bool:
+def send_user_activation_email(user: get_user_model, current_domain: str | None = None, background: bool = False) -> bool:
     """ Send activation email to user.
 
         The activation email contains a link to the activation page, which is used to activate the user's account.
@@ -76,7 +90,9 @@ def send_user_activation_email(user: get_user_model, current_domain: str | None
         :type user: User
         :param current_domain: Domain to use in the activation link. If not provided, the PLATFORM_URL setting will be used.
         :type current_domain: str
-        :return: True if email is sent successfully, False otherwise.
+        :param background: Whether to send the email in the background (see send_email_in_background), instead of waiting for it.
+        :type background: bool
+        :return: True if email is sent successfully (or is sent in the background), False otherwise.
         :rtype: bool
     """
     
@@ -101,6 +117,10 @@ def send_user_activation_email(user: get_user_model, current_domain: str | None
     }
 
     subject = _('Activate your account')
+    if background:
+        send_email_in_background(user.email, subject, render_base_email_template(data))
+        return True
+
     return send_email_from_base_template(user.email, subject, data)
 
 def send_email_from_base_template(to_emails: Union[list, str], subject: str, template_data, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
@@ -130,10 +150,8 @@ def send_email_from_base_template(to_emails: Union[list, str], subject: str, tem
     # content: str
     # buttons: list of dictionaries with keys text and url
 
-    # Add platform config to template data
-    template_data['PLATFORM_NAME'] = settings.PLATFORM_NAME
-
-    html_content = get_template('emails/base.html').render(template_data)
+    # The static parts of the base template (and PLATFORM_NAME) are rendered once per language, see modules.emails.rendering
+    html_content = render_base_email_template(template_data)
     return send_email(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
 
 def send_email_from_template(to_emails: Union[list, str], subject: str, template_path: str, template_data: dict, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
@@ -189,13 +207,222 @@ def send_email(to_emails: Union[list, str], subject: str, html_content: str, att
         if settings.EMAIL_USE_TASK_QUEUE:
             return async_send_email_with_sendgrid(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
         else:
-            return send_email_with_sendgrid(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+            try:
+                return send_email_with_sendgrid(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+            except EmailRateLimitedError:
+                return False
     else:
         if settings.EMAIL_USE_TASK_QUEUE:
             return async_send_email_with_smtp(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
         else:
             return send_email_with_smtp(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
 
+async def send_email_from_base_template_async(to_emails: Union[list, str], subject: str, template_data, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
+    """ Send email using a base template as the email content, from async code (see send_email_async). """
+
+    html_content = render_base_email_template(template_data)
+    return await send_email_async(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+
+async def send_email_async(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
+    """ Send email from async code (async views, websocket consumers), either with SMTP or SendGrid depending on the CONFIG setting.
+        If the task queue is used, the email is added to the task queue. Otherwise the email is sent with the asyncio transport
+        (see modules.emails.transport), so the event loop isn't blocked while waiting for the email provider.
+
+        Await it to wait for the result, or use send_email_in_background to send the email without waiting.
+
+        :param to_emails: List of email addresses OR single email address to send email to.
+        :type to_emails: list or str
+        :param subject: Subject of the email.
+        :type subject: str
+        :param html_content: HTML content of the email.
+        :type html_content: str
+        :param attachments: List of file paths to attach to the email.
+        :type attachments: list
+        :param cc_emails: List of email addresses OR single email address to send email to.
+        :type cc_emails: list or str
+        :param bcc_emails: List of email addresses OR single email address to send email to.
+        :type bcc_emails: list or str
+        :param remove_attachments_after_send: Whether to remove the attachments after the email is sent.
+        :type remove_attachments_after_send: bool
+        :return: True if email is sent successfully, False otherwise.
+        :rtype: bool
+    """
+
+    if settings.EMAIL_USE_TASK_QUEUE:
+        return await sync_to_async(send_email, thread_sensitive=False)(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+
+    if settings.EMAIL_PROVIDER == 'sendgrid':
+        try:
+            return await send_email_with_sendgrid_async(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+        except EmailRateLimitedError:
+            return False
+    else:
+        return await send_email_with_smtp_async(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send)
+
+def send_email_in_background(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> None:
+    """ Send email without waiting for it (fire and forget), from sync or async code.
+        In an event loop, the email is sent by a task of that loop. In sync code (e.g. views running in a thread under ASGI),
+        it's sent by the event loop of a background thread, so the request isn't held up by the email provider.
+        See send_email_async for the parameters.
+    """
+
+    if settings.EMAIL_USE_TASK_QUEUE and not in_event_loop():
+        send_email(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send) # Adding a task doesn't wait for the email provider
+        return
+
+    run_in_background(send_email_async(to_emails, subject, html_content, attachments, cc_emails, bcc_emails, remove_attachments_after_send))
+
+def apply_merge_fields(content: str, merge_fields: dict, html: bool = True) -> str:
+    """ Replace the [[field]] merge fields in the content with the values of the recipient.
+
+        :param content: The content (subject or HTML) with merge fields.
+        :type content: str
+        :param merge_fields: The values of the merge fields.
+        :type merge_fields: dict
+        :param html: Whether the content is HTML, in which case the values are escaped.
+        :type html: bool
+        :return: The content with the merge fields replaced.
+        :rtype: str
+    """
+
+    for field, value in merge_fields.items():
+        content = content.replace(MERGE_FIELD_FORMAT.format(field), escape(value) if html else str(value))
+    return content
+
+def send_bulk_email(recipients: list, subject: str, template_data: dict, template_path: str = 'emails/base.html') -> dict | list:
+    """ Send the same email to many recipients, each with their own merge fields.
+
+        The template is rendered once. Merge fields in the subject and template data are written as [[field]],
+        and are replaced with the values of each recipient when the email is sent to that recipient.
+        With SendGrid, up to 1000 recipients are sent per API request. With SMTP, the recipients are sent in chunks over pooled connections.
+
+        Example:
+            send_bulk_email(
+                [{'email' : 'john@example.com', 'first_name' : 'John'}, 'jane@example.com'],
+                'News for you, [[first_name]]',
+                {'heading' : 'Hello [[first_name]]', 'content' : '...'}
+            )
+
+        :param recipients: List of email addresses, or dictionaries with the 'email' key and the merge fields of the recipient.
+        :type recipients: list
+        :param subject: Subject of the email (may contain merge fields).
+        :type subject: str
+        :param template_data: Data to be passed to the template (may contain merge fields).
+        :type template_data: dict
+        :param template_path: Path to the HTML template (starting from the templates folder). Defaults to the base template.
+        :type template_path: str
+        :return: Whether the email was sent, per email address. If the task queue is used, the list of task results instead, which each return such a dictionary.
+        :rtype: dict or list
+    """
+
+    from modules.emails.tasks import async_send_bulk_email_with_smtp, async_send_bulk_email_with_sendgrid
+
+    recipients = [{'email' : recipient} if isinstance(recipient, str) else recipient for recipient in recipients]
+
+    if template_path == 'emails/base.html':
+        html_content = render_base_email_template(template_data)
+    else:
+        html_content = get_template(template_path).render(template_data)
+
+    if settings.EMAIL_PROVIDER == 'sendgrid':
+        chunk_size, send, async_send = SENDGRID_MAX_PERSONALIZATIONS, send_bulk_email_with_sendgrid, async_send_bulk_email_with_sendgrid
+    else:
+        chunk_size, send, async_send = BULK_EMAIL_SMTP_CHUNK_SIZE, send_bulk_email_with_smtp, async_send_bulk_email_with_smtp
+
+    chunks = [recipients[index:index + chunk_size] for index in range(0, len(recipients), chunk_size)]
+
+    if settings.EMAIL_USE_TASK_QUEUE:
+        return [async_send(chunk, subject, html_content) for chunk in chunks]
+
+    results = {}
+    for chunk in chunks:
+        try:
+            results.update(send(chunk, subject, html_content))
+        except EmailRateLimitedError:
+            results.update({recipient['email'] : False for recipient in chunk})
+    return results
+
+def send_bulk_email_with_smtp(recipients: list, subject: str, html_content: str, throttle: Callable[[], None] | None = None) -> dict:
+    """ Send an email to each recipient using SMTP, over pooled connections.
+
+        :param recipients: List of dictionaries with the 'email' key and the merge fields of the recipient.
+        :type recipients: list
+        :param subject: Subject of the email (may contain merge fields).
+        :type subject: str
+        :param html_content: HTML content of the email (may contain merge fields).
+        :type html_content: str
+        :param throttle: Function that is called before each email, to wait for the rate limiter.
+        :type throttle: Callable[[], None] | None
+        :return: Whether the email was sent, per email address.
+        :rtype: dict
+    """
+
+    FROM_EMAIL = settings.EMAIL_HOST_USER
+    pool = get_smtp_pool()
+    results = {}
+
+    for recipient in recipients:
+        message = MIMEMultipart(policy=policy.SMTP)
+        message['From'] = FROM_EMAIL
+        message['To'] = recipient['email']
+        message['Date'] = formatdate(localtime=True)
+        message['Subject'] = apply_merge_fields(subject, recipient, html=False)
+        message.attach(MIMEText(apply_merge_fields(html_content, recipient), 'html'))
+
+        if throttle:
+            throttle()
+
+        try:
+            pool.send(FROM_EMAIL, [recipient['email']], message.as_string())
+            results[recipient['email']] = True
+        except Exception:
+            results[recipient['email']] = False
+
+    return results
+
+def send_bulk_email_with_sendgrid(recipients: list, subject: str, html_content: str) -> dict:
+    """ Send an email to each recipient using the SendGrid API, with one personalization per recipient.
+
+        :param recipients: List of dictionaries with the 'email' key and the merge fields of the recipient (max. 1000).
+        :type recipients: list
+        :param subject: Subject of the email (may contain merge fields).
+        :type subject: str
+        :param html_content: HTML content of the email (may contain merge fields).
+        :type html_content: str
+        :return: Whether the email was sent, per email address.
+        :rtype: dict
+        :raises EmailRateLimitedError: If SendGrid rate limited the request (HTTP 429).
+    """
+
+    FROM_EMAIL = settings.EMAIL_HOST_USER
+    SENDGRID_API_KEY = settings.SENDGRID_API_KEY
+    client = SendGridAPIClient(SENDGRID_API_KEY)
+    results = {}
+
+    for index in range(0, len(recipients), SENDGRID_MAX_PERSONALIZATIONS):
+        chunk = recipients[index:index + SENDGRID_MAX_PERSONALIZATIONS]
+
+        message = Mail(from_email=FROM_EMAIL, subject=subject, html_content=html_content)
+        for recipient in chunk:
+            personalization = Personalization()
+            personalization.add_to(To(recipient['email']))
+            personalization.subject = apply_merge_fields(subject, recipient, html=False)
+            for field, value in recipient.items():
+                personalization.add_substitution(Substitution(MERGE_FIELD_FORMAT.format(field), escape(value)))
+            message.add_personalization(personalization)
+
+        try:
+            sent = client.send(message).status_code == 202
+        except TooManyRequestsError as e:
+            raise EmailRateLimitedError(get_retry_after(e.headers)) from e
+        except Exception:
+            logger.exception(f'Failed to send a bulk email with SendGrid to {len(chunk)} recipients')
+            sent = False
+
+        results.update({recipient['email'] : sent for recipient in chunk})
+
+    return results
+
 def send_email_with_smtp(to_emails: Union[list, str], subject: str, html_content: str, attachments: list = None, cc_emails: Union[list, str] = None, bcc_emails: Union[list, str] = None, remove_attachments_after_send: bool = False) -> bool:
     """ Send email using SMTP.
 
@@ -218,12 +445,6 @@ def send_email_with_smtp(to_emails: Union[list, str], subject: str, html_content
     """
     
     FROM_EMAIL = settings.EMAIL_HOST_USER
-    HOST = settings.EMAIL_HOST
-    PORT = settings.EMAIL_PORT
-    EMAIL_USER = settings.EMAIL_HOST_USER
-    EMAIL_PASSWORD = settings.EMAIL_HOST_PASSWORD
-    USE_TLS = settings.EMAIL_USE_TLS
-    attachment_paths = []
     
     to_emails = [to_emails] if isinstance(to_emails, str) else to_emails
     cc_emails = [cc_emails] if isinstance(cc_emails, str) else cc_emails
@@ -233,7 +454,7 @@ def send_email_with_smtp(to_emails: Union[list, str], subject: str, html_content
     bcc_emails = [] if bcc_emails is None else bcc_emails
     all_emails = to_emails + cc_emails + bcc_emails
     
-    message = MIMEMultipart()
+    message = MIMEMultipart(policy=policy.SMTP) # The SMTP policy encodes non-ASCII headers (e.g. translated subjects)
     message['From'] = FROM_EMAIL
     message['Date'] = formatdate(localtime=True)
     message['Subject'] = subject
@@ -249,55 +470,24 @@ def send_email_with_smtp(to_emails: Union[list, str], subject: str, html_content
     
     message['To'] = COMMASPACE.join(to_emails)
     
-    if attachments:
-        for attachment in attachments:
-            
-            # Search in static files first
-            # If not found, search in absolute path
-            # If not found, raise error
-            try:
-                attachment_path = finders.find(attachment)
-            except SuspiciousFileOperation: # File not found in static files
-                attachment_path = None
-            
-            if not attachment_path:
-                if not os.path.exists(attachment):
-                    raise FileNotFoundError(f'Attachment {attachment} not found.')
-                else:
-                    attachment_path = attachment
-
-            file_name = attachment.split('/')[-1]
-
-            part = MIMEBase('application', "octet-stream")
-            with open(attachment_path, 'rb') as f:
-                part.set_payload(f.read())
-            
-            # Add attachment path to list, so we can remove it after the email is sent if needed
-            attachment_paths.append(attachment_path)
-            
-            encoders.encode_base64(part)
-            part.add_header('Content-Disposition', 'attachment; filename="{}"'.format(file_name))
-            message.attach(part)
-    
+    # The attachments are streamed in base64 encoded chunks to the SMTP server, instead of being loaded in memory (see modules.emails.attachments)
+    email_attachments = [EmailAttachment(attachment) for attachment in attachments or []]
+    get_chunks = get_message_chunks(message, email_attachments)
+
     try:
-        smtp_server = smtplib.SMTP(HOST, PORT)
+        # The connection is reused for the next emails sent by this process (see modules.emails.smtp)
+        get_smtp_pool().send_stream(FROM_EMAIL, all_emails, get_chunks)
         
-        if USE_TLS:
-            smtp_server.starttls()
-        
-        smtp_server.login(EMAIL_USER, EMAIL_PASSWORD)
-        smtp_server.sendmail(FROM_EMAIL, all_emails, message.as_string())
-        smtp_server.close()
-        
-        if remove_attachments_after_send and attachments:
-            for attachment_path in attachment_paths:
-                os.remove(attachment_path)
+        if remove_attachments_after_send:
+            for email_attachment in email_attachments:
+                email_attachment.remove()
                 
         return True
-    except Exception as e:
-        if remove_attachments_after_send and attachments:
-            for attachment_path in attachment_paths:
-                os.remove(attachment_path)
+    except Exception:
+        logger.exception('Failed to send an email with SMTP')
+        if remove_attachments_after_send:
+            for email_attachment in email_attachments:
+                email_attachment.remove()
                 
         return False
 
@@ -319,11 +509,11 @@ def send_email_with_sendgrid(to_emails: Union[list, str], subject: str, html_con
         :param remove_attachments_after_send: Whether to remove the attachments after the email is sent.
         :return: True if email is sent successfully, False otherwise.
         :rtype: bool
+        :raises EmailRateLimitedError: If SendGrid rate limited the request (HTTP 429).
     """
     
     FROM_EMAIL = settings.EMAIL_HOST_USER
     SENDGRID_API_KEY = settings.SENDGRID_API_KEY
-    attachment_paths = []
     
     message = Mail(
         from_email=FROM_EMAIL,
@@ -346,59 +536,30 @@ def send_email_with_sendgrid(to_emails: Union[list, str], subject: str, html_con
         for bcc_email in bcc_emails:
             message.add_bcc(Bcc(bcc_email))
     
-    if attachments:
-        for attachment in attachments:
-
-            # Search in static files first
-            # If not found, search in absolute path
-            # If not found, raise error
-            try:
-                attachment_path = finders.find(attachment)
-            except SuspiciousFileOperation: # File not found in static files
-                attachment_path = None
-            
-            if not attachment_path:
-                if not os.path.exists(attachment):
-                    raise FileNotFoundError(f'Attachment {attachment} not found.')
-                else:
-                    attachment_path = attachment
-
-            
-            file_name = attachment.split('/')[-1]
-
-            with open(attachment_path, 'rb') as f:
-                data = f.read()
-                f.close()
-            
-            # Add attachment path to list, so we can remove it after the email is sent if needed
-            attachment_paths.append(attachment_path)
-            
-            mimetype = mimetypes.guess_type(attachment_path)[0]
-            if not mimetype:
-                mimetype = 'application/octet-stream'
-            
-            encoded_file = base64.b64encode(data).decode()
-            email_attachment = Attachment(
-                FileContent(encoded_file),
-                FileName(file_name),
-                FileType(mimetype),
-                Disposition('attachment')
-            )
-            message.add_attachment(email_attachment)
+    email_attachments = [EmailAttachment(attachment) for attachment in attachments or []]
+    for email_attachment in email_attachments:
+        # The content is encoded in chunks, and cached for static files (see modules.emails.attachments)
+        message.add_attachment(Attachment(
+            FileContent(email_attachment.get_base64()),
+            FileName(email_attachment.file_name),
+            FileType(email_attachment.mimetype),
+            Disposition('attachment')
+        ))
     
     try:
         client = SendGridAPIClient(SENDGRID_API_KEY)
         response = client.send(message)
         
-        if remove_attachments_after_send and attachments:
-            for attachment_path in attachment_paths:
-                os.remove(attachment_path)
+        if remove_attachments_after_send:
+            for email_attachment in email_attachments:
+                email_attachment.remove()
 
         if response.status_code == 202:
             return True
         else:
             return False
-    except Exception as e:
-        print(e)
-        
+    except TooManyRequestsError as e:
+        raise EmailRateLimitedError(get_retry_after(e.headers)) from e
+    except Exception:
+        logger.exception('Failed to send an email with SendGrid')
         return False
\ No newline at end of file
@@ -9,7 +9,7 @@ from django.http import JsonResponse
 
 from modules.emails.utils import send_email_from_base_template
 from modules.billing.mixins import CreditActionMixin
-from modules.views import ExcelModelExport, PDFExport, DynamicTableData
+from modules.views import ExcelModelExport, PDFExport, DynamicTableData, BackgroundExportMixin
 from modules.ai.openai import generate_image
 
 from .seeder import ExampleSeeder
@@ -57,8 +57,7 @@ class CreditsExample(LoginRequiredMixin, FormView):
         amount = form.cleaned_data['amount']
         action = form.cleaned_data['action']
 
-        if self.request.user.has_credits(amount):
-            self.request.user.consume_credits(amount, action)
+        if self.request.user.consume_credits(amount, action):
             messages.success(self.request, _('Credits consumed successfully'))
         else:
             messages.error(self.request, _('You do not have enough credits to perform this action'))
@@ -100,9 +99,16 @@ class CreditsActionExampleGET(CreditActionMixin, View):
 class ExcelExample(LoginRequiredMixin, TemplateView):
     template_name = 'examples/excel.html'
 
-class ExcelExportExample(ExcelModelExport):
+class ExcelExportExample(LoginRequiredMixin, BackgroundExportMixin, ExcelModelExport):
     model = get_user_model()
 
+    # A GET request downloads the file directly, a POST request starts a background export job (see BackgroundExportMixin)
+
+    # For large querysets, set stream to True to read the queryset in chunks and stream the file to the user
+    # In streaming mode, you can also set export_format to 'csv' or 'ndjson'
+    # stream = True
+    # export_format = 'csv'
+
     # You can pass fields as a list of strings or a list of dictionaries
     # If you pass a list of strings, the header will be the field name
     # If you pass a list of dictionaries, you can specify the header and the field name
@@ -154,6 +160,9 @@ class ExampleModelTableData(LoginRequiredMixin, DynamicTableData):
     sort_default = 'name'
     search_fields = ['name', 'address']
 
+    # For large tables, use an index-backed search backend ('trigram' or 'fulltext') and run the swd_build_search_indexes command
+    # search_backend = 'fulltext'
+
     def get_queryset(self):
         return ExampleModel.objects.all()
     
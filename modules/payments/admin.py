@@ -1,3 +1,22 @@
 from django.contrib import admin
+from django.utils.translation import gettext_lazy as _
 
-# Register your models here.
+from modules.payments.models import StripeWebhookEvent
+from unfold.admin import ModelAdmin
+
+@admin.register(StripeWebhookEvent)
+class StripeWebhookEventAdmin(ModelAdmin):
+    list_display = ('stripe_id', 'type', 'customer_id', 'status', 'attempts', 'created_at', 'processed_at')
+    list_filter = ('status', 'type')
+    search_fields = ('stripe_id', 'customer_id')
+    readonly_fields = ('stripe_id', 'type', 'customer_id', 'stripe_created', 'payload', 'attempts', 'error', 'created_at', 'processed_at')
+    actions = ['process_again']
+
+    @admin.action(description=_('Process the selected events again'))
+    def process_again(self, request, queryset):
+        from modules.payments.tasks import process_stripe_webhook_events
+
+        customer_ids = set(queryset.values_list('customer_id', flat=True))
+        queryset.update(status=StripeWebhookEvent.STATUS_PENDING, attempts=0, error='')
+        for customer_id in customer_ids:
+            process_stripe_webhook_events(customer_id)
@@ -0,0 +1,211 @@
+import json
+import time
+import threading
+
+import requests
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from huey.contrib.djhuey import HUEY
+
+from CONFIG.stripe import (
+    STRIPE_CACHE_TIMEOUT, STRIPE_LINE_ITEMS_CACHE_TIMEOUT, STRIPE_HTTP_POOL_SIZE, STRIPE_HTTP_TIMEOUT, STRIPE_MAX_NETWORK_RETRIES, STRIPE_API_BASE
+)
+
+METRICS_RETENTION_MINUTES = 120
+
+def configure_http_client(http_client: stripe.HTTPClient | None = None) -> stripe.HTTPClient:
+    """ Sets the HTTP client used for all Stripe API requests of the process.
+
+        By default, a requests session with a pool of STRIPE_HTTP_POOL_SIZE keep-alive connections is shared by all threads,
+        so the TLS connection to Stripe is set up once instead of for every request.
+        Pass a (fake) stripe.HTTPClient to test without the Stripe API, or set STRIPE_API_BASE to test against stripe-mock.
+
+        :param http_client: The HTTP client to use, None for the default client.
+        :type http_client: stripe.HTTPClient | None
+        :return: The HTTP client.
+        :rtype: stripe.HTTPClient
+    """
+
+    if http_client is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        http_client = stripe.RequestsClient(timeout=STRIPE_HTTP_TIMEOUT, session=session)
+
+    stripe.default_http_client = http_client
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+    if STRIPE_API_BASE:
+        stripe.api_base = STRIPE_API_BASE
+    return http_client
+
+def _get_redis():
+    """ Returns the Redis connection of the task queue, or None if the task queue doesn't use Redis (e.g. in immediate mode). """
+    return getattr(HUEY.storage, 'conn', None)
+
+def record_stripe_request(endpoint: str, seconds: float, failed: bool = False) -> None:
+    """ Counts the requests to a Stripe endpoint and their duration per minute, for get_stripe_metrics. """
+
+    redis = _get_redis()
+    if redis is None:
+        return
+
+    minute = int(time.time() // 60)
+    pipeline = redis.pipeline()
+    for field, value in (('requests', 1), ('failed', int(failed)), ('milliseconds', round(seconds * 1000))):
+        if value:
+            key = f'stripe_metrics:{endpoint}:{field}:{minute}'
+            pipeline.incrby(key, value)
+            pipeline.expire(key, METRICS_RETENTION_MINUTES * 60)
+    pipeline.execute()
+
+def record_stripe_cache(endpoint: str, result: str) -> None:
+    """ Counts the cache hits, misses and coalesced requests of a Stripe endpoint per minute, for get_stripe_metrics. """
+
+    redis = _get_redis()
+    if redis is None:
+        return
+
+    key = f'stripe_metrics:{endpoint}:cache_{result}:{int(time.time() // 60)}'
+    pipeline = redis.pipeline()
+    pipeline.incr(key)
+    pipeline.expire(key, METRICS_RETENTION_MINUTES * 60)
+    pipeline.execute()
+
+def get_stripe_metrics(minutes: int = 5) -> dict:
+    """ Returns the amount of requests, failed requests, the average latency and the cache hits per Stripe endpoint over the last minutes.
+
+        :param minutes: The amount of minutes to compute the metrics over (max. METRICS_RETENTION_MINUTES).
+        :type minutes: int
+        :return: The metrics per endpoint, empty if the task queue doesn't use Redis.
+        :rtype: dict
+    """
+
+    redis = _get_redis()
+    if redis is None:
+        return {}
+
+    current_minute = int(time.time() // 60)
+    minute_range = range(current_minute - min(minutes, METRICS_RETENTION_MINUTES) + 1, current_minute + 1)
+    endpoints = sorted({key.decode().split(':')[1] for key in redis.scan_iter('stripe_metrics:*')})
+
+    metrics = {}
+    for endpoint in endpoints:
+        counts = {}
+        for field in ('requests', 'failed', 'milliseconds', 'cache_hit', 'cache_miss', 'cache_coalesced'):
+            keys = [f'stripe_metrics:{endpoint}:{field}:{minute}' for minute in minute_range]
+            counts[field] = sum(int(value) for value in redis.mget(keys) if value)
+
+        metrics[endpoint] = {
+            'requests' : counts['requests'],
+            'failed' : counts['failed'],
+            'average_milliseconds' : round(counts['milliseconds'] / counts['requests'], 1) if counts['requests'] else None,
+            'cache_hits' : counts['cache_hit'],
+            'cache_misses' : counts['cache_miss'],
+            'coalesced' : counts['cache_coalesced'],
+        }
+
+    return metrics
+
+class _InFlightRequest:
+    """ A request to Stripe that other threads are waiting for. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+class StripeClient:
+    """ Retrieves customers and checkout line items from Stripe, with a cache and request coalescing.
+
+        - The objects are cached in the Django cache (Redis, so shared by the web and task queue processes) for STRIPE_CACHE_TIMEOUT seconds.
+          The webhook handlers remove them from the cache when Stripe reports a change (see modules.payments.webhooks).
+        - Identical requests made at the same time by threads of the process are sent to Stripe once; the other threads wait for the result.
+        - The duration of every request is recorded per endpoint (see get_stripe_metrics).
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def call(self, endpoint: str, func, *args, **kwargs):
+        """ Calls the Stripe API function and records its duration for the endpoint. """
+
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            record_stripe_request(endpoint, time.perf_counter() - start, failed=True)
+            raise
+        record_stripe_request(endpoint, time.perf_counter() - start)
+        return result
+
+    def _coalesce(self, key: str, func):
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[key] = _InFlightRequest()
+
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.exception is not None:
+                raise in_flight.exception
+            return in_flight.result, True
+
+        try:
+            in_flight.result = func()
+        except Exception as e:
+            in_flight.exception = e
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+        return in_flight.result, False
+
+    def _get(self, cache_key: str, endpoint: str, timeout: int, func, *args):
+        data = cache.get(cache_key)
+        if data is not None:
+            record_stripe_cache(endpoint, 'hit')
+            return data
+
+        def fetch():
+            data = json.loads(str(self.call(endpoint, func, *args)))
+            cache.set(cache_key, data, timeout)
+            return data
+
+        data, coalesced = self._coalesce(cache_key, fetch)
+        record_stripe_cache(endpoint, 'coalesced' if coalesced else 'miss')
+        return data
+
+    def retrieve_customer(self, customer_id: str) -> stripe.Customer:
+        """ Returns the Stripe customer (deleted customers have a deleted attribute set to True). """
+
+        data = self._get(f'stripe_customer_{customer_id}', 'customers.retrieve', STRIPE_CACHE_TIMEOUT, stripe.Customer.retrieve, customer_id)
+        return stripe.Customer.construct_from(data, stripe.api_key)
+
+    def create_customer(self, **params) -> stripe.Customer:
+        """ Creates a Stripe customer, and caches it so it isn't retrieved right after. """
+
+        customer = self.call('customers.create', stripe.Customer.create, **params)
+        cache.set(f'stripe_customer_{customer.id}', json.loads(str(customer)), STRIPE_CACHE_TIMEOUT)
+        return customer
+
+    def list_checkout_line_items(self, checkout_session_id: str) -> list:
+        """ Returns the line items of the checkout session. """
+
+        data = self._get(
+            f'stripe_line_items_{checkout_session_id}', 'checkout.sessions.list_line_items', STRIPE_LINE_ITEMS_CACHE_TIMEOUT,
+            stripe.checkout.Session.list_line_items, checkout_session_id
+        )
+        return stripe.ListObject.construct_from(data, stripe.api_key).data
+
+    def invalidate_customer(self, customer_id: str) -> None:
+        cache.delete(f'stripe_customer_{customer_id}')
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+configure_http_client()
+
+stripe_client = StripeClient()
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from huey.contrib.djhuey import HUEY
+from huey.exceptions import TaskLockedException
+
+from CONFIG.stripe import STRIPE_RECONCILIATION_INVOICE_DAYS, STRIPE_RECONCILIATION_BATCH_SIZE
+from modules.payments.reconciliation import reconcile_with_stripe
+
+class Command(BaseCommand):
+    help = 'Reconciles the customers, subscriptions and invoices with Stripe, for webhook events that were missed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only show the changes, don\'t save them')
+        parser.add_argument('--batch-size', type=int, default=STRIPE_RECONCILIATION_BATCH_SIZE, help='Amount of rows per bulk update/create')
+        parser.add_argument('--invoice-days', type=int, default=STRIPE_RECONCILIATION_INVOICE_DAYS, help='Only check the invoices created in the last days')
+        parser.add_argument('--all-invoices', action='store_true', help='Check all invoices')
+
+    def handle(self, *args, **options):
+        try:
+            with HUEY.lock_task('stripe_reconciliation'): # Not at the same time as the periodic task
+                stats = reconcile_with_stripe(
+                    dry_run=options['dry_run'],
+                    batch_size=options['batch_size'],
+                    invoice_days=None if options['all_invoices'] else options['invoice_days'],
+                )
+        except TaskLockedException:
+            self.stdout.write(self.style.ERROR('The reconciliation is already running.'))
+            return
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Dry run, no changes were saved.'))
+        self.stdout.write(self.style.SUCCESS(stats.get_summary()))
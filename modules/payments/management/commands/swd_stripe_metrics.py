@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from modules.payments.client import get_stripe_metrics
+from modules.payments.webhook_handler import get_webhook_handler_metrics, HANDLER_TIMING_BUCKETS
+
+class Command(BaseCommand):
+    help = 'Shows the amount of requests, the average latency and the cache hits per Stripe API endpoint, and the duration histogram per webhook handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=5, help='Amount of minutes to compute the metrics over')
+
+    def handle(self, *args, **options):
+        metrics = get_stripe_metrics(options['minutes'])
+
+        if not metrics:
+            self.stdout.write(self.style.WARNING('No metrics found. Metrics are only available when the task queue uses Redis.'))
+
+        for endpoint, endpoint_metrics in metrics.items():
+            average = f'{endpoint_metrics["average_milliseconds"]} ms' if endpoint_metrics['average_milliseconds'] is not None else '-'
+            self.stdout.write(
+                f'{endpoint}: {endpoint_metrics["requests"]} requests ({endpoint_metrics["failed"]} failed, average {average}), '
+                f'{endpoint_metrics["cache_hits"]} cache hits, {endpoint_metrics["cache_misses"]} misses, '
+                f'{endpoint_metrics["coalesced"]} coalesced in the last {options["minutes"]} minutes'
+            )
+
+        for name, handler_metrics in get_webhook_handler_metrics(options['minutes']).items():
+            buckets = []
+            for bucket, runs in handler_metrics['histogram'].items():
+                if runs:
+                    label = f'<= {bucket} ms' if bucket != 'inf' else f'> {HANDLER_TIMING_BUCKETS[-1]} ms'
+                    buckets.append(f'{label}: {runs}')
+            self.stdout.write(f'{name}: {handler_metrics["runs"]} runs ({handler_metrics["failed"]} failed) - {", ".join(buckets)}')
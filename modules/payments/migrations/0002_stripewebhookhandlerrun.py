@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 11:43
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeWebhookHandlerRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('handler', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='handler_runs', to='payments.stripewebhookevent')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stripewebhookhandlerrun',
+            constraint=models.UniqueConstraint(fields=('event', 'handler'), name='webhookhandlerrun_unique'),
+        ),
+    ]
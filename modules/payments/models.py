@@ -1,3 +1,58 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
-from django.contrib.auth import get_user_model
\ No newline at end of file
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+class StripeWebhookEvent(models.Model):
+    """ A webhook event received from Stripe. The unique Stripe event ID makes sure an event is processed only once,
+        also when Stripe sends it again (e.g. because the first delivery timed out).
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSED = 'processed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSED, 'Processed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    stripe_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    customer_id = models.CharField(max_length=255, blank=True, default='') # The Stripe customer, events of the same customer are processed in order
+    stripe_created = models.BigIntegerField(default=0) # Unix timestamp
+    payload = models.JSONField()
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+
+    created_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['stripe_created', 'id']
+        indexes = [
+            models.Index(fields=['customer_id', 'status', 'stripe_created', 'id'], name='webhookevent_customer_idx'),
+            models.Index(fields=['status', 'created_at'], name='webhookevent_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.type} ({self.stripe_id}) - {self.status}'
+
+class StripeWebhookHandlerRun(models.Model):
+    """ A webhook handler that completed for an event. Saved in the transaction of the handler, so when the event is processed again
+        (because another handler failed), the completed handlers aren't run twice (e.g. credits aren't added twice).
+    """
+
+    event = models.ForeignKey(StripeWebhookEvent, on_delete=models.CASCADE, related_name='handler_runs')
+    handler = models.CharField(max_length=255)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'handler'], name='webhookhandlerrun_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.handler} ({self.event.stripe_id})'
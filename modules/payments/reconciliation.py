@@ -0,0 +1,288 @@
+import time
+import datetime
+import logging
+
+import stripe
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from CONFIG.stripe import STRIPE_RECONCILIATION_INVOICE_DAYS, STRIPE_RECONCILIATION_BATCH_SIZE
+from modules.billing.entitlements import invalidate_entitlements_for_users
+from modules.billing.models import Subscription, StripeInvoice
+from modules.payments.client import stripe_client
+from modules.payments.utils import get_subscription_fields_for_stripe_subscription
+
+logger = logging.getLogger(__name__)
+
+STRIPE_PAGE_SIZE = 100 # The maximum of the Stripe API
+
+# The fields of a subscription that is reset to the default plan (see Subscription.reset_to_default)
+DEFAULT_SUBSCRIPTION_FIELDS = {
+    'subscription_key' : 'default',
+    'stripe_subscription_id' : None,
+    'stripe_status' : None,
+    'starts' : 0,
+    'current_period_start' : 0,
+    'current_period_end' : 0,
+    'cancel_at_period_end' : False,
+}
+
+# Subscriptions with these statuses are preferred over canceled (and expired) subscriptions of the same customer
+CURRENT_SUBSCRIPTION_STATUSES = ['active', 'trialing', 'past_due', 'unpaid', 'incomplete', 'paused']
+
+# Invoices with these statuses are finalized, like the invoices added by the invoice.finalized webhook handler
+FINALIZED_INVOICE_STATUSES = ['open', 'paid', 'void', 'uncollectible']
+
+class ReconciliationStats:
+    """ The amount of Stripe objects that were read, and the local rows that were created, updated or found unchanged per type. """
+
+    def __init__(self):
+        self.counts = {}
+        self.requests = 0
+        self.start = time.perf_counter()
+        self.seconds = 0
+
+    def add(self, name: str, amount: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def stop(self) -> None:
+        self.seconds = time.perf_counter() - self.start
+
+    def get(self, name: str) -> int:
+        return self.counts.get(name, 0)
+
+    def get_summary(self) -> str:
+        objects = sum(count for name, count in self.counts.items() if name.endswith('_read'))
+        per_second = objects / self.seconds if self.seconds else 0
+        counts = ', '.join(f'{name.replace("_", " ")}: {count}' for name, count in sorted(self.counts.items()))
+        return f'{objects} Stripe objects in {self.requests} requests in {self.seconds:.1f} seconds ({per_second:.0f}/s). {counts}'
+
+def iterate_stripe_list(endpoint: str, list_function, stats: ReconciliationStats, **params):
+    """ Yields all objects of a Stripe list endpoint, page by page (like auto_paging_iter, with the requests recorded per endpoint). """
+
+    starting_after = None
+    while True:
+        page = stripe_client.call(endpoint, list_function, limit=STRIPE_PAGE_SIZE, **params, **({'starting_after' : starting_after} if starting_after else {}))
+        stats.requests += 1
+
+        yield from page.data
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1].id
+
+class BatchWriter:
+    """ Collects the changed and new rows, and saves them with bulk_update and bulk_create in batches (not in a dry run).
+
+        :param unchanged_since: Only update the rows whose updated_at is older, so changes saved in the meantime (e.g. by a webhook handler) aren't overwritten.
+        :param ignore_conflicts: Skip new rows that conflict with an existing row (e.g. added by a webhook handler in the meantime).
+    """
+
+    def __init__(self, model, fields: list, batch_size: int, dry_run: bool, on_write=None, unchanged_since: datetime.datetime | None = None, ignore_conflicts: bool = False):
+        self.model = model
+        self.fields = fields
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.on_write = on_write
+        self.unchanged_since = unchanged_since
+        self.ignore_conflicts = ignore_conflicts
+        self.to_update = []
+        self.to_create = []
+        self.skipped = 0
+
+    def update(self, instance) -> None:
+        self.to_update.append(instance)
+        if len(self.to_update) >= self.batch_size:
+            self.flush()
+
+    def create(self, instance) -> None:
+        self.to_create.append(instance)
+        if len(self.to_create) >= self.batch_size:
+            self.flush()
+
+    def _update(self) -> None:
+        if self.unchanged_since is None:
+            self.model.objects.bulk_update(self.to_update, self.fields, batch_size=self.batch_size)
+            return
+
+        # The rows are locked until they're updated, so they can't change between the check and the update
+        with transaction.atomic():
+            unchanged_ids = set(self.model.objects.select_for_update().filter(
+                pk__in=[instance.pk for instance in self.to_update], updated_at__lt=self.unchanged_since
+            ).values_list('pk', flat=True))
+
+            changed = [instance for instance in self.to_update if instance.pk not in unchanged_ids]
+            self.to_update = [instance for instance in self.to_update if instance.pk in unchanged_ids]
+            self.skipped += len(changed)
+            self.model.objects.bulk_update(self.to_update, self.fields, batch_size=self.batch_size)
+
+    def flush(self) -> None:
+        if not self.dry_run:
+            if self.to_update:
+                self._update()
+            if self.to_create:
+                self.model.objects.bulk_create(self.to_create, batch_size=self.batch_size, ignore_conflicts=self.ignore_conflicts)
+            if self.on_write is not None:
+                self.on_write(self.to_update + self.to_create)
+
+        self.to_update = []
+        self.to_create = []
+
+def reconcile_customers(stats: ReconciliationStats, dry_run: bool = False, batch_size: int = STRIPE_RECONCILIATION_BATCH_SIZE) -> dict:
+    """ Links the users without a Stripe customer to the customer that was created for them (by the user_id metadata),
+        e.g. when saving the customer ID failed. Counts the customer IDs of users that don't exist in Stripe (not changed).
+
+        :return: The user ID per Stripe customer ID.
+        :rtype: dict
+    """
+
+    user_ids_by_customer_id = dict(get_user_model().objects.exclude(stripe_customer_id=None).exclude(stripe_customer_id='').values_list('stripe_customer_id', 'id'))
+    unlinked_user_ids = set(get_user_model().objects.filter(stripe_customer_id=None).values_list('id', flat=True))
+    unlinked_user_ids |= set(get_user_model().objects.filter(stripe_customer_id='').values_list('id', flat=True))
+
+    stripe_customer_ids = set()
+    customers_for_unlinked_users = {}
+    for customer in iterate_stripe_list('customers.list', stripe.Customer.list, stats):
+        stats.add('customers_read')
+        stripe_customer_ids.add(customer.id)
+
+        user_id = getattr(getattr(customer, 'metadata', None), 'user_id', None)
+        if user_id and user_id.isdigit() and int(user_id) in unlinked_user_ids:
+            # The newest customer of the user is used (customers are listed newest first)
+            customers_for_unlinked_users.setdefault(int(user_id), customer.id)
+
+    stats.add('customers_missing_in_stripe', len(user_ids_by_customer_id.keys() - stripe_customer_ids))
+
+    writer = BatchWriter(get_user_model(), ['stripe_customer_id'], batch_size, dry_run)
+    for user in get_user_model().objects.filter(id__in=customers_for_unlinked_users).only('id', 'stripe_customer_id').iterator(chunk_size=batch_size):
+        user.stripe_customer_id = customers_for_unlinked_users[user.id]
+        user_ids_by_customer_id[user.stripe_customer_id] = user.id
+        writer.update(user)
+        stats.add('customers_linked')
+    writer.flush()
+
+    return user_ids_by_customer_id
+
+def _get_current_subscription(subscriptions: list):
+    """ Returns the subscription that applies to a customer: the newest current subscription, or the newest canceled one. """
+    return max(subscriptions, key=lambda subscription: (subscription['status'] in CURRENT_SUBSCRIPTION_STATUSES, subscription['created']))
+
+def reconcile_subscriptions(stats: ReconciliationStats, user_ids_by_customer_id: dict, dry_run: bool = False, batch_size: int = STRIPE_RECONCILIATION_BATCH_SIZE) -> None:
+    """ Updates the local subscriptions to the subscriptions in Stripe, like the customer.subscription.* webhook handlers would have.
+        Lifetime subscriptions (one-time payments) aren't subscriptions in Stripe, and are left alone.
+        Subscriptions that changed since the subscriptions were listed (e.g. by a webhook handler) are newer than the listing, and are skipped.
+    """
+
+    listed_at = timezone.now()
+    subscriptions_by_customer_id = {}
+    for stripe_subscription in iterate_stripe_list('subscriptions.list', stripe.Subscription.list, stats, status='all'):
+        stats.add('subscriptions_read')
+        if get_subscription_fields_for_stripe_subscription(stripe_subscription) is not None: # Only subscriptions to a plan of the billing catalog
+            subscriptions_by_customer_id.setdefault(stripe_subscription['customer'], []).append(stripe_subscription)
+
+    fields = list(DEFAULT_SUBSCRIPTION_FIELDS) + ['lifetime', 'updated_at']
+    writer = BatchWriter(
+        Subscription, fields, batch_size, dry_run, unchanged_since=listed_at,
+        on_write=lambda subscriptions: invalidate_entitlements_for_users([subscription.user_id for subscription in subscriptions])
+    )
+
+    # The customers are mapped in Python instead of joining the users, so the customers linked in a dry run are included
+    customer_ids_by_user_id = {user_id : customer_id for customer_id, user_id in user_ids_by_customer_id.items() if customer_id in subscriptions_by_customer_id}
+    for subscription in Subscription.objects.filter(lifetime=False, updated_at__lt=listed_at).iterator(chunk_size=batch_size):
+        customer_id = customer_ids_by_user_id.get(subscription.user_id)
+        if customer_id is None:
+            continue
+
+        stripe_subscription = _get_current_subscription(subscriptions_by_customer_id[customer_id])
+
+        if stripe_subscription['status'] in CURRENT_SUBSCRIPTION_STATUSES:
+            new_fields = get_subscription_fields_for_stripe_subscription(stripe_subscription)
+        elif subscription.stripe_subscription_id == stripe_subscription['id']:
+            new_fields = DEFAULT_SUBSCRIPTION_FIELDS # Canceled, like the customer.subscription.deleted webhook handler
+        else:
+            new_fields = {} # An older subscription of the customer was canceled
+
+        if all(getattr(subscription, field) == value for field, value in new_fields.items()):
+            stats.add('subscriptions_unchanged')
+            continue
+
+        for field, value in new_fields.items():
+            setattr(subscription, field, value)
+        subscription.updated_at = timezone.now() # bulk_update doesn't set auto_now fields
+        writer.update(subscription)
+        stats.add('subscriptions_updated')
+
+    writer.flush()
+    stats.add('subscriptions_updated', -writer.skipped)
+    stats.add('subscriptions_skipped_changed', writer.skipped + Subscription.objects.filter(lifetime=False, updated_at__gte=listed_at).count())
+
+def reconcile_invoices(stats: ReconciliationStats, user_ids_by_customer_id: dict, dry_run: bool = False, batch_size: int = STRIPE_RECONCILIATION_BATCH_SIZE,
+                       since: datetime.datetime | None = None) -> None:
+    """ Adds the finalized Stripe invoices that are missing locally (like the invoice.finalized webhook handler would have),
+        and updates the number and URL of the existing ones.
+    """
+
+    writer = BatchWriter(StripeInvoice, ['number', 'hosted_invoice_url'], batch_size, dry_run, ignore_conflicts=True) # The invoice.finalized handler may add an invoice in the meantime
+    params = {'created' : {'gte' : int(since.timestamp())}} if since else {}
+
+    page = []
+    def reconcile_page():
+        existing = {invoice.stripe_id : invoice for invoice in StripeInvoice.objects.filter(stripe_id__in=[stripe_invoice.id for stripe_invoice in page])}
+        for stripe_invoice in page:
+            invoice = existing.get(stripe_invoice.id)
+            if invoice is None:
+                writer.create(StripeInvoice(
+                    user_id=user_ids_by_customer_id[stripe_invoice['customer']],
+                    stripe_id=stripe_invoice.id,
+                    number=stripe_invoice['number'],
+                    hosted_invoice_url=getattr(stripe_invoice, 'hosted_invoice_url', None),
+                ))
+                stats.add('invoices_created')
+            elif invoice.number != stripe_invoice['number'] or invoice.hosted_invoice_url != getattr(stripe_invoice, 'hosted_invoice_url', None):
+                invoice.number = stripe_invoice['number']
+                invoice.hosted_invoice_url = getattr(stripe_invoice, 'hosted_invoice_url', None)
+                writer.update(invoice)
+                stats.add('invoices_updated')
+            else:
+                stats.add('invoices_unchanged')
+        page.clear()
+
+    for stripe_invoice in iterate_stripe_list('invoices.list', stripe.Invoice.list, stats, **params):
+        stats.add('invoices_read')
+        if stripe_invoice['status'] not in FINALIZED_INVOICE_STATUSES or not getattr(stripe_invoice, 'number', None) or stripe_invoice['customer'] not in user_ids_by_customer_id:
+            continue
+
+        page.append(stripe_invoice)
+        if len(page) >= STRIPE_PAGE_SIZE:
+            reconcile_page()
+
+    if page:
+        reconcile_page()
+    writer.flush()
+
+def reconcile_with_stripe(dry_run: bool = False, batch_size: int = STRIPE_RECONCILIATION_BATCH_SIZE, invoice_days: int | None = STRIPE_RECONCILIATION_INVOICE_DAYS) -> ReconciliationStats:
+    """ Reconciles the customers, subscriptions and invoices with Stripe, for changes of which a webhook event was missed.
+        The objects are listed from Stripe page by page (100 per request, instead of a request per user) and the changes are saved in batches.
+        bulk_update doesn't send signals, so the cached entitlements of the changed subscriptions are removed explicitly.
+
+        :param dry_run: Only count the changes, don't save them.
+        :type dry_run: bool
+        :param batch_size: The amount of rows per bulk_update/bulk_create.
+        :type batch_size: int
+        :param invoice_days: Only check the invoices created in the last days, None to check all invoices.
+        :type invoice_days: int | None
+        :return: The statistics.
+        :rtype: ReconciliationStats
+    """
+
+    stats = ReconciliationStats()
+
+    user_ids_by_customer_id = reconcile_customers(stats, dry_run=dry_run, batch_size=batch_size)
+    reconcile_subscriptions(stats, user_ids_by_customer_id, dry_run=dry_run, batch_size=batch_size)
+
+    since = timezone.now() - datetime.timedelta(days=invoice_days) if invoice_days is not None else None
+    reconcile_invoices(stats, user_ids_by_customer_id, dry_run=dry_run, batch_size=batch_size, since=since)
+
+    stats.stop()
+    logger.info(f'Stripe reconciliation{" (dry run)" if dry_run else ""}: {stats.get_summary()}')
+    return stats
@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+
+from huey import crontab
+from huey.contrib.djhuey import task, periodic_task, HUEY
+from huey.exceptions import TaskLockedException
+from redis.exceptions import LockError
+
+from CONFIG.stripe import STRIPE_WEBHOOK_MAX_ATTEMPTS, STRIPE_RECONCILIATION_HOUR
+from .client import _get_redis
+from .reconciliation import reconcile_with_stripe
+from .utils import process_webhook_events_for_customer, get_customers_with_stuck_webhook_events, remove_old_webhook_events
+
+WEBHOOK_RETRY_BACKOFF_BASE = 30 # Seconds before the first retry of a failed webhook event, doubled for every next attempt
+WEBHOOK_RETRY_BACKOFF_MAX = 3600
+WEBHOOK_LOCK_TIMEOUT = 120 # Seconds after which the lock of a customer expires, so a worker that died doesn't block the customer. It's extended before every event.
+WEBHOOK_LOCK_MAX_WAITS = 30 # Times a task waits a second for a worker that is busy with the customer. After that, the events are picked up by process_pending_stripe_webhook_events.
+
+class StripeWebhookEventFailed(Exception):
+    """ Raised when a webhook event failed, so the task is retried. """
+
+@contextmanager
+def lock_customer_webhook_events(customer_id: str):
+    """ Locks the webhook events of a Stripe customer, so only one worker processes them at the same time.
+        Yields the lock (None if the task queue doesn't use Redis), raises TaskLockedException if the events are already locked.
+    """
+
+    redis = _get_redis()
+    if redis is None:
+        with HUEY.lock_task(f'stripe_webhook_events_{customer_id}'):
+            yield None
+        return
+
+    lock = redis.lock(f'stripe_webhook_events_lock:{customer_id}', timeout=WEBHOOK_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        raise TaskLockedException(f'unable to acquire lock stripe_webhook_events_lock:{customer_id}')
+
+    try:
+        yield lock
+    finally:
+        try:
+            lock.release()
+        except LockError: # Expired
+            pass
+
+@task(retries=STRIPE_WEBHOOK_MAX_ATTEMPTS, context=True)
+def process_stripe_webhook_events(customer_id: str, waits: int = 0, task=None) -> int:
+    """ (Task queue) Process the pending webhook events of a Stripe customer, in order.
+        Only one worker processes the events of a customer at the same time. If another worker is busy with the customer,
+        the task is run again a second later (at most WEBHOOK_LOCK_MAX_WAITS times), as that worker may have missed the newest event.
+    """
+
+    try:
+        with lock_customer_webhook_events(customer_id) as lock:
+            processed, failed_attempts = process_webhook_events_for_customer(customer_id, on_event=lock.reacquire if lock else None)
+    except TaskLockedException:
+        if waits < WEBHOOK_LOCK_MAX_WAITS:
+            process_stripe_webhook_events.schedule((customer_id, waits + 1), delay=1)
+        return 0
+
+    if failed_attempts is not None and task is not None:
+        task.retry_delay = min(WEBHOOK_RETRY_BACKOFF_MAX, WEBHOOK_RETRY_BACKOFF_BASE * 2 ** (failed_attempts - 1))
+        raise StripeWebhookEventFailed(f'A webhook event of customer "{customer_id}" failed, retrying in {task.retry_delay} seconds.')
+
+    return processed
+
+@periodic_task(crontab(minute='*/5'))
+def process_pending_stripe_webhook_events() -> None:
+    """ (Task queue) Process the webhook events that are stuck, e.g. because the task couldn't be added when the event was received. """
+
+    for customer_id in get_customers_with_stuck_webhook_events():
+        process_stripe_webhook_events(customer_id)
+
+@periodic_task(crontab(minute='30', hour='4'))
+def remove_old_stripe_webhook_events() -> None:
+    """ (Task queue) Remove the processed webhook events older than STRIPE_WEBHOOK_EVENT_RETENTION_DAYS. """
+
+    remove_old_webhook_events()
+
+@periodic_task(crontab(minute='15', hour=str(STRIPE_RECONCILIATION_HOUR)))
+@HUEY.lock_task('stripe_reconciliation')
+def reconcile_stripe() -> None:
+    """ (Task queue) Reconcile the customers, subscriptions and recent invoices with Stripe, for webhook events that were missed. """
+
+    reconcile_with_stripe()
@@ -1,6 +1,17 @@
+import datetime
+import traceback
+from typing import Callable
+
 import stripe
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils import timezone
+
+from CONFIG.stripe import STRIPE_WEBHOOK_MAX_ATTEMPTS, STRIPE_WEBHOOK_EVENT_RETENTION_DAYS
+from modules.billing.catalog import BILLING_CATALOG
+from modules.payments.client import stripe_client
+from modules.payments.models import StripeWebhookEvent, StripeWebhookHandlerRun
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
@@ -8,7 +19,7 @@ def get_or_create_stripe_customer(user: get_user_model) -> stripe.Customer:
     """ Tries to retrieve the stripe customer for the user. If it doesn't exist, creates it. """
 
     if not user.stripe_customer_id:
-        stripe_customer = stripe.Customer.create(
+        stripe_customer = stripe_client.create_customer(
             email=user.email,
             name=user.get_full_name(),
             description=f"Stripe customer for {user.get_full_name()}",
@@ -23,12 +34,13 @@ def get_or_create_stripe_customer(user: get_user_model) -> stripe.Customer:
     # try to return the customer by our saved id
     # if Stripe can't find it, create it again
     try:
-        customer = stripe.Customer.retrieve(user.stripe_customer_id)
+        customer = stripe_client.retrieve_customer(user.stripe_customer_id) # Cached, see modules.payments.client
 
         # Deleted customers are still present in Stripe
         # but they have a deleted attribute set to True
         # If that's the case, we need to create a new customer
         if getattr(customer, 'deleted', False):
+            stripe_client.invalidate_customer(user.stripe_customer_id)
             user.stripe_customer_id = None
             user.save()
             return get_or_create_stripe_customer(user)
@@ -46,8 +58,35 @@ def get_user_by_stripe_customer_id(stripe_customer_id: str) -> get_user_model:
 def get_line_items_for_checkout(checkout_session_id: str) -> list[dict]:
     """ Retrieves the line items for a checkout session. """
 
-    session = stripe.checkout.Session.list_line_items(checkout_session_id)
-    return session.data
+    return stripe_client.list_checkout_line_items(checkout_session_id)
+
+def get_subscription_fields_for_stripe_subscription(subscription_data) -> dict | None:
+    """ Returns the fields of the local Subscription for a Stripe subscription, or None if its price isn't a subscription plan.
+
+        :param subscription_data: The Stripe subscription.
+        :type subscription_data: stripe.Subscription | dict
+        :return: The Subscription fields.
+        :rtype: dict | None
+    """
+
+    try:
+        plan = BILLING_CATALOG.get_subscription_by_price_id(subscription_data['items']['data'][0]['price']['id'])
+    except (KeyError, IndexError, TypeError):
+        return None
+
+    if not plan:
+        return None
+
+    return {
+        'stripe_subscription_id' : subscription_data['id'],
+        'stripe_status' : subscription_data['status'],
+        'subscription_key' : plan['key'],
+        'starts' : subscription_data['start_date'],
+        'current_period_start' : subscription_data['current_period_start'],
+        'current_period_end' : subscription_data['current_period_end'],
+        'cancel_at_period_end' : subscription_data['cancel_at_period_end'],
+        'lifetime' : False, # Stripe subscriptions are never lifetime
+    }
 
 def create_stripe_invoice_for_price_for_user(user: get_user_model, price_id: str, mark_paid: bool = False) -> stripe.Invoice:
     """ Creates a stripe invoice for the user. 
@@ -75,4 +114,116 @@ def create_stripe_invoice_for_price_for_user(user: get_user_model, price_id: str
     if mark_paid:
         stripe.Invoice.pay(invoice.id, paid_out_of_band=True)
 
-    return invoice
\ No newline at end of file
+    return invoice
+
+def get_customer_id_for_event(payload: dict) -> str:
+    """ Returns the ID of the Stripe customer an event is about, or an empty string if the event isn't about a customer. """
+
+    data_object = payload.get('data', {}).get('object', {})
+    if data_object.get('object') == 'customer':
+        return data_object.get('id') or ''
+
+    customer = data_object.get('customer')
+    if isinstance(customer, dict): # Expanded customer
+        customer = customer.get('id')
+    return customer or ''
+
+def store_webhook_event(payload: dict) -> tuple[StripeWebhookEvent, bool]:
+    """ Stores a (verified) Stripe webhook event, unless it was already received.
+
+        :param payload: The event, as received from Stripe.
+        :type payload: dict
+        :return: The stored event, and whether it's new (False if Stripe sent the event before).
+        :rtype: tuple[StripeWebhookEvent, bool]
+    """
+
+    return StripeWebhookEvent.objects.get_or_create(
+        stripe_id=payload['id'],
+        defaults={
+            'type' : payload['type'],
+            'customer_id' : get_customer_id_for_event(payload),
+            'stripe_created' : payload.get('created') or 0,
+            'payload' : payload,
+        }
+    )
+
+def process_webhook_event(webhook_event: StripeWebhookEvent) -> bool:
+    """ Runs the handlers of a stored webhook event. Every handler runs in its own transaction, the handlers that were completed
+        in an earlier attempt aren't run again. The event is marked as processed when all handlers are completed,
+        or as failed after STRIPE_WEBHOOK_MAX_ATTEMPTS attempts.
+
+        :param webhook_event: The stored event.
+        :type webhook_event: StripeWebhookEvent
+        :return: Whether the event was processed.
+        :rtype: bool
+    """
+
+    from modules.payments.webhook_handler import handle_event
+
+    event = stripe.Event.construct_from(webhook_event.payload, stripe.api_key)
+    webhook_event.attempts += 1
+
+    try:
+        completed = set(webhook_event.handler_runs.values_list('handler', flat=True))
+        result = handle_event(event, completed=completed, on_complete=lambda handler: StripeWebhookHandlerRun.objects.create(event=webhook_event, handler=handler))
+        error = None if result.ok else result.get_error()
+    except Exception:
+        error = traceback.format_exc()
+
+    if error is not None:
+        webhook_event.error = error
+        if webhook_event.attempts >= STRIPE_WEBHOOK_MAX_ATTEMPTS:
+            webhook_event.status = StripeWebhookEvent.STATUS_FAILED
+        webhook_event.save(update_fields=['attempts', 'error', 'status'])
+        return False
+
+    webhook_event.status = StripeWebhookEvent.STATUS_PROCESSED
+    webhook_event.error = ''
+    webhook_event.processed_at = timezone.now()
+    webhook_event.save(update_fields=['attempts', 'error', 'status', 'processed_at'])
+    return True
+
+def process_webhook_events_for_customer(customer_id: str, on_event: Callable | None = None) -> tuple[int, int | None]:
+    """ Processes the pending webhook events of a Stripe customer, in the order Stripe created them.
+        Stops at the first event that fails (and can be retried), so the next events aren't processed before it.
+
+        :param customer_id: The ID of the Stripe customer (empty for events that aren't about a customer).
+        :type customer_id: str
+        :param on_event: Called before every event, e.g. to extend the lock of the customer.
+        :type on_event: Callable | None
+        :return: The amount of processed events, and the attempts of the event that failed (None if no event failed).
+        :rtype: tuple[int, int | None]
+    """
+
+    processed = 0
+    pending_events = StripeWebhookEvent.objects.filter(customer_id=customer_id, status=StripeWebhookEvent.STATUS_PENDING).order_by('stripe_created', 'id')
+    for webhook_event in pending_events:
+        if on_event is not None:
+            on_event()
+        if process_webhook_event(webhook_event):
+            processed += 1
+        elif webhook_event.status == StripeWebhookEvent.STATUS_PENDING:
+            return processed, webhook_event.attempts
+
+    return processed, None
+
+def get_customers_with_stuck_webhook_events() -> list:
+    """ Returns the Stripe customers with webhook events that are still pending, but aren't being processed or retried:
+        events that were never tried a minute after they were received (e.g. because the task couldn't be added),
+        and events that are still pending an hour after they were received (the retries of the task ended).
+    """
+
+    now = timezone.now()
+    return list(StripeWebhookEvent.objects.filter(
+        Q(attempts=0, created_at__lt=now - datetime.timedelta(minutes=1)) | Q(created_at__lt=now - datetime.timedelta(hours=1)),
+        status=StripeWebhookEvent.STATUS_PENDING,
+    ).order_by().values_list('customer_id', flat=True).distinct())
+
+def remove_old_webhook_events() -> int:
+    """ Removes the processed webhook events older than STRIPE_WEBHOOK_EVENT_RETENTION_DAYS. Returns the amount of removed events. """
+
+    removed, _ = StripeWebhookEvent.objects.filter(
+        status=StripeWebhookEvent.STATUS_PROCESSED,
+        created_at__lt=timezone.now() - datetime.timedelta(days=STRIPE_WEBHOOK_EVENT_RETENTION_DAYS)
+    ).delete()
+    return removed
@@ -9,8 +9,12 @@ from django.http import HttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from modules.billing.utils import get_subscription_by_price_id, get_data_and_type_for_price_id
-from .webhook_handler import handle_event
+from django.db import transaction
+from .utils import store_webhook_event
+from .client import stripe_client
+from .tasks import process_stripe_webhook_events
 
+import json
 import stripe
 
 class SetupCheckoutForPrice(LoginRequiredMixin, View):
@@ -20,7 +24,7 @@ class SetupCheckoutForPrice(LoginRequiredMixin, View):
 
         stripe_customer = request.user.get_stripe_customer()
 
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = stripe_client.call('checkout.sessions.create', stripe.checkout.Session.create,
             line_items=[{
                 'price': self.price_id,
                 'quantity': 1,
@@ -85,7 +89,10 @@ class StripeWebhook(View):
             # Invalid signature
             return HttpResponse('Invalid signature', status=400)
 
-        # Handle the event
-        handle_event(event)
+        # Store the event and acknowledge it right away. The event is processed by the task queue, in order with the other events
+        # of the customer (see modules.payments.tasks). An event that Stripe sends again is recognized by its ID and not processed twice.
+        webhook_event, created = store_webhook_event(json.loads(str(event))) # The verified event, as a plain dict
+        if created:
+            transaction.on_commit(lambda: process_stripe_webhook_events(webhook_event.customer_id))
 
         return HttpResponse(status=200)
\ No newline at end of file
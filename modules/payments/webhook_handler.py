@@ -1,15 +1,286 @@
-webhook_handlers = {}
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+
+from CONFIG.stripe import STRIPE_WEBHOOK_HANDLER_WORKERS
+
+# Upper bounds (in milliseconds) of the buckets of the handler timing histograms
+HANDLER_TIMING_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+METRICS_RETENTION_MINUTES = 120
+
+class WebhookHandler:
+    """ A function that handles a type of Stripe webhook event.
+
+        :param func: The function, called with the event and the WebhookEventContext.
+        :param depends_on: The handlers (functions or names) of the same event type that must be completed before this one.
+        :param retries: The amount of times the handler is tried again (right away) when it fails, before the event is retried.
+        :param retry_delay: Seconds to wait before trying the handler again.
+    """
+
+    def __init__(self, func, depends_on: list | None = None, retries: int = 0, retry_delay: float = 0):
+        self.func = func
+        self.name = get_handler_name(func)
+        self.depends_on = tuple(get_handler_name(handler) if callable(handler) else handler for handler in depends_on or [])
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def __repr__(self):
+        return f'<WebhookHandler {self.name}>'
+
+def get_handler_name(func) -> str:
+    return f'{func.__module__}.{func.__qualname__}'
+
+class WebhookDispatchResult:
+    """ The outcome of dispatching an event: the completed, failed and skipped (because a dependency failed) handlers. """
+
+    def __init__(self):
+        self.completed = []
+        self.failed = {} # Name : traceback
+        self.skipped = []
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed and not self.skipped
+
+    def get_error(self) -> str:
+        errors = [f'{name} failed:\n{error}' for name, error in self.failed.items()]
+        errors += [f'{name} skipped, a handler it depends on failed.' for name in self.skipped]
+        return '\n'.join(errors)
+
+class WebhookDispatcher:
+    """ The registry of the webhook handlers, which runs the handlers of an event.
+
+        - Handlers that don't depend on each other run at the same time in a thread pool (the first one in the current thread),
+          so e.g. the checkout.session.completed handlers don't wait for each other's Stripe requests.
+          Handlers run after the handlers they depend on (depends_on).
+        - Every handler runs in its own transaction. A failing handler is tried again (retries) and doesn't stop the handlers that
+          don't depend on it. The handlers that are already completed are passed on the next attempt of the event, so they aren't run twice.
+        - The duration of every handler is recorded in a histogram (see get_webhook_handler_metrics).
+    """
+
+    def __init__(self, max_workers: int = STRIPE_WEBHOOK_HANDLER_WORKERS):
+        self.handlers = {}
+        self.max_workers = max_workers
+        self._plans = {}
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def register(self, event_type: str, func, depends_on: list | None = None, retries: int = 0, retry_delay: float = 0) -> WebhookHandler:
+        handler = WebhookHandler(func, depends_on=depends_on, retries=retries, retry_delay=retry_delay)
+        self.handlers.setdefault(event_type, []).append(handler)
+        self._plans.pop(event_type, None)
+        return handler
+
+    def get_plan(self, event_type: str) -> list[list[WebhookHandler]]:
+        """ Returns the handlers of the event type in stages: the handlers of a stage only depend on handlers of earlier stages. """
+
+        plan = self._plans.get(event_type)
+        if plan is not None:
+            return plan
+
+        handlers = self.handlers.get(event_type, [])
+        names = {handler.name for handler in handlers}
+        for handler in handlers:
+            for dependency in handler.depends_on:
+                if dependency not in names:
+                    raise ImproperlyConfigured(f'Webhook handler {handler.name} depends on {dependency}, which doesn\'t handle "{event_type}" events.')
+
+        plan, planned, remaining = [], set(), list(handlers)
+        while remaining:
+            stage = [handler for handler in remaining if set(handler.depends_on) <= planned]
+            if not stage:
+                raise ImproperlyConfigured(f'The webhook handlers of "{event_type}" events depend on each other: {", ".join(handler.name for handler in remaining)}.')
+            plan.append(stage)
+            planned.update(handler.name for handler in stage)
+            remaining = [handler for handler in remaining if handler not in stage]
+
+        self._plans[event_type] = plan
+        return plan
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='stripe-webhook')
+            return self._executor
+
+    def _run(self, handler: WebhookHandler, event, context, on_complete, in_thread: bool = False) -> str | None:
+        """ Runs the handler (with its retries). Returns the traceback if it failed, None otherwise. """
+
+        try:
+            for attempt in range(handler.retries + 1):
+                start = time.perf_counter()
+                try:
+                    with transaction.atomic():
+                        handler.func(event, context=context)
+                        if on_complete is not None:
+                            on_complete(handler.name) # In the transaction of the handler, so it's only recorded if the changes are saved
+                except Exception:
+                    record_webhook_handler_timing(handler.name, time.perf_counter() - start, failed=True)
+                    if attempt == handler.retries:
+                        return traceback.format_exc()
+                    time.sleep(handler.retry_delay)
+                else:
+                    record_webhook_handler_timing(handler.name, time.perf_counter() - start)
+                    return None
+        finally:
+            if in_thread:
+                close_old_connections()
+
+    def dispatch(self, event, context=None, completed=(), on_complete=None) -> WebhookDispatchResult:
+        """ Runs the handlers of the event.
+
+            :param event: The Stripe event.
+            :type event: stripe.Event
+            :param context: The context shared by the handlers, a new WebhookEventContext if None.
+            :type context: WebhookEventContext | None
+            :param completed: The names of the handlers that were completed in an earlier attempt, they aren't run again.
+            :type completed: Iterable[str]
+            :param on_complete: Called with the name of a handler when it's completed, in the transaction of the handler.
+            :type on_complete: Callable | None
+            :return: The completed, failed and skipped handlers.
+            :rtype: WebhookDispatchResult
+        """
+
+        context = context or WebhookEventContext(event)
+        result = WebhookDispatchResult()
+        done = set(completed)
+
+        for stage in self.get_plan(event['type']):
+            runnable = []
+            for handler in stage:
+                if handler.name in done:
+                    continue
+                if any(dependency not in done for dependency in handler.depends_on):
+                    result.skipped.append(handler.name)
+                    continue
+                runnable.append(handler)
+
+            if not runnable:
+                continue
+
+            # The first handler runs in the current thread, the others in the thread pool
+            futures = [(handler, self._get_executor().submit(self._run, handler, event, context, on_complete, in_thread=True)) for handler in runnable[1:]]
+            errors = [(runnable[0], self._run(runnable[0], event, context, on_complete))]
+            errors += [(handler, future.result()) for handler, future in futures]
+
+            for handler, error in errors:
+                if error is None:
+                    done.add(handler.name)
+                    result.completed.append(handler.name)
+                else:
+                    result.failed[handler.name] = error
+
+        return result
+
+class WebhookEventContext:
+    """ Shared by the handlers of one event. Lookups (Stripe API calls, the user of the customer) are done once per event,
+        e.g. the line items of a checkout session are fetched once for all checkout.session.completed handlers.
+        The handlers may run at the same time, a lookup that is in progress is waited for.
+    """
+
+    _missing = object()
+
+    def __init__(self, event):
+        self.event = event
+        self.cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key, func, *args, **kwargs):
+        """ Returns the cached result of func for the key, or calls func and caches the result. """
+
+        value = self.cache.get(key, self._missing)
+        if value is not self._missing:
+            return value
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            value = self.cache.get(key, self._missing)
+            if value is self._missing:
+                value = self.cache[key] = func(*args, **kwargs)
+        return value
+
+    def get_user(self):
+        """ Returns the user of the Stripe customer of the event, or None. """
+
+        from modules.payments.utils import get_user_by_stripe_customer_id
+        return self.lookup('user', get_user_by_stripe_customer_id, getattr(self.event['data']['object'], 'customer', None))
+
+    def get_line_items(self) -> list:
+        """ Returns the line items of the checkout session of the event. """
+
+        from modules.payments.utils import get_line_items_for_checkout
+        return self.lookup('line_items', get_line_items_for_checkout, self.event['data']['object']['id'])
+
+def record_webhook_handler_timing(name: str, seconds: float, failed: bool = False) -> None:
+    """ Counts the runs of a webhook handler per duration bucket and minute, for get_webhook_handler_metrics. """
+
+    from modules.payments.client import _get_redis
+
+    redis = _get_redis()
+    if redis is None:
+        return
+
+    milliseconds = seconds * 1000
+    bucket = next((str(bound) for bound in HANDLER_TIMING_BUCKETS if milliseconds <= bound), 'inf')
+    minute = int(time.time() // 60)
+
+    pipeline = redis.pipeline()
+    for field in [f'le_{bucket}', 'failed'] if failed else [f'le_{bucket}']:
+        key = f'stripe_webhook_handler_metrics:{name}:{field}:{minute}'
+        pipeline.incr(key)
+        pipeline.expire(key, METRICS_RETENTION_MINUTES * 60)
+    pipeline.execute()
+
+def get_webhook_handler_metrics(minutes: int = 5) -> dict:
+    """ Returns the duration histogram (runs per bucket, in milliseconds) and the failed runs per webhook handler over the last minutes.
+
+        :param minutes: The amount of minutes to compute the metrics over (max. METRICS_RETENTION_MINUTES).
+        :type minutes: int
+        :return: The metrics per handler, empty if the task queue doesn't use Redis.
+        :rtype: dict
+    """
+
+    from modules.payments.client import _get_redis
+
+    redis = _get_redis()
+    if redis is None:
+        return {}
+
+    current_minute = int(time.time() // 60)
+    minute_range = range(current_minute - min(minutes, METRICS_RETENTION_MINUTES) + 1, current_minute + 1)
+    names = sorted({key.decode().split(':')[1] for key in redis.scan_iter('stripe_webhook_handler_metrics:*')})
+
+    def count(name, field):
+        keys = [f'stripe_webhook_handler_metrics:{name}:{field}:{minute}' for minute in minute_range]
+        return sum(int(value) for value in redis.mget(keys) if value)
+
+    metrics = {}
+    for name in names:
+        histogram = {str(bound) : count(name, f'le_{bound}') for bound in HANDLER_TIMING_BUCKETS}
+        histogram['inf'] = count(name, 'le_inf')
+        metrics[name] = {
+            'runs' : sum(histogram.values()),
+            'failed' : count(name, 'failed'),
+            'histogram' : histogram,
+        }
+
+    return metrics
+
+webhook_dispatcher = WebhookDispatcher()
+
+def receive(event_type, depends_on: list | None = None, retries: int = 0, retry_delay: float = 0):
+    """ Registers the decorated function as handler of the event type (see WebhookDispatcher). """
 
-def receive(event_type):
     def decorator(func):
-        if event_type not in webhook_handlers:
-            webhook_handlers[event_type] = []
-        webhook_handlers[event_type].append(func)
+        webhook_dispatcher.register(event_type, func, depends_on=depends_on, retries=retries, retry_delay=retry_delay)
         return func
     return decorator
 
-def handle_event(event):
-    event_type = event['type']
-    handlers = webhook_handlers.get(event_type, [])
-    for handler in handlers:
-        handler(event)
\ No newline at end of file
+def handle_event(event, context: WebhookEventContext | None = None, completed=(), on_complete=None) -> WebhookDispatchResult:
+    return webhook_dispatcher.dispatch(event, context=context, completed=completed, on_complete=on_complete)
@@ -1,12 +1,18 @@
 from .webhook_handler import receive
 from django.contrib.auth import get_user_model
 from modules.billing.utils import get_subscription_by_price_id, get_credit_package_by_price_id
-from modules.payments.utils import get_user_by_stripe_customer_id, get_line_items_for_checkout, create_stripe_invoice_for_price_for_user
+from modules.payments.utils import create_stripe_invoice_for_price_for_user, get_subscription_fields_for_stripe_subscription
+from modules.payments.client import stripe_client
 
 from modules.billing.models import StripeInvoice
 
 from django.utils.translation import gettext_lazy as _
 
+@receive('customer.updated')
+@receive('customer.deleted')
+def invalidate_cached_customer(event, **kwargs):
+    stripe_client.invalidate_customer(event['data']['object']['id'])
+
 @receive('customer.deleted')
 def delete_customer(event, **kwargs):
     customer_data = event['data']['object']
@@ -16,9 +22,9 @@ def delete_customer(event, **kwargs):
         user.save()
 
 @receive('invoice.paid')
-def paid_invoice(event, **kwargs):
+def paid_invoice(event, context, **kwargs):
     invoice_data = event['data']['object']
-    user = get_user_model().objects.filter(stripe_customer_id=invoice_data['customer']).first()
+    user = context.get_user()
     if user and not user.subscription.lifetime:
         user.subscription.current_period_start = invoice_data['lines']['data'][0]['period']['start']
         user.subscription.current_period_end = invoice_data['lines']['data'][0]['period']['end']
@@ -26,55 +32,45 @@ def paid_invoice(event, **kwargs):
 
 @receive('customer.subscription.created')
 @receive('customer.subscription.updated')
-def create_or_update_subscription(event, **kwargs):
-    subscription_data = event['data']['object']
-    try:
-        subscription = get_subscription_by_price_id(subscription_data['items']['data'][0]['price']['id'])
-    except:
-        return
-    
-    if not subscription:
+def create_or_update_subscription(event, context, **kwargs):
+    fields = get_subscription_fields_for_stripe_subscription(event['data']['object'])
+    if not fields:
         return
 
-    user = get_user_model().objects.filter(stripe_customer_id=subscription_data['customer']).first()
+    user = context.get_user()
     if user:
-        user.subscription.stripe_subscription_id = subscription_data['id']
-        user.subscription.stripe_status = subscription_data['status']
-
-        user.subscription.subscription_key = subscription['key']
-        user.subscription.starts = subscription_data['start_date']
-        user.subscription.current_period_start = subscription_data['current_period_start']
-        user.subscription.current_period_end = subscription_data['current_period_end']
-        user.subscription.cancel_at_period_end = subscription_data['cancel_at_period_end']
-        user.subscription.lifetime = False # Stripe subscriptions are never lifetime
+        for field, value in fields.items():
+            setattr(user.subscription, field, value)
 
         user.subscription.save()
 
 @receive('customer.subscription.deleted')
-def delete_subscription(event, **kwargs):
-    subscription_data = event['data']['object']
-    user = get_user_model().objects.filter(stripe_customer_id=subscription_data['customer']).first()
+def delete_subscription(event, context, **kwargs):
+    user = context.get_user()
     if user:
         user.subscription.reset_to_default()
 
 @receive('invoice.finalized')
-def add_invoice(event, **kwargs):
+def add_invoice(event, context, **kwargs):
     invoice_data = event['data']['object']
-    user = get_user_by_stripe_customer_id(invoice_data['customer'])
+    user = context.get_user()
     if user:
-        StripeInvoice.objects.create(
+        # Also when the event is processed again (e.g. after a failure), the invoice is only added once
+        StripeInvoice.objects.get_or_create(
             user=user,
             stripe_id=invoice_data['id'],
-            number=invoice_data['number'],
-            hosted_invoice_url=invoice_data['hosted_invoice_url']
+            defaults={
+                'number' : invoice_data['number'],
+                'hosted_invoice_url' : invoice_data['hosted_invoice_url'],
+            }
         )
 
 @receive('checkout.session.completed')
-def create_onetime_subscription(event, **kwargs):
+def create_onetime_subscription(event, context, **kwargs):
     session_data = event['data']['object']
-    user = get_user_by_stripe_customer_id(session_data['customer'])
+    user = context.get_user()
 
-    line_items = get_line_items_for_checkout(session_data['id'])
+    line_items = context.get_line_items() # Fetched once for all checkout.session.completed handlers
     if len(line_items) == 0 or 'price' not in line_items[0]:
         return
     
@@ -101,11 +97,10 @@ def create_onetime_subscription(event, **kwargs):
         create_stripe_invoice_for_price_for_user(user, line_items[0]['price']['id'], mark_paid=True)
 
 @receive('checkout.session.completed')
-def add_credits_to_user(event, **kwargs):
-    session_data = event['data']['object']
-    user = get_user_by_stripe_customer_id(session_data['customer'])
+def add_credits_to_user(event, context, **kwargs):
+    user = context.get_user()
 
-    line_items = get_line_items_for_checkout(session_data['id'])
+    line_items = context.get_line_items()
     if len(line_items) == 0 or 'price' not in line_items[0]:
         return
     
@@ -115,7 +110,6 @@ def add_credits_to_user(event, **kwargs):
 
     if user:
         user.add_credits(credit_package['credits'], _(f'Bought {credit_package["credits"]} credits for {credit_package["price"]["currency_symbol"]} {credit_package["price"]["value"]} '))
-        user.save()
 
         # Request Stripe to create an invoice (this is not done automatically for one-time payments)
         create_stripe_invoice_for_price_for_user(user, line_items[0]['price']['id'], mark_paid=True)
\ No newline at end of file
@@ -1,7 +1,8 @@
 # Power on self test
 # Path: base/base/urls.py
 
-from CONFIG.billing import SUBSCRIPTIONS, BILLING_MODEL, CREDIT_PACKAGES
+from CONFIG.billing import BILLING_MODEL
+from modules.billing.catalog import BILLING_CATALOG
 from CONFIG.emails import EMAIL_PROVIDER, SENDGRID_API_KEY
 from CONFIG.secrets import SECRETS_MANAGER, INFISICAL_PROJECT_ID, INFISICAL_CLIENT_ID, INFISICAL_CLIENT_SECRET, INFISICAL_ENVIRONMENT, AWS_SECRET_NAME, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION, AZURE_CLIENT_ID, AZURE_TENANT_ID, AZURE_CLIENT_SECRET, AZURE_KEY_VAULT_NAME
 
@@ -23,54 +24,13 @@ class PowerOnSelfTest:
 
     def test_billing(self):
         billing_errors = []
-        default_subscription = None
 
         ## Check BILLING_MODEL
         if BILLING_MODEL not in ['subscriptions', 'credits', 'both', 'none']:
             billing_errors.append(f'Invalid value for BILLING_MODEL: {BILLING_MODEL}. The value of BILLING_MODEL should be "subscriptions", "credits" or "both".')
 
-        ## If BILLING_MODEL is 'subscriptions' or 'both', check that SUBSCRIPTIONS is not empty
-        if BILLING_MODEL in ['subscriptions', 'both']:
-            if len(SUBSCRIPTIONS) == 0:
-                billing_errors.append('No subscription plans found. Please add at least one subscription plan to the SUBSCRIPTIONS list in CONFIG/subscriptions.py.')
-
-            # Check that each subscription has the required keys
-            for subscription in SUBSCRIPTIONS:
-                required_keys = ['key', 'name', 'description', 'icon', 'price', 'show']
-                for key in required_keys:
-                    if key not in subscription:
-                        billing_errors.append(f'Subscription with key "{subscription["key"]}" is missing the key "{key}".')
-
-                if 'price' in subscription:
-                    if 'value' not in subscription['price']:
-                        billing_errors.append(f'Subscription with key "{subscription["key"]}" is missing the key "value" in the price dictionary.')
-                    if 'currency_symbol' not in subscription['price']:
-                        billing_errors.append(f'Subscription with key "{subscription["key"]}" is missing the key "currency_symbol" in the price dictionary.')
-
-                if subscription['key'] == 'default':
-                    default_subscription = subscription
-            
-            if default_subscription is None:
-                billing_errors.append('No subscription with key "default" found. Please add a subscription with the key "default" to the SUBSCRIPTIONS list in CONFIG/subscriptions.py.')
-        
-        # If BILLING_MODEL is 'credits' or 'both', check that CREDIT_PACKAGES is not empty
-        if BILLING_MODEL in ['credits', 'both']:
-            if len(CREDIT_PACKAGES) == 0:
-                billing_errors.append('No credit packages found. Please add at least one credit package to the CREDIT_PACKAGES list in CONFIG/subscriptions.py.')
-
-            # Check that each credit package has the required keys
-            for credit_package in CREDIT_PACKAGES:
-                required_keys = ['key', 'name', 'description', 'price']
-                for key in required_keys:
-                    if key not in credit_package:
-                        billing_errors.append(f'Credit package with key "{credit_package["key"]}" is missing the key "{key}".')
-                
-                if 'price' in credit_package:
-                    if 'value' not in credit_package['price']:
-                        billing_errors.append(f'Credit package with key "{credit_package["key"]}" is missing the key "value" in the price dictionary.')
-                    if 'currency_symbol' not in credit_package['price']:
-                        billing_errors.append(f'Credit package with key "{credit_package["key"]}" is missing the key "currency_symbol" in the price dictionary.')
-
+        ## Check the subscriptions and credit packages of the billing model (required keys, the default subscription, unique keys and price IDs)
+        billing_errors.extend(BILLING_CATALOG.validate(BILLING_MODEL))
 
         self.ran_tests.append('test_billing')
         if len(billing_errors) > 0:
@@ -58,7 +58,7 @@ function initDynamicTable(table) {
                 addSearchField(table);
                 addSortOptions(table, data.sort_options, data.sort_default);
                 addPerPageOptions(table, data.per_page);
-                addPaginationControls(table, data.page, data.num_pages, data.per_page, data.total);
+                addTablePagination(table, data);
             } else {
                 table.querySelector('thead').remove();
             }
@@ -178,6 +178,66 @@ function addSearchField(table) {
     wrapper.appendChild(searchField);
 }
 
+/**
+ * Adds the pagination controls that match the pagination mode of the table data ('page' or 'cursor').
+ * @param {HTMLTableElement} table The table to add pagination controls to.
+ * @param {Object} data The table data returned from the server.
+ */
+function addTablePagination(table, data) {
+    if (data.pagination == 'cursor') {
+        addCursorPaginationControls(table, data.prev_cursor, data.next_cursor, data.total);
+    } else {
+        addPaginationControls(table, data.page, data.num_pages, data.per_page, data.total);
+    }
+}
+
+/**
+ * Adds previous and next controls below a table that is paginated with a cursor.
+ * The cursors are opaque tokens returned by the server, which point to the previous and next page.
+ */
+function addCursorPaginationControls(table, prevCursor, nextCursor, totalItems) {
+    const wrapper = table.parentNode.querySelector('div.table-bottom');
+    const paginationWrapper = document.createElement('div');
+    paginationWrapper.classList.add('pagination', 'flex', 'justify-center', 'space-x-2', 'mt-4');
+
+    const createCursorButton = (cursor, text) => {
+        const pageButton = document.createElement('button');
+        pageButton.type = 'button';
+        pageButton.textContent = text;
+        pageButton.classList.add('page-btn', 'px-4', 'py-2', 'rounded-2xl', 'bg-primary-light', 'text-primary');
+        pageButton.addEventListener('click', (event) => {
+            event.preventDefault();
+            searchAndSortTable(table, 1, cursor);
+        });
+        return pageButton;
+    };
+
+    if (prevCursor) {
+        paginationWrapper.appendChild(createCursorButton(prevCursor, 'Previous'));
+    }
+
+    if (nextCursor) {
+        paginationWrapper.appendChild(createCursorButton(nextCursor, 'Next'));
+    }
+
+    const existingPagination = wrapper.querySelector('.pagination');
+    if (existingPagination) {
+        existingPagination.remove();
+    }
+
+    const showingItemsWrapper = document.createElement('div');
+    showingItemsWrapper.textContent = `${totalItems} items`;
+    showingItemsWrapper.classList.add('showing-items', 'text-sm', 'text-slate-500');
+
+    const existingShowingItems = wrapper.querySelector('.showing-items');
+    if (existingShowingItems) {
+        existingShowingItems.remove();
+    }
+
+    wrapper.appendChild(showingItemsWrapper);
+    wrapper.appendChild(paginationWrapper);
+}
+
 /**
  * Adds pagination controls below the table.
  */
@@ -290,8 +350,9 @@ function addPerPageOptions(table, perPageDefault) {
 
 /**
  * Fetches the table data from the server and populates the table with the returned data.
+ * For tables that are paginated with a cursor, the cursor of the requested page is passed instead of the page number.
  */
-function searchAndSortTable(table, page = 1) {
+function searchAndSortTable(table, page = 1, cursor = undefined) {
     populateTable(table, generateTableSkeletonHTML());
     let url = table.getAttribute('data-url');
     let params = new URLSearchParams();
@@ -317,12 +378,16 @@ function searchAndSortTable(table, page = 1) {
 
     params.set('page', page);
 
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+
     const full_url = url + '?' + params.toString();
     fetch(full_url, getFetchInit('GET'))
         .then(response => response.json())
         .then(data => {
             populateTable(table, data.html);
-            addPaginationControls(table, data.page, data.num_pages, data.per_page, data.total);
+            addTablePagination(table, data);
             initClickableRows(table);
         });
 
@@ -59,4 +59,65 @@ function checkFileTaskStatus(taskId, successCallback = undefined) {
                 }
             }
         })
-}
\ No newline at end of file
+}
+
+/**
+ * Check the status of an export job (see BackgroundExportMixin).
+ * While the job is running, the progress callback is called with the progress percentage. If the job has been completed, the file will be downloaded.
+ * The progress is also sent to the user socket with the 'export_progress' action.
+ * @param {string} taskId - The id of the task.
+ * @param {function} successCallback - The function that will be called when the job is completed.
+ * @param {function} progressCallback - The function that will be called with the progress percentage (0-100).
+ * @returns {void}
+ * @example
+ * checkExportJobStatus('d8f7b5c9-4e0c-4d1e-8e6b-4c7f5a2b3a6e', undefined, progress => console.log(progress));
+ */
+function checkExportJobStatus(taskId, successCallback = undefined, progressCallback = undefined) {
+
+    fetch(`/swd/utils/export-job-status/${taskId}/`)
+        .then(response => {
+            if (response.status === 200) {
+                const contentDisposition = response.headers.get('Content-Disposition');
+                let filename = 'downloaded_file';
+
+                if (contentDisposition) {
+                    const matches = contentDisposition.match(/filename=([^;]+)/);
+                    if (matches && matches[1]) {
+                        filename = matches[1].trim();
+                    }
+                }
+
+                return response.blob().then(blob => {
+                    var url = URL.createObjectURL(blob);
+                    var a = document.createElement('a');
+                    a.href = url;
+                    a.download = filename;
+                    document.body.appendChild(a);
+                    a.click();
+                    a.remove();
+                    URL.revokeObjectURL(url);
+
+                    if (progressCallback) {
+                        progressCallback(100);
+                    }
+
+                    if (successCallback) {
+                        successCallback();
+                    }
+                });
+            }
+
+            return response.json().then(data => {
+                if (data.state !== 'PENDING') {
+                    console.log(`Export job ${taskId} failed: ${data.error}`);
+                    return;
+                }
+
+                if (progressCallback) {
+                    progressCallback(data.progress);
+                }
+
+                setTimeout(() => checkExportJobStatus(taskId, successCallback, progressCallback), 2000);
+            });
+        })
+}
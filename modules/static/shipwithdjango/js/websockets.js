@@ -55,7 +55,8 @@ function returnWSProtocol() {
  */
 function initWebsocket(route, onOpenFunc=undefined, actionFunc=undefined) {
     const protocol = returnWSProtocol();
-    const connection_string = `${protocol}//${window.location.host}/ws/${route}/`;
+    // The socket subscribes to the messages of this page, messages for other pages are dropped by the server.
+    const connection_string = `${protocol}//${window.location.host}/ws/${route}/?page_id=${encodeURIComponent(WS_PAGE_ID)}`;
     let socket = new WebSocket(connection_string);
 
     socket.onopen = function open() {
@@ -99,6 +100,29 @@ function initWebsocket(route, onOpenFunc=undefined, actionFunc=undefined) {
     return socket;
 }
 
+/**
+ * Subscribes the socket to the messages of more pages (e.g. when the page shows the content of another page).
+ * Messages for 'all_pages' are always received.
+ * @param {Object} socket - The websocket object.
+ * @param {string[]} pageIds - The page ids to subscribe to.
+ * @returns {void}
+ * @example
+ * subscribeToPages(userSocket, ['3j4k5l6m7']);
+ */
+function subscribeToPages(socket, pageIds) {
+    socket.send(JSON.stringify({event: 'subscribe', page_ids: pageIds}));
+}
+
+/**
+ * Unsubscribes the socket from the messages of pages.
+ * @param {Object} socket - The websocket object.
+ * @param {string[]} pageIds - The page ids to unsubscribe from.
+ * @returns {void}
+ */
+function unsubscribeFromPages(socket, pageIds) {
+    socket.send(JSON.stringify({event: 'unsubscribe', page_ids: pageIds}));
+}
+
 /**
  * Gets called when the user socket is opened.
  * @param {Object} socket - The websocket object.
@@ -1,5 +1,8 @@
 import ast
 import os
+import hashlib
+
+from django.utils.functional import Promise
 
 def format_value(value: str) -> str | bool | int | float:
     """ Convert the string value to its appropriate Python data type. """
@@ -60,4 +63,28 @@ def set_config_value(config_type: str, config_key: str , config_value: str, fail
     
     # Write the updated content back to the config file
     with open(config_file_path, 'w') as file:
-        file.writelines(lines)
\ No newline at end of file
+        file.writelines(lines)
+
+def _fingerprint(value):
+    """ Returns a representation of the value that is the same in every process.
+        Translated strings are represented by their untranslated text, so the fingerprint doesn't depend on the language.
+    """
+
+    if isinstance(value, dict):
+        return tuple(sorted((str(key), _fingerprint(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(item) for item in value)
+    if isinstance(value, Promise):
+        return value._args # The arguments of the lazy translation (the untranslated text)
+    return value
+
+def get_config_version(value) -> str:
+    """ Returns a hash of a config value (e.g. the SUBSCRIPTIONS list), which changes whenever the value is changed.
+        Use it in cache keys, so cached data that is computed from the config is not used anymore after the config changes.
+
+        :param value: The config value (dictionaries, lists, tuples, translated strings and other values with a stable repr).
+        :return: The version of the value.
+        :rtype: str
+    """
+
+    return hashlib.sha256(repr(_fingerprint(value)).encode('utf-8')).hexdigest()[:12]
@@ -0,0 +1,193 @@
+import csv
+import json
+import itertools
+import zipfile
+from typing import AsyncIterator, Iterable, Iterator
+from xml.sax.saxutils import escape
+
+from asgiref.sync import sync_to_async
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
+
+EXPORT_FORMATS = ['xlsx', 'csv', 'ndjson']
+EXPORT_CONTENT_TYPES = {
+    'xlsx' : 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv' : 'text/csv; charset=utf-8',
+    'ndjson' : 'application/x-ndjson; charset=utf-8',
+}
+EXPORT_BLOCK_SIZE = 64 * 1024 # Size (in bytes) of the blocks that are yielded to the response or written to storage
+
+class _Echo:
+    """ File-like object that returns what is written to it, so csv.writer can be used as a generator. """
+
+    def write(self, value):
+        return value
+
+def _buffered(chunks: Iterable[bytes], block_size: int = EXPORT_BLOCK_SIZE) -> Iterator[bytes]:
+    """ Groups small chunks into blocks of (at least) block_size bytes, to avoid sending one chunk per row. """
+
+    buffer = []
+    buffered_size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= block_size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered_size = 0
+
+    if buffer:
+        yield b''.join(buffer)
+
+def iter_csv(headers: list, rows: Iterable[list]) -> Iterator[bytes]:
+    """ Yields the rows as CSV, encoded as UTF-8. """
+
+    writer = csv.writer(_Echo())
+    yield writer.writerow(headers).encode('utf-8')
+    for row in rows:
+        yield writer.writerow(row).encode('utf-8')
+
+def iter_ndjson(headers: list, rows: Iterable[list]) -> Iterator[bytes]:
+    """ Yields the rows as newline delimited JSON objects, using the headers as keys. """
+
+    for row in rows:
+        yield (json.dumps(dict(zip(headers, row)), default=str) + '\n').encode('utf-8')
+
+XLSX_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_PARTS = {
+    '[Content_Types].xml' : (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels' : (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml' : (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<workbook xmlns="{XLSX_NAMESPACE}" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels' : (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/styles.xml' : (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<styleSheet xmlns="{XLSX_NAMESPACE}">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+
+class _ZipStream:
+    """ Write-only, non-seekable file for zipfile. What is written is kept until it's taken with pop(). """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def _xlsx_cell(reference: str, value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{reference}" t="n"><v>{value}</v></c>'
+
+    value = escape(ILLEGAL_CHARACTERS_RE.sub('', str(value)))
+    return f'<c r="{reference}" t="inlineStr"><is><t xml:space="preserve">{value}</t></is></c>'
+
+def iter_xlsx(headers: list, rows: Iterable[list], block_size: int = EXPORT_BLOCK_SIZE) -> Iterator[bytes]:
+    """ Yields an xlsx file (with one sheet) while the rows are read.
+
+        The sheet is written row by row into a zip file that isn't seekable, so the compressed bytes
+        can be yielded as soon as there are block_size of them. Memory usage stays flat regardless of the amount of rows,
+        and the first bytes are sent before the last row is read.
+    """
+
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><worksheet xmlns="{XLSX_NAMESPACE}"><sheetData>'.encode('utf-8'))
+
+            columns = []
+            for row_number, row in enumerate(itertools.chain([headers], rows), start=1):
+                while len(columns) < len(row):
+                    columns.append(get_column_letter(len(columns) + 1))
+
+                cells = ''.join(_xlsx_cell(f'{column}{row_number}', value) for column, value in zip(columns, row))
+                sheet.write(f'<row r="{row_number}">{cells}</row>'.encode('utf-8'))
+                if len(stream.buffer) >= block_size:
+                    yield stream.pop()
+
+            sheet.write(b'</sheetData></worksheet>')
+
+    yield stream.pop()
+
+def iter_export(export_format: str, headers: list, rows: Iterable[list]) -> Iterator[bytes]:
+    """ Yields the export file in blocks for the given format.
+
+        :param export_format: The format of the export. One of EXPORT_FORMATS.
+        :type export_format: str
+        :param headers: The column headers.
+        :type headers: list
+        :param rows: An iterable with the (already formatted) rows.
+        :type rows: Iterable[list]
+        :return: An iterator with the file content in blocks.
+        :rtype: Iterator[bytes]
+    """
+
+    if export_format == 'xlsx':
+        return iter_xlsx(headers, rows)
+    elif export_format == 'csv':
+        return _buffered(iter_csv(headers, rows))
+    elif export_format == 'ndjson':
+        return _buffered(iter_ndjson(headers, rows))
+
+    raise ValueError(f'Invalid export format: {export_format}. The export format should be one of: {", ".join(EXPORT_FORMATS)}.')
+
+async def aiter_blocks(blocks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """ Yields the blocks of a (sync) iterator from an async context, reading every block in a thread with sync_to_async.
+
+        Under ASGI, Django reads a sync iterator of a StreamingHttpResponse into a list before sending it, so the whole file would be in memory.
+        All blocks are read in the same thread, so the database cursor of a queryset iterator can be used.
+    """
+
+    blocks = iter(blocks)
+    try:
+        while (block := await sync_to_async(next)(blocks, None)) is not None:
+            yield block
+    finally:
+        close = getattr(blocks, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
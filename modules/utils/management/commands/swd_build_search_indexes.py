@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from modules.views import get_table_views
+
+class Command(BaseCommand):
+    help = 'Creates (or drops) the search indexes of all DynamicTableData views that use an index-backed search backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Drop and recreate the indexes')
+        parser.add_argument('--drop', action='store_true', help='Only drop the indexes (and generated search columns)')
+
+    def index_exists(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+            return cursor.fetchone() is not None
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Search indexes are only supported on PostgreSQL.')
+
+        for view_class in get_table_views():
+            if view_class.search_backend == 'icontains' or not view_class.search_fields:
+                continue
+
+            if view_class.model is None:
+                self.stdout.write(self.style.WARNING(f'Skipping {view_class.__name__}: the model attribute is required to build search indexes.'))
+                continue
+
+            backend = view_class().get_search_backend()
+            model = backend.model
+
+            # CREATE/DROP INDEX CONCURRENTLY can't run in a transaction, so the schema editor doesn't wrap the statements in one
+            with connection.schema_editor(atomic=False) as schema_editor:
+                if options['rebuild'] or options['drop']:
+                    for index in backend.get_indexes():
+                        if self.index_exists(index.name):
+                            schema_editor.remove_index(model, index, concurrently=True)
+                            self.stdout.write(f'Dropped index {index.name} ({view_class.__name__})')
+
+                    if options['drop']:
+                        for sql, params in backend.get_teardown_sql():
+                            schema_editor.execute(sql, params)
+                        continue
+
+                for sql, params in backend.get_setup_sql():
+                    schema_editor.execute(sql, params)
+
+                for index in backend.get_indexes():
+                    if self.index_exists(index.name):
+                        self.stdout.write(f'Index {index.name} already exists ({view_class.__name__})')
+                        continue
+
+                    schema_editor.add_index(model, index, concurrently=True)
+                    self.stdout.write(self.style.SUCCESS(f'Created index {index.name} ({view_class.__name__})'))
+
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE "{model._meta.db_table}"') # Update the planner statistics, so the new indexes are used
+
+        self.stdout.write(self.style.SUCCESS('Search indexes are up to date'))
@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from modules.views import get_cached_table_models, bump_table_version
+
+def invalidate_cached_table_data(sender, using=None, **kwargs):
+    """ Invalidates the cached data of the DynamicTableData views of the saved or deleted model.
+        The version is changed once the transaction is committed, so a request in the meantime can't cache the old rows under the new version.
+    """
+    if sender in get_cached_table_models():
+        transaction.on_commit(lambda: bump_table_version(sender), using=using)
+
+post_save.connect(invalidate_cached_table_data, dispatch_uid='invalidate_cached_table_data_on_save')
+post_delete.connect(invalidate_cached_table_data, dispatch_uid='invalidate_cached_table_data_on_delete')
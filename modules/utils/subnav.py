@@ -1,36 +1,83 @@
+import threading
+
+from django.urls import reverse, get_script_prefix
+from django.utils import translation
+
 from CONFIG.subnav import GLOBAL_SUBNAV
+from modules.billing.entitlements import Entitlements, get_entitlements
+from modules.utils.config import get_config_version
 
-def get_visible_subnav_for_user(user) -> dict:
-    ''' Get the visible subnav items for the user.
-    
-    This function will filter out the subnav items that are not visible to the user.
+# The visible subnav per (version, superuser, staff, subscription key, language, script prefix). There are only a handful of combinations.
+_subnav_cache = {}
+_subnav_cache_lock = threading.Lock()
+_subnav_version = None
+
+def get_subnav_version() -> str:
+    """ Returns the version of GLOBAL_SUBNAV. It's computed once per process, call invalidate_subnav_cache after changing GLOBAL_SUBNAV at runtime. """
+
+    global _subnav_version
+    if _subnav_version is None:
+        _subnav_version = get_config_version(GLOBAL_SUBNAV)
+    return _subnav_version
+
+def invalidate_subnav_cache() -> None:
+    """ Removes the computed subnavs, and computes the version of GLOBAL_SUBNAV again. """
+
+    global _subnav_version
+    with _subnav_cache_lock:
+        _subnav_cache.clear()
+        _subnav_version = None
+
+def build_visible_subnav(entitlements: Entitlements) -> list:
+    ''' Build the visible subnav items for the role flags and subscription of the entitlements.
+
+    This function will filter out the subnav items that are not visible, resolve the translated names (in the current language)
+    and resolve the URLs of the items.
     '''
 
     accessible_sections = []
-    
+
     for section in GLOBAL_SUBNAV:
         if section.get('is_active', True):
             accessible_items = []
-            
+
             for item in section['items']:
                 if item.get('is_active', True):
                     superuser_required = item.get('superuser_required', False)
-                    if superuser_required and not user.is_superuser:
+                    if superuser_required and not entitlements.is_superuser:
                         continue
 
                     staff_required = item.get('staff_required', False)
-                    if staff_required and not user.is_staff:
+                    if staff_required and not entitlements.is_staff:
                         continue
-                    
+
                     required_subs = item.get('required_subscription')
-                    if required_subs is None or (
-                        isinstance(required_subs, str) and required_subs == user.subscription.subscription_key) or (
-                        isinstance(required_subs, list) and user.subscription.subscription_key in required_subs):
-                        accessible_items.append(item)
-            
+                    if required_subs is None or entitlements.has_subscription(required_subs):
+                        new_item = {key : str(value) if key == 'name' else value for key, value in item.items()}
+                        new_item['url'] = reverse(item['url_name']) if item.get('url_name') else None
+                        accessible_items.append(new_item)
+
             if accessible_items:
                 new_section = section.copy()
+                new_section['name'] = str(section.get('name', ''))
                 new_section['items'] = accessible_items
                 accessible_sections.append(new_section)
-    
-    return accessible_sections
\ No newline at end of file
+
+    return accessible_sections
+
+def get_visible_subnav_for_user(user) -> list:
+    ''' Get the visible subnav items for the user.
+
+    The subnav only depends on the role flags and subscription of the user and the language, so it's built once per combination
+    (see build_visible_subnav) and shared by all users with that combination. The result must not be changed.
+    '''
+
+    entitlements = get_entitlements(user)
+    key = (get_subnav_version(), entitlements.is_superuser, entitlements.is_staff, entitlements.subscription_key, translation.get_language(), get_script_prefix())
+
+    subnav = _subnav_cache.get(key)
+    if subnav is None:
+        subnav = build_visible_subnav(entitlements)
+        with _subnav_cache_lock:
+            _subnav_cache[key] = subnav
+    return subnav
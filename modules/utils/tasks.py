@@ -0,0 +1,78 @@
+import datetime
+from huey import crontab
+from huey.contrib.djhuey import task, periodic_task, HUEY
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from CONFIG.task_queue import EXPORT_JOB_DIRECTORY, EXPORT_JOB_FILES_MAX_AGE_HOURS
+from modules.websockets.utils import send_websocket_message_to_user
+
+EXPORT_PROGRESS_ACTION = 'export_progress'
+
+def get_export_job_checkpoint_key(task_id: str) -> str:
+    """ Returns the key under which the checkpoint of an export job is stored in the Huey storage. """
+    return f'export_job_checkpoint_{task_id}'
+
+def get_export_job_checkpoint(task_id: str) -> dict | None:
+    """ Returns the checkpoint of an export job, or None if the job hasn't started yet. """
+    return HUEY.get(get_export_job_checkpoint_key(task_id), peek=True)
+
+def set_export_job_checkpoint(task_id: str, checkpoint: dict) -> None:
+    """ Stores the checkpoint of an export job. """
+    HUEY.put(get_export_job_checkpoint_key(task_id), checkpoint)
+
+@task(retries=3, retry_delay=60, context=True)
+def run_export_job(view_path: str, user_id: int, query_string: str = '', view_kwargs: dict = None, page_id: str = 'all_pages', task=None) -> str:
+    """ (Task queue) Run an ExcelModelExport or PDFExport view in the background and return the file path.
+
+        The view is set up with a GET request for the user, so get_queryset and get_context work as they do in the request.
+        The progress is stored in a checkpoint and sent to the user's websocket group. When the task is retried, the export resumes from the checkpoint.
+    """
+
+    user = get_user_model().objects.get(pk=user_id)
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.user = user
+    request.GET = QueryDict(query_string)
+
+    view = import_string(view_path)()
+    view.setup(request, **(view_kwargs or {}))
+
+    checkpoint = get_export_job_checkpoint(task.id) or {'user_id': user_id, 'progress': 0}
+
+    def on_progress(checkpoint, progress):
+        checkpoint['progress'] = progress
+        set_export_job_checkpoint(task.id, checkpoint)
+        send_websocket_message_to_user(user, EXPORT_PROGRESS_ACTION, {'task_id': task.id, 'progress': progress}, page_id, coalesce_key=task.id)
+
+    set_export_job_checkpoint(task.id, checkpoint)
+    return view.write_to_storage(f'{EXPORT_JOB_DIRECTORY}/{task.id}', checkpoint, on_progress)
+
+@periodic_task(crontab(minute='0'))
+def remove_expired_export_files() -> None:
+    """ (Task queue) Remove the files, results and checkpoints of export jobs older than EXPORT_JOB_FILES_MAX_AGE_HOURS. """
+
+    if not default_storage.exists(EXPORT_JOB_DIRECTORY):
+        return
+
+    expires_before = timezone.now() - datetime.timedelta(hours=EXPORT_JOB_FILES_MAX_AGE_HOURS)
+    task_ids, _ = default_storage.listdir(EXPORT_JOB_DIRECTORY)
+
+    for task_id in task_ids:
+        directory = f'{EXPORT_JOB_DIRECTORY}/{task_id}'
+        _, file_names = default_storage.listdir(directory)
+
+        file_paths = [f'{directory}/{file_name}' for file_name in file_names]
+        if any(default_storage.get_modified_time(file_path) > expires_before for file_path in file_paths):
+            continue
+
+        for file_path in file_paths:
+            default_storage.delete(file_path)
+        default_storage.delete(directory)
+
+        HUEY.delete(get_export_job_checkpoint_key(task_id))
+        HUEY.delete(task_id) # The result of the task
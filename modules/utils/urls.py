@@ -4,4 +4,5 @@ from . import views
 
 urlpatterns = [
     path('check-file-task-status/<str:task_id>/', views.HueyCheckFileTaskStatus.as_view(), name='check-file-task-status'),
+    path('export-job-status/<str:task_id>/', views.ExportJobStatus.as_view(), name='export-job-status'),
 ]
\ No newline at end of file
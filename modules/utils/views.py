@@ -6,6 +6,8 @@ import os
 
 from huey.contrib.djhuey import HUEY
 
+from modules.utils.tasks import get_export_job_checkpoint
+
 class HueyCheckFileTaskStatus(LoginRequiredMixin, View):
     """ View to check the status of a file task. 
         If the task is completed, the file will be downloaded.
@@ -13,13 +15,19 @@ class HueyCheckFileTaskStatus(LoginRequiredMixin, View):
         NOTE: This only works if Huey is configured to store the results and the result of the task is the file path to download.
     """
 
+    delete_after_download = True
+
+    def get_pending_response(self, task_id):
+        """ Returns the response when the task is not completed yet """
+        return JsonResponse({'state': 'PENDING'}, status=202)
+
     def get(self, request, *args, **kwargs):
         task_id = kwargs.get('task_id', None)
         if not task_id:
             return HttpResponseBadRequest()
         
         try:
-            file_path = HUEY.result(task_id)
+            file_path = HUEY.result(task_id, preserve=not self.delete_after_download)
         except Exception as e:
             return JsonResponse({'state': 'ERROR', 'error': str(e)}, status=500)
         
@@ -29,10 +37,34 @@ class HueyCheckFileTaskStatus(LoginRequiredMixin, View):
                 response['Content-Disposition'] = f'attachment; filename={os.path.basename(file_path)}'
                 
                 # The data has already been placed in the response, so we can delete the file
-                default_storage.delete(file_path)
+                if self.delete_after_download:
+                    default_storage.delete(file_path)
                 
                 return response
             else:
                 return HttpResponseNotFound('File not found')
         else:
-            return JsonResponse({'state': 'PENDING'}, status=202)
\ No newline at end of file
+            return self.get_pending_response(task_id)
+
+class ExportJobStatus(HueyCheckFileTaskStatus):
+    """ View to check the status of an export job (see modules.views.BackgroundExportMixin).
+        While the job is running, the progress percentage is returned. If the job is completed, the file will be downloaded.
+
+        The file is kept after the download and removed by the remove_expired_export_files task.
+    """
+
+    delete_after_download = False
+
+    def get_pending_response(self, task_id):
+        checkpoint = get_export_job_checkpoint(task_id) or {}
+        return JsonResponse({'state': 'PENDING', 'progress': checkpoint.get('progress', 0)}, status=202)
+
+    def get(self, request, *args, **kwargs):
+        checkpoint = get_export_job_checkpoint(kwargs.get('task_id', None))
+
+        # Only the user that started the job can download the file. The checkpoint is stored when the job is queued,
+        # so a job without a checkpoint is unknown (or removed by remove_expired_export_files).
+        if not checkpoint or checkpoint.get('user_id') != request.user.id:
+            return HttpResponseNotFound('File not found')
+
+        return super().get(request, *args, **kwargs)
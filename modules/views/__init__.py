@@ -1,17 +1,127 @@
 from django.template.loader import render_to_string
 from django.views import View
-from django.http import JsonResponse
-from django.db.models import Q
+from django.http import JsonResponse, HttpResponseNotModified
+from django.db.models import Q, F
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.urls import get_resolver, URLResolver
+from django.utils import translation
 
+import os
+import json
+import hashlib
 import datetime
+import uuid
+import tempfile
+import functools
 import tablib
 
 from modules.utils.pdf import render_to_pdf_file
+from modules.utils.export import iter_export, aiter_blocks, EXPORT_CONTENT_TYPES
+from modules.views.search import SEARCH_BACKENDS
+
+CURSOR_SALT = 'modules.views.DynamicTableData.cursor'
+
+def get_table_version(model) -> str:
+    """ Returns the version of the table data of a model. The version changes when a row is saved or deleted. """
+    cache_key = f'dynamic_table_version_{model._meta.label_lower}'
+    version = cache.get(cache_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(cache_key, version, None): # Another process set the version in the meantime
+            version = cache.get(cache_key, version)
+    return version
+
+def bump_table_version(model) -> None:
+    """ Changes the version of the table data of a model, which invalidates the cached table data.
+        This is done automatically when a row is saved or deleted. Call it after bulk operations that don't send signals (e.g. bulk_create or update).
+    """
+    cache.set(f'dynamic_table_version_{model._meta.label_lower}', uuid.uuid4().hex, None)
+
+def get_keyset_ordering(queryset) -> list[tuple[str, bool]]:
+    """ Returns the ordering of the queryset as (field, descending) pairs, ending with the primary key so the order is unique.
+        Falls back to the primary key if the queryset is ordered by expressions.
+    """
+
+    ordering = queryset.query.order_by or (queryset.model._meta.ordering if queryset.query.default_ordering else [])
+    if not all(isinstance(field, str) and field.lstrip('-') and field != '?' for field in ordering):
+        return [('pk', False)]
+
+    pk_names = {'pk', queryset.model._meta.pk.name, queryset.model._meta.pk.attname}
+    keyset = []
+    for field in ordering:
+        name, descending = field.lstrip('-'), field.startswith('-')
+        if name in pk_names:
+            return keyset + [('pk', descending)]
+        keyset.append((name, descending))
+    return keyset + [('pk', False)]
+
+def get_keyset_order_by(keyset: list[tuple[str, bool]]) -> list:
+    """ Returns the order_by arguments for the keyset. Null values are ordered as if they are greater than any other value. """
+    return [F(name).desc(nulls_first=True) if descending else F(name).asc(nulls_last=True) for name, descending in keyset]
+
+def get_keyset_filter(keyset: list[tuple[str, bool]], values: list) -> Q:
+    """ Returns the filter for the rows after the row with the given values of the keyset fields (see get_keyset_order_by). """
+
+    name, descending = keyset[0]
+    value = values[0]
+
+    if value is None:
+        after = Q(**{f'{name}__isnull': False}) if descending else None
+        equal = Q(**{f'{name}__isnull': True})
+    else:
+        after = Q(**{f'{name}__lt': value}) if descending else Q(**{f'{name}__gt': value}) | Q(**{f'{name}__isnull': True})
+        equal = Q(**{name: value})
+
+    if len(keyset) > 1:
+        rest = equal & get_keyset_filter(keyset[1:], values[1:])
+        return rest if after is None else after | rest
+    return after if after is not None else Q(pk__in=[])
+
+def get_table_views(patterns=None) -> list:
+    """ Returns all DynamicTableData views in the URL configuration """
+
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+
+    views = []
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            views += [view for view in get_table_views(pattern.url_patterns) if view not in views]
+            continue
+
+        view_class = getattr(pattern.callback, 'view_class', None)
+        if view_class and issubclass(view_class, DynamicTableData) and view_class not in views:
+            views.append(view_class)
+
+    return views
+
+@functools.cache
+def get_cached_table_models() -> frozenset:
+    """ Returns the models of the DynamicTableData views that cache their data """
+    return frozenset(model for view in get_table_views() if view.cache_timeout for model in view.get_cache_models())
 
 class DynamicTableData(View):
-    """ A view that returns the data for a dynamic table """
+    """ A view that returns the data for a dynamic table.
+
+        By default, the table is paginated with page numbers. For large tables, set cursor_pagination to True
+        to paginate with a cursor (keyset pagination) on the sort field and the primary key. This avoids OFFSET queries,
+        so every page is fetched equally fast. In cursor mode, the sort fields must be model fields (null values are sorted last).
+
+        The search_backend determines how the search_fields are searched: 'icontains' (default), 'trigram' or 'fulltext' (see modules.views.search).
+        For 'fulltext', set search_vector_column to store the search vector in a generated column of the table.
+        Run the swd_build_search_indexes management command to create the indexes for the 'trigram' and 'fulltext' backends.
+
+        Set cache_timeout to cache the table data per user, URL and request parameters. The response has an ETag, so repeated requests
+        get a 304 Not Modified response until a row of the model (or of the cache_models) is saved or deleted.
+    """
 
     template_name = None
     model = None
@@ -20,6 +130,13 @@ class DynamicTableData(View):
     sort_options = []
     search_fields = []
     paginate_by = 10
+    cursor_pagination = False
+    count_cache_timeout = 60 # Seconds to cache the total amount of rows in cursor mode. Set to None to count on every request.
+    search_backend = 'icontains' # 'icontains', 'trigram', 'fulltext' or a SearchBackend subclass
+    search_config = 'english' # The text search configuration (language) of the 'fulltext' backend
+    search_vector_column = None
+    cache_timeout = None # Seconds to cache the table data. The cache is invalidated when a row of the model is saved or deleted. Requires the model attribute.
+    cache_models = [] # Other models shown in the table (e.g. fields of related models), whose changes invalidate the cached data too
 
     def get_search_term(self):
         """ Returns the search term from the request """
@@ -34,10 +151,22 @@ class DynamicTableData(View):
         """
 
         sort = self.request.GET.get('sort_field', None)
-        if sort is not None:
+        if sort is not None and self.is_valid_sort_field(sort):
             return sort
         
         return self.sort_default
+    
+    def is_valid_sort_field(self, sort_field):
+        """ Returns whether the table can be sorted by the sort field: a model field (following relations) or, without cursor pagination, an annotation """
+        field_name = sort_field.lstrip('-')
+        if not self.cursor_pagination and field_name in self.get_queryset().query.annotations:
+            return True
+
+        try:
+            self.get_sort_model_field(field_name)
+        except FieldDoesNotExist:
+            return False
+        return True
 
     def get_per_page(self):
         """ Returns the number of items per page. 
@@ -63,22 +192,25 @@ class DynamicTableData(View):
             return self.model.objects.all()
         raise NotImplementedError('You must define a model or override the get_queryset method')
     
-    def get_processed_queryset(self):
-        """ Returns the queryset after filtering, sorting and pagination. """
-        sort_field = self.get_sort_field()
+    def get_search_backend(self):
+        """ Returns the search backend for the search fields """
+        backend_class = SEARCH_BACKENDS[self.search_backend] if isinstance(self.search_backend, str) else self.search_backend
+        model = self.model if self.model is not None else self.get_queryset().model
+        return backend_class(model, self.search_fields, config=self.search_config, vector_column=self.search_vector_column)
+    
+    def get_search_queryset(self):
+        """ Returns the queryset after filtering on the search term """
         queryset = self.get_queryset()
         search_term = self.get_search_term()
         
-        search_query = None
         if search_term is not None and len(search_term) > 0 and len(self.search_fields) > 0:
-            search_query = Q()
-            for field in self.search_fields:
-                search_query |= Q(**{f'{field}__icontains': search_term})
+            queryset = self.get_search_backend().filter(queryset, search_term)
 
-        if search_query is not None:
-            queryset = queryset.filter(search_query)
-        
-        queryset = queryset.order_by(sort_field)
+        return queryset
+    
+    def get_processed_queryset(self):
+        """ Returns the queryset after filtering, sorting and pagination. """
+        queryset = self.get_search_queryset().order_by(self.get_sort_field())
 
         page = self.request.GET.get('page', 1)
         per_page = self.get_per_page()
@@ -92,31 +224,199 @@ class DynamicTableData(View):
             objects = paginator.page(paginator.num_pages)
         
         return objects
+    
+    def get_total(self, queryset):
+        """ Returns the amount of rows in the queryset. The count is cached for count_cache_timeout seconds. """
+
+        if not self.count_cache_timeout:
+            return queryset.count()
+        
+        cache_key = f'dynamic_table_count_{hashlib.md5(str(queryset.query).encode()).hexdigest()}'
+        total = cache.get(cache_key)
+        if total is None:
+            total = queryset.count()
+            cache.set(cache_key, total, self.count_cache_timeout)
+        return total
+    
+    def get_sort_model_field(self, field_name):
+        """ Returns the model field for the sort field, following relations (e.g. 'user__email') """
+        model = self.get_queryset().model
+        field = None
+        for part in field_name.split('__'):
+            if model is None:
+                raise FieldDoesNotExist(f'{field.name} has no field named {part}')
+            field = model._meta.pk if part == 'pk' else model._meta.get_field(part)
+            model = field.related_model
+        return field
+    
+    def get_cursor(self):
+        """ Returns the decoded cursor from the request, or None for the first page """
+        cursor = self.request.GET.get('cursor', None)
+        if not cursor:
+            return None
+        
+        try:
+            return signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None
+        
+    def encode_cursor(self, objekt, sort_field, keyset, direction):
+        """ Returns an opaque cursor that points to the given object """
+        values = []
+        for name, descending in keyset:
+            field = self.get_sort_model_field(name)
+            parent = objekt
+            for part in name.split('__')[:-1]:
+                parent = getattr(parent, part) if parent is not None else None
+
+            value = getattr(parent, field.attname) if parent is not None else None
+            values.append(field.value_to_string(parent) if value is not None else None)
+
+        return signing.dumps({
+            'sort_field': sort_field,
+            'values': values,
+            'direction': direction,
+        }, salt=CURSOR_SALT, compress=True)
+    
+    def decode_cursor_values(self, cursor, keyset):
+        """ Returns the values of the keyset fields in the cursor, or None if the cursor can't be used for the keyset """
+        values = cursor.get('values')
+        if values is None or len(values) != len(keyset):
+            return None
 
-    def get_html(self):
+        try:
+            return [self.get_sort_model_field(name).to_python(value) if value is not None else None for (name, descending), value in zip(keyset, values)]
+        except ValidationError:
+            return None
+    
+    def get_cursor_page(self):
+        """ Returns the objects of the current page, and the cursors of the next and previous page (None if there's no such page). """
+        sort_field = self.get_sort_field()
+        per_page = self.get_per_page()
+        queryset = self.get_search_queryset()
+        field_name, descending = sort_field.lstrip('-'), sort_field.startswith('-')
+        keyset = [('pk', descending)] if field_name in ('pk', queryset.model._meta.pk.name) else [(field_name, descending), ('pk', descending)]
+
+        # A cursor of another sort field (e.g. after the user changed the sorting) starts at the first page
+        cursor = self.get_cursor()
+        values = self.decode_cursor_values(cursor, keyset) if cursor is not None and cursor.get('sort_field') == sort_field else None
+        if values is None:
+            cursor = None
+        backwards = cursor is not None and cursor['direction'] == 'prev'
+
+        # When going back, the ordering is reversed to fetch the rows before the cursor
+        ordering = [(name, not descending) for name, descending in keyset] if backwards else keyset
+        queryset = queryset.order_by(*get_keyset_order_by(ordering))
+        if cursor is not None:
+            queryset = queryset.filter(get_keyset_filter(ordering, values))
+
+        # Fetch one extra row to know if there are more rows
+        objects = list(queryset[:per_page + 1])
+        has_more = len(objects) > per_page
+        objects = objects[:per_page]
+        if backwards:
+            objects.reverse()
+
+        has_next = has_more if not backwards else True
+        has_previous = cursor is not None if not backwards else has_more
+        next_cursor = self.encode_cursor(objects[-1], sort_field, keyset, 'next') if objects and has_next else None
+        prev_cursor = self.encode_cursor(objects[0], sort_field, keyset, 'prev') if objects and has_previous else None
+
+        return objects, next_cursor, prev_cursor
+
+    def get_html(self, objects=None):
         """ Returns the html for the table """
-        return render_to_string(self.get_template_name(), {self.context_object_name: self.get_processed_queryset()})
+        if objects is None:
+            objects = self.get_processed_queryset()
+        return render_to_string(self.get_template_name(), {self.context_object_name: objects})
     
-    def get(self, request, *args, **kwargs):
-        """ Handles the GET request and returns the table data as JSON """
-        objects = self.get_processed_queryset()
+    def get_data(self):
+        """ Returns the table data """
+
+        if self.cursor_pagination:
+            objects, next_cursor, prev_cursor = self.get_cursor_page()
 
-        return JsonResponse({
+            return {
                 'sort_default': self.sort_default,
                 'sort_options': self.sort_options,
-                'html': self.get_html(),
-                'total': self.get_queryset().count(),
-                'page': objects.number,
-                'num_pages': objects.paginator.num_pages,
-                'per_page': objects.paginator.per_page,
-        })
+                'html': self.get_html(objects),
+                'total': self.get_total(self.get_search_queryset()),
+                'pagination': 'cursor',
+                'next_cursor': next_cursor,
+                'prev_cursor': prev_cursor,
+                'per_page': self.get_per_page(),
+            }
+
+        objects = self.get_processed_queryset()
+
+        return {
+            'sort_default': self.sort_default,
+            'sort_options': self.sort_options,
+            'html': self.get_html(objects),
+            'total': objects.paginator.count,
+            'pagination': 'page',
+            'page': objects.number,
+            'num_pages': objects.paginator.num_pages,
+            'per_page': objects.paginator.per_page,
+        }
+    
+    @classmethod
+    def get_cache_models(cls) -> list:
+        """ Returns the models whose changes invalidate the cached table data: the model and the cache_models. """
+        return [model for model in [cls.model, *cls.cache_models] if model is not None]
+
+    def get_cache_key_data(self) -> list:
+        """ Returns the data the cached table data depends on. Override it to add other dependencies (e.g. a setting of the user). """
+        return [
+            f'{self.__class__.__module__}.{self.__class__.__qualname__}',
+            self.request.user.pk,
+            self.kwargs,
+            sorted(self.request.GET.lists()),
+            translation.get_language(),
+            [get_table_version(model) for model in self.get_cache_models()],
+        ]
+
+    def get_cache_key(self):
+        """ Returns the cache key of the table data for the current request """
+        key_data = self.get_cache_key_data()
+        return f'dynamic_table_data_{hashlib.md5(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()}'
+    
+    def get(self, request, *args, **kwargs):
+        """ Handles the GET request and returns the table data as JSON """
+
+        if not self.cache_timeout:
+            return JsonResponse(self.get_data())
+        
+        # The cache key changes when the data changes, so it is used as the ETag
+        cache_key = self.get_cache_key()
+        etag = '"%s"' % cache_key.rsplit('_', 1)[-1]
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            data = cache.get(cache_key)
+            if data is None:
+                data = self.get_data()
+                cache.set(cache_key, data, self.cache_timeout)
+            response = JsonResponse(data)
+
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     
 class ExcelModelExport(View):
-    """ A view that returns an Excel file with the data from a queryset """
+    """ A view that returns an Excel file with the data from a queryset.
+
+        If stream is set to True, the queryset is read in chunks and the file is written incrementally,
+        so memory usage stays flat for large querysets. In streaming mode the export_format can be 'xlsx', 'csv' or 'ndjson'.
+        NOTE: In streaming mode, the fields are read with values_list, so each field must be a model field or lookup (e.g. 'user__email').
+    """
 
     model = None
     fields = []
     filename = 'data.xlsx'
+    stream = False
+    export_format = 'xlsx'
+    chunk_size = 2000
 
     def get_queryset(self):
         """ Returns the queryset to display in the table """
@@ -165,9 +465,121 @@ class ExcelModelExport(View):
         """ Returns the filename of the Excel file """
         return self.filename
     
+    def get_stream(self):
+        """ Returns whether the file should be streamed """
+        return self.stream
+    
+    def get_export_format(self):
+        """ Returns the format of the streamed file """
+        return self.export_format
+    
+    def get_chunk_size(self):
+        """ Returns the amount of rows to fetch from the database at once when streaming """
+        return self.chunk_size
+    
+    def get_headers(self):
+        """ Returns the headers of the file """
+        return [field['header'] for field in self.get_formatted_fields()]
+    
+    def get_rows(self):
+        """ Yields the formatted rows, reading the queryset in chunks """
+
+        field_names = [field['field'] for field in self.get_formatted_fields()]
+        queryset = self.get_queryset().values_list(*field_names)
+
+        for values in queryset.iterator(chunk_size=self.get_chunk_size()):
+            yield [self.format_field_value(value) for value in values]
+    
+    def get_streaming_response(self):
+        """ Returns a streaming response with the file """
+
+        export_format = self.get_export_format()
+        filename = f'{os.path.splitext(self.get_filename())[0]}.{export_format}'
+
+        blocks = iter_export(export_format, self.get_headers(), self.get_rows())
+        if isinstance(self.request, ASGIRequest):
+            blocks = aiter_blocks(blocks) # Django reads a sync iterator into a list under ASGI
+
+        response = StreamingHttpResponse(blocks, content_type=EXPORT_CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    
+    def write_to_storage(self, directory: str, checkpoint: dict, on_progress=None) -> str:
+        """ Writes the file to the default storage in chunks and returns the path of the file.
+
+            The rows are first written in parts of chunk_size rows. After each part, the checkpoint is updated and on_progress is called with the checkpoint and the progress percentage.
+            When the checkpoint of a previous (failed) run is passed, the export resumes after the last written row instead of starting over.
+        """
+
+        export_format = self.get_export_format()
+        field_names = [field['field'] for field in self.get_formatted_fields()]
+        queryset = self.get_queryset()
+
+        # The rows are read with a keyset (the ordering of the queryset and the primary key) instead of an offset,
+        # so rows that are added or deleted while exporting (or between retries) don't shift the rows of the next parts
+        keyset = get_keyset_ordering(queryset)
+        key_names = [name for name, descending in keyset]
+        names = list(dict.fromkeys(key_names + field_names))
+        key_indexes = [names.index(name) for name in key_names]
+        field_indexes = [names.index(name) for name in field_names]
+        queryset = queryset.order_by(*get_keyset_order_by(keyset)).values_list(*names)
+
+        chunk_size = self.get_chunk_size()
+        if 'total' not in checkpoint: # Not counted again when the export is resumed
+            checkpoint['total'] = queryset.count()
+        total = checkpoint['total']
+        parts = checkpoint.setdefault('parts', [])
+        written = checkpoint.setdefault('written', 0)
+
+        while True:
+            chunk_queryset = queryset if checkpoint.get('last') is None else queryset.filter(get_keyset_filter(keyset, checkpoint['last']))
+            chunk = list(chunk_queryset[:chunk_size])
+            if not chunk:
+                break
+
+            rows = [[self.format_field_value(values[index]) for index in field_indexes] for values in chunk]
+            part_path = f'{directory}/part_{len(parts):05d}.ndjson'
+            if default_storage.exists(part_path): # Left behind by a run that failed before saving the checkpoint
+                default_storage.delete(part_path)
+
+            parts.append(default_storage.save(part_path, ContentFile(''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8'))))
+            written += len(rows)
+            checkpoint['written'] = written
+            checkpoint['last'] = [chunk[-1][index] for index in key_indexes]
+
+            if on_progress:
+                on_progress(checkpoint, min(99, int(written / max(total, 1) * 100)))
+
+        def iter_part_rows():
+            for part_path in parts:
+                with default_storage.open(part_path, 'rb') as part:
+                    for line in part:
+                        yield json.loads(line)
+
+        file_path = f'{directory}/{os.path.splitext(self.get_filename())[0]}.{export_format}'
+        with tempfile.TemporaryFile() as file:
+            for block in iter_export(export_format, self.get_headers(), iter_part_rows()):
+                file.write(block)
+            file.seek(0)
+
+            if default_storage.exists(file_path):
+                default_storage.delete(file_path)
+            file_path = default_storage.save(file_path, File(file))
+
+        for part_path in parts:
+            default_storage.delete(part_path)
+
+        if on_progress:
+            on_progress(checkpoint, 100)
+
+        return file_path
+    
     def get(self, request, *args, **kwargs):
         """ Handles the GET request and returns the Excel file """
 
+        if self.get_stream():
+            return self.get_streaming_response()
+
         queryset = self.get_queryset()
         fields = self.get_formatted_fields()
         data = tablib.Dataset()
@@ -203,6 +615,22 @@ class PDFExport(View):
         """ Returns the context to render the PDF """
         return {}
     
+    def write_to_storage(self, directory: str, checkpoint: dict, on_progress=None) -> str:
+        """ Writes the PDF file to the default storage and returns the path of the file """
+
+        context = self.get_context(self.request, *self.args, **self.kwargs)
+        pdf = render_to_pdf_file(self.get_template_name(), context)
+
+        file_path = f'{directory}/{self.get_filename()}'
+        if default_storage.exists(file_path):
+            default_storage.delete(file_path)
+        file_path = default_storage.save(file_path, ContentFile(pdf))
+
+        if on_progress:
+            on_progress(checkpoint, 100)
+
+        return file_path
+
     def get(self, request, *args, **kwargs):
         """ Handles the GET request and returns the PDF file """
 
@@ -211,4 +639,24 @@ class PDFExport(View):
 
         response = HttpResponse(pdf, content_type='application/pdf')
         response['Content-Disposition'] = f'attachment; filename="{self.get_filename()}"'
-        return response
\ No newline at end of file
+        return response
+
+class BackgroundExportMixin:
+    """ Adds a POST handler to an ExcelModelExport or PDFExport view that runs the export as a background job.
+        
+        The response contains the task_id, which can be used to check the status of the job and download the file (see modules.utils.views.ExportJobStatus).
+        The progress is also sent to the user's websocket group with the 'export_progress' action.
+    """
+
+    def post(self, request, *args, **kwargs):
+        from huey.contrib.djhuey import HUEY
+        from modules.utils.tasks import run_export_job, set_export_job_checkpoint
+
+        view_path = f'{self.__class__.__module__}.{self.__class__.__qualname__}'
+        page_id = request.GET.get('page_id', 'all_pages')
+        task = run_export_job.s(view_path, request.user.id, request.GET.urlencode(), kwargs, page_id)
+
+        # The checkpoint is stored before the job is queued, so ExportJobStatus knows who started the job from the start
+        set_export_job_checkpoint(task.id, {'user_id': request.user.id, 'progress': 0})
+        HUEY.enqueue(task)
+        return JsonResponse({'task_id': task.id})
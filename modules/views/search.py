@@ -0,0 +1,128 @@
+import hashlib
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchVector, SearchVectorField
+from django.db.models import Q, CharField, TextField
+from django.db.models.expressions import RawSQL
+
+class SearchBackend:
+    """ Base class for the search backends of DynamicTableData.
+
+        A search backend filters a queryset on a search term, and defines the database objects (indexes, columns, extensions)
+        it needs to be fast. Those are created by the swd_build_search_indexes management command.
+    """
+
+    name = None
+
+    def __init__(self, model, search_fields: list, config: str = 'english', vector_column: str | None = None):
+        self.model = model
+        self.search_fields = search_fields
+        self.config = config
+        self.vector_column = vector_column
+
+    def filter(self, queryset, search_term: str):
+        """ Returns the queryset filtered on the search term """
+        raise NotImplementedError('You must implement the filter method in the search backend.')
+
+    def get_index_name(self, suffix: str = '') -> str:
+        """ Returns a unique index name (max. 63 characters, the limit of PostgreSQL) """
+        digest = hashlib.md5(f'{self.name}:{",".join(self.search_fields)}:{self.config}:{suffix}'.encode()).hexdigest()[:8]
+        return f'{self.model._meta.db_table[:40]}_{self.name[:4]}_{digest}_idx'
+
+    def get_indexes(self) -> list:
+        """ Returns the indexes the backend needs """
+        return []
+
+    def get_setup_sql(self) -> list[tuple[str, list]]:
+        """ Returns the SQL statements (with params) to run before the indexes are created, e.g. to create extensions or columns """
+        return []
+
+    def get_teardown_sql(self) -> list[tuple[str, list]]:
+        """ Returns the SQL statements (with params) to run after the indexes are dropped """
+        return []
+
+class IContainsSearchBackend(SearchBackend):
+    """ Searches with field__icontains on every search field. This can't use an index, so it scans the whole table. """
+
+    name = 'icontains'
+
+    def filter(self, queryset, search_term: str):
+        search_query = Q()
+        for field in self.search_fields:
+            search_query |= Q(**{f'{field}__icontains': search_term})
+        return queryset.filter(search_query)
+
+class TrigramSearchBackend(SearchBackend):
+    """ Searches on word similarity with the pg_trgm extension, backed by a GIN trigram index per field.
+        Text fields match when the search term is similar to a word in the field, so typos are allowed. Other fields fall back to icontains.
+    """
+
+    name = 'trigram'
+
+    def is_text_field(self, field_name: str) -> bool:
+        field = self.model._meta.get_field(field_name) if '__' not in field_name else None
+        return isinstance(field, (CharField, TextField))
+
+    def filter(self, queryset, search_term: str):
+        search_query = Q()
+        for field in self.search_fields:
+            lookup = 'trigram_word_similar' if self.is_text_field(field) else 'icontains'
+            search_query |= Q(**{f'{field}__{lookup}': search_term})
+        return queryset.filter(search_query)
+
+    def get_indexes(self) -> list:
+        return [
+            GinIndex(fields=[field], opclasses=['gin_trgm_ops'], name=self.get_index_name(field))
+            for field in self.search_fields if self.is_text_field(field)
+        ]
+
+    def get_setup_sql(self) -> list[tuple[str, list]]:
+        return [('CREATE EXTENSION IF NOT EXISTS pg_trgm', [])]
+
+class FullTextSearchBackend(SearchBackend):
+    """ Searches with PostgreSQL full-text search (tsvector/tsquery), with the search term in the websearch syntax.
+
+        Without a vector_column, the tsvector is computed in the query and backed by a GIN expression index on the same expression.
+        With a vector_column, the tsvector is stored in a generated column of the table, backed by a GIN index on that column.
+    """
+
+    name = 'fulltext'
+
+    def get_search_vector(self):
+        return SearchVector(*self.search_fields, config=self.config)
+
+    def filter(self, queryset, search_term: str):
+        if self.vector_column:
+            vector = RawSQL(f'"{self.model._meta.db_table}"."{self.vector_column}"', [], output_field=SearchVectorField())
+        else:
+            vector = self.get_search_vector()
+
+        return queryset.annotate(search_vector=vector).filter(search_vector=SearchQuery(search_term, config=self.config, search_type='websearch'))
+
+    def get_indexes(self) -> list:
+        if self.vector_column:
+            return [GinIndex(RawSQL(f'"{self.vector_column}"', []), name=self.get_index_name(self.vector_column))]
+        return [GinIndex(self.get_search_vector(), name=self.get_index_name())]
+
+    def get_setup_sql(self) -> list[tuple[str, list]]:
+        if not self.vector_column:
+            return []
+
+        columns = [self.model._meta.get_field(field).column for field in self.search_fields]
+        document = " || ' ' || ".join(f'coalesce("{column}"::text, \'\')' for column in columns)
+        return [(
+            f'ALTER TABLE "{self.model._meta.db_table}" ADD COLUMN IF NOT EXISTS "{self.vector_column}" tsvector '
+            f'GENERATED ALWAYS AS (to_tsvector(%s::regconfig, {document})) STORED',
+            [self.config],
+        )]
+
+    def get_teardown_sql(self) -> list[tuple[str, list]]:
+        if not self.vector_column:
+            return []
+        return [(f'ALTER TABLE "{self.model._meta.db_table}" DROP COLUMN IF EXISTS "{self.vector_column}"', [])]
+
+SEARCH_BACKENDS = {
+    IContainsSearchBackend.name : IContainsSearchBackend,
+    TrigramSearchBackend.name : TrigramSearchBackend,
+    FullTextSearchBackend.name : FullTextSearchBackend,
+}
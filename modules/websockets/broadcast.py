@@ -0,0 +1,137 @@
+import time
+import asyncio
+import logging
+import functools
+
+from channels.layers import get_channel_layer
+
+from CONFIG.websockets import WEBSOCKET_BROADCAST_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# The batched send uses these internals of the Redis channel layer (channels_redis 4.2). When they're missing, or with another version
+# of channels_redis, the groups are sent with the public group_send instead.
+REDIS_CHANNEL_LAYER_VERSION = '4.2.'
+REDIS_CHANNEL_LAYER_INTERNALS = ('consistent_hash', 'connection', '_group_key', '_map_channel_keys_to_connection', 'group_expiry', 'expiry')
+
+# The group_send script of channels_redis: adds the message to every channel key that isn't over capacity.
+GROUP_SEND_SCRIPT = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+def _is_redis_channel_layer(channel_layer) -> bool:
+    """ Returns whether the channel layer is a Redis channel layer with the internals that the batched send uses. """
+
+    try:
+        import channels_redis
+        from channels_redis.core import RedisChannelLayer
+    except ImportError:
+        return False
+
+    if not isinstance(channel_layer, RedisChannelLayer):
+        return False
+
+    missing = [name for name in REDIS_CHANNEL_LAYER_INTERNALS if not hasattr(channel_layer, name)]
+    if missing or not channels_redis.__version__.startswith(REDIS_CHANNEL_LAYER_VERSION):
+        _warn_unsupported_redis_channel_layer(channels_redis.__version__, tuple(missing))
+        return False
+    return True
+
+@functools.cache
+def _warn_unsupported_redis_channel_layer(version: str, missing: tuple) -> None:
+    logger.warning(
+        f'Broadcasts are sent with group_send, because the batched send doesn\'t support channels_redis {version}'
+        + (f' (missing: {", ".join(missing)})' if missing else '')
+    )
+
+def _batches(items: list, batch_size: int):
+    for index in range(0, len(items), batch_size):
+        yield items[index:index + batch_size]
+
+async def _get_channels_of_groups(channel_layer, groups: list) -> set:
+    """ Returns the channels of the groups, with one pipelined round trip per Redis host (instead of two per group). """
+
+    groups_by_connection = {}
+    for group in groups:
+        groups_by_connection.setdefault(channel_layer.consistent_hash(group), []).append(group)
+
+    channels = set()
+    for index, connection_groups in groups_by_connection.items():
+        pipeline = channel_layer.connection(index).pipeline(transaction=False)
+        for group in connection_groups:
+            key = channel_layer._group_key(group)
+            pipeline.zremrangebyscore(key, min=0, max=int(time.time()) - channel_layer.group_expiry) # Discard old channels, like group_send
+            pipeline.zrange(key, 0, -1)
+
+        results = await pipeline.execute()
+        for channel_names in results[1::2]:
+            channels.update(channel_name.decode('utf8') for channel_name in channel_names)
+    return channels
+
+async def _redis_group_send_many(channel_layer, groups: list, message: dict, batch_size: int) -> None:
+    for batch in _batches(groups, batch_size):
+        channels = await _get_channels_of_groups(channel_layer, batch)
+        if not channels:
+            continue
+
+        # A message per channel key (the channels of a process share a key), like group_send
+        channel_keys_by_connection, messages, capacities = channel_layer._map_channel_keys_to_connection(sorted(channels), message)
+
+        over_capacity = 0
+        for index, channel_keys in channel_keys_by_connection.items():
+            pipeline = channel_layer.connection(index).pipeline(transaction=False)
+            script_results = []
+            for keys in _batches(channel_keys, batch_size):
+                for key in keys:
+                    pipeline.zremrangebyscore(key, min=0, max=int(time.time()) - int(channel_layer.expiry)) # Discard old messages
+                args = [messages[key] for key in keys] + [capacities[key] for key in keys] + [time.time(), channel_layer.expiry]
+                pipeline.eval(GROUP_SEND_SCRIPT, len(keys), *keys, *args)
+                script_results.append(len(pipeline) - 1)
+
+            results = await pipeline.execute()
+            over_capacity += sum(results[position] for position in script_results)
+
+        if over_capacity:
+            logger.info(f'{over_capacity} of {len(channels)} channels over capacity in a broadcast to {len(batch)} groups')
+
+async def group_send_many(groups, message: dict, channel_layer=None, batch_size: int = WEBSOCKET_BROADCAST_BATCH_SIZE) -> None:
+    """ Sends a message to many channel groups.
+
+        With the Redis channel layer (channels_redis 4.2), the groups are sent in batches: the channels of a batch of groups are retrieved in one pipelined
+        round trip and the messages are added with one pipelined round trip per Redis host. A channel in more than one group of a batch
+        receives the message once. Other channel layers send the groups of a batch concurrently.
+
+        :param groups: The names of the groups.
+        :type groups: Iterable[str]
+        :param message: The message, with the 'type' of the consumer method that handles it.
+        :type message: dict
+        :param channel_layer: The channel layer, the default channel layer if None.
+        :type channel_layer: BaseChannelLayer | None
+        :param batch_size: The amount of groups per batch.
+        :type batch_size: int
+        :return: None
+        :rtype: None
+    """
+
+    channel_layer = channel_layer or get_channel_layer()
+    groups = list(dict.fromkeys(groups))
+    for group in groups:
+        assert channel_layer.valid_group_name(group), 'Group name not valid'
+
+    if _is_redis_channel_layer(channel_layer):
+        await _redis_group_send_many(channel_layer, groups, message, batch_size)
+        return
+
+    for batch in _batches(groups, batch_size):
+        await asyncio.gather(*[channel_layer.group_send(group, message) for group in batch])
@@ -0,0 +1,119 @@
+import time
+import logging
+import itertools
+from collections import OrderedDict
+
+from huey.contrib.djhuey import HUEY
+
+logger = logging.getLogger(__name__)
+
+METRICS_RETENTION_MINUTES = 120
+
+class CoalescingMetrics:
+    """ The amount of sent, merged (replaced by a newer message) and dropped (buffer full) messages, per connection and per process. """
+
+    def __init__(self):
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def add(self, metrics: 'CoalescingMetrics') -> None:
+        self.sent += metrics.sent
+        self.merged += metrics.merged
+        self.dropped += metrics.dropped
+
+    def as_dict(self) -> dict:
+        return {'sent' : self.sent, 'merged' : self.merged, 'dropped' : self.dropped}
+
+# The totals of the closed connections of this process
+process_coalescing_metrics = CoalescingMetrics()
+
+def _get_redis():
+    """ Returns the Redis connection of the task queue, or None if the task queue doesn't use Redis (e.g. in immediate mode). """
+    return getattr(HUEY.storage, 'conn', None)
+
+def record_coalescing_metrics(metrics: CoalescingMetrics) -> None:
+    """ Counts the sent, merged and dropped messages of a closed connection per minute, for get_coalescing_metrics. """
+
+    redis = _get_redis()
+    if redis is None:
+        return
+
+    minute = int(time.time() // 60)
+    pipeline = redis.pipeline()
+    for field, value in metrics.as_dict().items():
+        if value:
+            key = f'websocket_coalescing_metrics:{field}:{minute}'
+            pipeline.incrby(key, value)
+            pipeline.expire(key, METRICS_RETENTION_MINUTES * 60)
+    pipeline.execute()
+
+def get_coalescing_metrics(minutes: int = 5) -> dict:
+    """ Returns the amount of sent, merged and dropped messages of the coalescing connections that were closed in the last minutes,
+        over all websocket server processes.
+
+        :param minutes: The amount of minutes to compute the metrics over (max. METRICS_RETENTION_MINUTES).
+        :type minutes: int
+        :return: The metrics, empty if the task queue doesn't use Redis.
+        :rtype: dict
+    """
+
+    redis = _get_redis()
+    if redis is None:
+        return {}
+
+    current_minute = int(time.time() // 60)
+    minute_range = range(current_minute - min(minutes, METRICS_RETENTION_MINUTES) + 1, current_minute + 1)
+
+    metrics = {}
+    for field in CoalescingMetrics().as_dict():
+        keys = [f'websocket_coalescing_metrics:{field}:{minute}' for minute in minute_range]
+        metrics[field] = sum(int(value) for value in redis.mget(keys) if value)
+    return metrics
+
+class MessageBuffer:
+    """ The bounded buffer of the unsent messages of a connection.
+
+        A message with a coalesce key replaces the unsent message with the same key (it's moved to the end, so the order of
+        the messages is the order of their last update). When the buffer is full, the oldest message is dropped.
+    """
+
+    _unique_keys = itertools.count()
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.messages = OrderedDict()
+        self.metrics = CoalescingMetrics()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, frame, key: tuple | None = None) -> None:
+        """ Adds the (encoded) message. Messages without a key are never replaced. """
+
+        if key is None:
+            key = ('unique', next(self._unique_keys))
+        elif key in self.messages:
+            self.metrics.merged += 1
+            del self.messages[key]
+
+        self.messages[key] = frame
+        while len(self.messages) > self.max_size:
+            self.messages.popitem(last=False)
+            self.metrics.dropped += 1
+
+    def pop_all(self) -> list:
+        """ Returns the messages in order and empties the buffer. """
+
+        frames = list(self.messages.values())
+        self.messages = OrderedDict()
+        self.metrics.sent += len(frames)
+        return frames
+
+    def close(self) -> None:
+        """ Adds the metrics of the connection to the metrics of the process and to the metrics in Redis (see get_coalescing_metrics). """
+
+        process_coalescing_metrics.add(self.metrics)
+        record_coalescing_metrics(self.metrics)
+        if self.metrics.dropped:
+            logger.info(f'Websocket connection closed, {self.metrics.dropped} messages were dropped because the buffer was full ({self.metrics.as_dict()})')
@@ -0,0 +1,100 @@
+import json
+
+import msgpack
+from django.core.exceptions import ImproperlyConfigured
+
+from CONFIG.websockets import WEBSOCKET_CODEC
+
+class JSONCodec:
+    """ Encodes the websocket messages as JSON text frames, with the standard library. """
+
+    name = 'json'
+    binary = False
+
+    def encode(self, data) -> str:
+        return json.dumps(data, separators=(',', ':'))
+
+    def decode(self, frame: str | bytes):
+        return json.loads(frame)
+
+class ORJSONCodec:
+    """ Encodes the websocket messages as JSON text frames, with orjson (several times faster than the standard library). """
+
+    name = 'orjson'
+    binary = False
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            raise ImproperlyConfigured('The orjson websocket codec needs orjson: pip install orjson')
+        self.orjson = orjson
+
+    def encode(self, data) -> str:
+        return self.orjson.dumps(data).decode('utf8')
+
+    def decode(self, frame: str | bytes):
+        return self.orjson.loads(frame)
+
+class MsgPackCodec:
+    """ Encodes the websocket messages as MessagePack binary frames (smaller than JSON, the browser needs a MessagePack decoder). """
+
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame: bytes):
+        return msgpack.unpackb(frame, raw=False)
+
+CODECS = {
+    'json' : JSONCodec,
+    'orjson' : ORJSONCodec,
+    'msgpack' : MsgPackCodec,
+}
+
+_codecs = {}
+
+def get_codec(name: str | None = None):
+    """ Returns the codec with the name, or the WEBSOCKET_CODEC if None. The codecs are created once per process. """
+
+    name = name or WEBSOCKET_CODEC
+    codec = _codecs.get(name)
+    if codec is None:
+        if name not in CODECS:
+            raise ImproperlyConfigured(f'Unknown websocket codec "{name}", choose from: {", ".join(CODECS)}.')
+        codec = _codecs[name] = CODECS[name]()
+    return codec
+
+def build_channel_message(action: str, payload_data: dict, page_id: str = 'all_pages', codec: str | None = None, coalesce_key: str | None = None) -> dict:
+    """ Returns the channel layer message that is handled by the send_message method of the consumers.
+
+        The websocket frame is encoded once here, with the codec (WEBSOCKET_CODEC by default), so a message to a group of N connections
+        isn't encoded N times. Only the frame is sent through the channel layer (not the payload as well), consumers with another codec
+        decode the frame and encode it again.
+
+        :param action: The action to send.
+        :type action: str
+        :param payload_data: The data to send.
+        :type payload_data: dict
+        :param page_id: The page ID to send the message to. Default is 'all_pages'.
+        :type page_id: str
+        :param codec: The name of the codec to encode the frame with, WEBSOCKET_CODEC if None.
+        :type codec: str | None
+        :param coalesce_key: Messages with the same action, page ID and coalesce key replace each other in consumers in coalescing mode.
+        :type coalesce_key: str | None
+        :return: The channel layer message.
+        :rtype: dict
+    """
+
+    action = action.lower()
+    codec = get_codec(codec)
+    return {
+        'type' : 'send_message',
+        'action' : action,
+        'page_id' : page_id,
+        'frame' : codec.encode({'action' : action, 'page_id' : page_id, 'payload' : payload_data}),
+        'codec' : codec.name,
+        'coalesce_key' : coalesce_key,
+    }
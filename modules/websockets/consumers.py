@@ -1,9 +1,41 @@
-import json
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from .utils import send_to_channel_group_async
+
+from CONFIG.websockets import WEBSOCKET_MAX_PAGE_SUBSCRIPTIONS, WEBSOCKET_COALESCE_INTERVAL, WEBSOCKET_MAX_BUFFERED_MESSAGES
+from .codecs import get_codec
+from .coalescing import MessageBuffer
+from .utils import send_to_channel_groups_async
+
+logger = logging.getLogger(__name__)
+
+ALL_PAGES = 'all_pages'
 
 class ShipWithDjangoConsumer(AsyncJsonWebsocketConsumer):
+    """ Base consumer. A connection can subscribe to the page IDs it's interested in (with the page_id query parameter when connecting,
+        or with the subscribe and unsubscribe events). Messages for other pages are then dropped on the server, before they're encoded
+        and sent. Messages for 'all_pages' are always sent. A connection that didn't subscribe to a page receives all messages.
+
+        In coalescing mode (coalesce = True), the messages are buffered per connection and sent at most every coalesce_interval seconds
+        (the first message after a quiet period is sent right away). Messages with the same action, page ID and coalesce key replace
+        older unsent ones, and the buffer holds max_buffered_messages at most (see modules.websockets.coalescing). This keeps fast
+        updates (e.g. progress) from piling up in the channel layer for clients that can't keep up.
+    """
+
     channel_groups = None
+    page_ids = None # The subscribed page IDs, None if the connection didn't subscribe
+    codec = None # The name of the codec of the messages, WEBSOCKET_CODEC if None
+
+    coalesce = False
+    coalesce_interval = WEBSOCKET_COALESCE_INTERVAL
+    max_buffered_messages = WEBSOCKET_MAX_BUFFERED_MESSAGES
+    message_buffer = None
+    _flush_task = None
+    _last_flush = 0
 
     def get_channel_groups(self):
         if not self.channel_groups:
@@ -12,7 +44,33 @@ class ShipWithDjangoConsumer(AsyncJsonWebsocketConsumer):
         formatted_groups = [group.format(user=self.scope['user']) if 'user' in self.scope else group for group in self.channel_groups]
         return formatted_groups
     
+    def get_codec(self):
+        """ Returns the codec of the messages (see modules.websockets.codecs), the codec attribute or WEBSOCKET_CODEC. """
+        return get_codec(self.codec)
+
+    def subscribe(self, page_ids: list) -> None:
+        """ Subscribes the connection to the page IDs (up to WEBSOCKET_MAX_PAGE_SUBSCRIPTIONS). """
+
+        if self.page_ids is None:
+            self.page_ids = set()
+
+        for page_id in page_ids:
+            if isinstance(page_id, str) and page_id != ALL_PAGES and len(self.page_ids) < WEBSOCKET_MAX_PAGE_SUBSCRIPTIONS:
+                self.page_ids.add(page_id)
+
+    def unsubscribe(self, page_ids: list) -> None:
+        if self.page_ids is not None:
+            self.page_ids.difference_update(page_ids)
+
+    def is_subscribed(self, page_id: str) -> bool:
+        """ Returns whether messages for the page ID are sent to the connection. """
+        return self.page_ids is None or page_id == ALL_PAGES or page_id in self.page_ids
+
     async def connect(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        if query.get('page_id'):
+            self.subscribe(query['page_id'])
+
         for group in self.get_channel_groups():
             await self.channel_layer.group_add(
                 group,
@@ -22,6 +80,10 @@ class ShipWithDjangoConsumer(AsyncJsonWebsocketConsumer):
         await self.accept()
     
     async def disconnect(self, close_code):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self.message_buffer is not None:
+            await sync_to_async(self.message_buffer.close)() # Records the metrics in Redis
 
         for group in self.get_channel_groups():
             await self.channel_layer.group_discard(
@@ -29,17 +91,28 @@ class ShipWithDjangoConsumer(AsyncJsonWebsocketConsumer):
                 self.channel_name
             )
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
         """
             Receive message from client.
             Get the event and execute the necessary action.
         """
         
-        payload = json.loads(text_data)
+        payload = self.get_codec().decode(text_data if text_data is not None else bytes_data)
         event = payload['event'].lower()
-        page_id = payload['page_id'] if 'page_id' in payload else 'all_pages'
+        page_id = payload['page_id'] if 'page_id' in payload else ALL_PAGES
         user = self.scope['user']
 
+        if event in ('subscribe', 'unsubscribe'):
+            page_ids = payload.get('page_ids') or [page_id]
+            if isinstance(page_ids, str):
+                page_ids = [page_ids]
+
+            if event == 'subscribe':
+                self.subscribe(page_ids)
+            else:
+                self.unsubscribe(page_ids)
+            return
+
         await self.receive_event(event, page_id, user, payload)
     
     async def receive_event(self, event, page_id, user, response):
@@ -50,19 +123,70 @@ class ShipWithDjangoConsumer(AsyncJsonWebsocketConsumer):
     async def send_message(self, res):
         """ Send a message to the client. """
         
-        action = res['action'].lower()
         page_id = res['page_id']
-        payload = res['payload']
-        
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            "action": action,
-            "page_id": page_id,
-            "payload": payload
-        }))
+        if not self.is_subscribed(page_id):
+            return # Not for a page of this connection, dropped before it's encoded
 
-    async def send_to_all_groups(self, action, payload, page_id='all_pages'):
-        """ Send a message to all groups. """
+        codec = self.get_codec()
+        if 'frame' not in res: # Sent to the channel layer directly, without build_channel_message
+            frame = codec.encode({
+                'action' : res['action'].lower(),
+                'page_id' : page_id,
+                'payload' : res['payload'],
+            })
+        elif res['codec'] == codec.name:
+            frame = res['frame'] # Encoded once when the message was sent to the group
+        else:
+            frame = codec.encode(get_codec(res['codec']).decode(res['frame'])) # Sent with another codec
 
-        for group in self.get_channel_groups():
-            await send_to_channel_group_async(group, action, payload, page_id)
\ No newline at end of file
+        if self.coalesce:
+            await self.buffer_frame(frame, res)
+            return
+
+        await self.send_frame(frame)
+
+    async def send_frame(self, frame) -> None:
+        """ Send an encoded message to WebSocket. """
+
+        if self.get_codec().binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def buffer_frame(self, frame, res) -> None:
+        """ Add an encoded message to the buffer of the connection, and make sure the buffer is flushed (coalescing mode). """
+
+        if self.message_buffer is None:
+            self.message_buffer = MessageBuffer(self.max_buffered_messages)
+
+        coalesce_key = res.get('coalesce_key')
+        self.message_buffer.add(frame, (res['action'].lower(), res['page_id'], coalesce_key) if coalesce_key is not None else None)
+
+        if self._flush_task is None:
+            delay = self._last_flush + self.coalesce_interval - time.monotonic()
+            if delay <= 0:
+                await self.flush_messages() # Quiet period, no need to wait
+            else:
+                self._flush_task = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        """ Flush the buffer after the delay. Errors are logged here, because nothing awaits the task. """
+
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        try:
+            await self.flush_messages()
+        except Exception:
+            logger.exception('Sending the buffered websocket messages failed')
+
+    async def flush_messages(self) -> None:
+        """ Send the buffered messages (coalescing mode). """
+
+        self._last_flush = time.monotonic()
+        for frame in self.message_buffer.pop_all():
+            await self.send_frame(frame)
+
+    async def send_to_all_groups(self, action, payload, page_id=ALL_PAGES):
+        """ Send a message to all groups (in one batch). """
+
+        await send_to_channel_groups_async(self.get_channel_groups(), action, payload, page_id)
\ No newline at end of file
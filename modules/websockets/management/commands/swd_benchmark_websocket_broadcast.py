@@ -0,0 +1,51 @@
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from modules.websockets.utils import send_to_channel_groups_sync
+
+class Command(BaseCommand):
+    help = 'Compares broadcasting a message to many channel groups one group at a time and in batches, against the default channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--groups', type=int, default=10000, help='Amount of groups (like user_{id} groups), with one channel each')
+        parser.add_argument('--processes', type=int, default=4, help='Amount of (simulated) websocket server processes the channels are spread over')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--skip-per-group', action='store_true', help='Only run the batched broadcast')
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        run_id = uuid.uuid4().hex[:8]
+
+        groups = [f'benchmark_{run_id}_{index}' for index in range(options['groups'])]
+        channels = [f'specific.benchmark{run_id}{index % options["processes"]}!{index}' for index in range(options['groups'])]
+        message = {'type' : 'send_message', 'action' : 'benchmark', 'page_id' : 'all_pages', 'payload' : {'message' : 'Hello'}}
+
+        async def add_channels():
+            for group, channel in zip(groups, channels):
+                await channel_layer.group_add(group, channel)
+
+        async def remove_channels():
+            for group, channel in zip(groups, channels):
+                await channel_layer.group_discard(group, channel)
+
+        self.stdout.write(f'Adding {len(groups)} groups...')
+        async_to_sync(add_channels)()
+
+        try:
+            if not options['skip_per_group']:
+                start = time.perf_counter()
+                for group in groups:
+                    async_to_sync(channel_layer.group_send)(group, message) # Like send_websocket_message_to_user per user
+                duration = time.perf_counter() - start
+                self.stdout.write(f'One group at a time: {len(groups)} groups in {duration:.2f}s ({len(groups) / duration:.0f} groups/s)')
+
+            start = time.perf_counter()
+            send_to_channel_groups_sync(groups, message['action'], message['payload'], batch_size=options['batch_size'])
+            duration = time.perf_counter() - start
+            self.stdout.write(f'Batched: {len(groups)} groups in {duration:.2f}s ({len(groups) / duration:.0f} groups/s)')
+        finally:
+            async_to_sync(remove_channels)() # The benchmark messages expire after the expiry of the channel layer (60 seconds by default)
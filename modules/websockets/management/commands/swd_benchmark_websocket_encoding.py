@@ -0,0 +1,42 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+
+from modules.websockets.codecs import CODECS, get_codec
+
+class Command(BaseCommand):
+    help = 'Compares the CPU time to encode a broadcast for every connection of a group, per codec, with encoding the message once per group'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=10000, help='Amount of connections in the group')
+        parser.add_argument('--rows', type=int, default=20, help='Amount of rows in the payload (like a table update)')
+
+    def handle(self, *args, **options):
+        payload = {
+            'message' : 'The table was updated',
+            'rows' : [{'id' : index, 'name' : f'Row {index}', 'email' : f'user{index}@example.com', 'credits' : index * 10, 'active' : index % 2 == 0} for index in range(options['rows'])],
+        }
+        message = {'action' : 'update_table', 'page_id' : 'all_pages', 'payload' : payload}
+        connections = options['connections']
+
+        for name in CODECS:
+            try:
+                codec = get_codec(name)
+            except ImproperlyConfigured as e:
+                self.stdout.write(self.style.WARNING(f'{name}: skipped ({e})'))
+                continue
+
+            start = time.perf_counter()
+            for _ in range(connections):
+                frame = codec.encode(message) # Like encoding in send_message, per connection
+            per_connection = time.perf_counter() - start
+
+            start = time.perf_counter()
+            frame = codec.encode(message) # Encoded once per group message, every connection sends the same frame
+            once = time.perf_counter() - start
+
+            self.stdout.write(
+                f'{name}: {len(frame)} bytes per frame. Per connection: {per_connection * 1000:.1f} ms for {connections} connections, '
+                f'once per group: {once * 1000:.2f} ms ({per_connection / once:.0f}x less CPU)'
+            )
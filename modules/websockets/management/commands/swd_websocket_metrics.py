@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from modules.websockets.coalescing import get_coalescing_metrics
+
+class Command(BaseCommand):
+    help = 'Shows the amount of sent, merged and dropped messages of the coalescing websocket connections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=5, help='Amount of minutes to compute the metrics over')
+
+    def handle(self, *args, **options):
+        metrics = get_coalescing_metrics(options['minutes'])
+
+        if not metrics:
+            self.stdout.write(self.style.WARNING('No metrics found. Metrics are only available when the task queue uses Redis.'))
+            return
+
+        self.stdout.write(
+            f'Coalescing connections closed in the last {options["minutes"]} minutes: {metrics["sent"]} messages sent, '
+            f'{metrics["merged"]} merged (replaced by a newer message), {metrics["dropped"]} dropped (buffer full)'
+        )
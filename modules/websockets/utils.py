@@ -3,7 +3,11 @@ from asgiref.sync import async_to_sync
 
 from django.contrib.auth import get_user_model
 
-def send_to_channel_group_sync(group: str, action: str, payload_data: dict, page_id: str = 'all_pages'):
+from CONFIG.websockets import WEBSOCKET_BROADCAST_BATCH_SIZE
+from .broadcast import group_send_many
+from .codecs import build_channel_message
+
+def send_to_channel_group_sync(group: str, action: str, payload_data: dict, page_id: str = 'all_pages', coalesce_key: str | None = None):
     """ Send a message to a channel group synchronously.
 
         :param group: The group to send the message to.
@@ -14,24 +18,22 @@ def send_to_channel_group_sync(group: str, action: str, payload_data: dict, page
         :type payload_data: dict
         :param page_id: The page ID to send the message to. Default is 'all_pages'.
         :type page_id: str
+        :param coalesce_key: Messages with the same action, page ID and coalesce key replace each other in the buffer of consumers
+            in coalescing mode (e.g. the task ID of progress updates). None if the message must not be replaced.
+        :type coalesce_key: str | None
         :return: None
         :rtype: None
     """
     
     channel_layer = get_channel_layer()
-    data = {
-        'type' : 'send_message',
-        'action' : action,
-        'page_id' : page_id,
-        'payload' : payload_data
-    }
+    data = build_channel_message(action, payload_data, page_id, coalesce_key=coalesce_key)
     
     async_to_sync(channel_layer.group_send)(
         group,
         data
     )
 
-async def send_to_channel_group_async(group: str, action: str, payload_data: dict, page_id: str = 'all_pages'):
+async def send_to_channel_group_async(group: str, action: str, payload_data: dict, page_id: str = 'all_pages', coalesce_key: str | None = None):
     """ Send a message to a channel group asynchronously.
 
         :param group: The group to send the message to.
@@ -42,23 +44,21 @@ async def send_to_channel_group_async(group: str, action: str, payload_data: dic
         :type payload_data: dict
         :param page_id: The page ID to send the message to. Default is 'all_pages'.
         :type page_id: str
+        :param coalesce_key: Messages with the same action, page ID and coalesce key replace each other in the buffer of consumers
+            in coalescing mode (e.g. the task ID of progress updates). None if the message must not be replaced.
+        :type coalesce_key: str | None
         :return: None
         :rtype: None
     """
 
     channel_layer = get_channel_layer()
-    data = {
-        'type' : 'send_message',
-        'action' : action,
-        'page_id' : page_id,
-        'payload' : payload_data
-    }
+    data = build_channel_message(action, payload_data, page_id, coalesce_key=coalesce_key)
     await channel_layer.group_send(
         group,
         data
     )
 
-def send_websocket_message_to_user(user:get_user_model, action: str, payload_data: dict, page_id: str = 'all_pages') -> None:
+def send_websocket_message_to_user(user:get_user_model, action: str, payload_data: dict, page_id: str = 'all_pages', coalesce_key: str | None = None) -> None:
     """ Send a message to a user. 
     
         :param user: The user to send the message to.
@@ -69,19 +69,68 @@ def send_websocket_message_to_user(user:get_user_model, action: str, payload_dat
         :type payload_data: dict
         :param page_id: The page ID to send the message to. Default is 'all_pages'.
         :type page_id: str
+        :param coalesce_key: Messages with the same action, page ID and coalesce key replace each other in the buffer of consumers
+            in coalescing mode (e.g. the task ID of progress updates). None if the message must not be replaced.
+        :type coalesce_key: str | None
         :return: None
         :rtype: None
     """
     
     channel_layer = get_channel_layer()
-    data = {
-        'type' : 'send_message',
-        'action' : action,
-        'page_id' : page_id,
-        'payload' : payload_data
-    }
+    data = build_channel_message(action, payload_data, page_id, coalesce_key=coalesce_key)
     
     async_to_sync(channel_layer.group_send)(
         f'user_{user.id}',
         data
-    )
\ No newline at end of file
+    )
+
+async def send_to_channel_groups_async(groups, action: str, payload_data: dict, page_id: str = 'all_pages', batch_size: int = WEBSOCKET_BROADCAST_BATCH_SIZE, coalesce_key: str | None = None):
+    """ Send a message to many channel groups asynchronously, in batches (see modules.websockets.broadcast.group_send_many).
+
+        :param groups: The groups to send the message to.
+        :type groups: Iterable[str]
+        :param action: The action to send.
+        :type action: str
+        :param payload_data: The data to send.
+        :type payload_data: dict
+        :param page_id: The page ID to send the message to. Default is 'all_pages'.
+        :type page_id: str
+        :param coalesce_key: Messages with the same action, page ID and coalesce key replace each other in the buffer of consumers
+            in coalescing mode (e.g. the task ID of progress updates). None if the message must not be replaced.
+        :type coalesce_key: str | None
+        :param batch_size: The amount of groups per batch.
+        :type batch_size: int
+        :return: None
+        :rtype: None
+    """
+
+    data = build_channel_message(action, payload_data, page_id, coalesce_key=coalesce_key)
+    await group_send_many(groups, data, batch_size=batch_size)
+
+def send_to_channel_groups_sync(groups, action: str, payload_data: dict, page_id: str = 'all_pages', batch_size: int = WEBSOCKET_BROADCAST_BATCH_SIZE, coalesce_key: str | None = None):
+    """ Send a message to many channel groups synchronously (e.g. from a task queue task), with one event loop for all groups.
+        See send_to_channel_groups_async for the parameters.
+    """
+
+    async_to_sync(send_to_channel_groups_async)(list(groups), action, payload_data, page_id, batch_size, coalesce_key)
+
+def send_websocket_message_to_users(users, action: str, payload_data: dict, page_id: str = 'all_pages', coalesce_key: str | None = None) -> None:
+    """ Send a message to many users at once (to their user_{id} groups).
+
+        :param users: The users (or user IDs) to send the message to.
+        :type users: Iterable[User | int]
+        :param action: The action to send.
+        :type action: str
+        :param payload_data: The data to send.
+        :type payload_data: dict
+        :param page_id: The page ID to send the message to. Default is 'all_pages'.
+        :type page_id: str
+        :param coalesce_key: Messages with the same action, page ID and coalesce key replace each other in the buffer of consumers
+            in coalescing mode (e.g. the task ID of progress updates). None if the message must not be replaced.
+        :type coalesce_key: str | None
+        :return: None
+        :rtype: None
+    """
+
+    groups = [f'user_{user if isinstance(user, int) else user.id}' for user in users]
+    send_to_channel_groups_sync(groups, action, payload_data, page_id, coalesce_key=coalesce_key)
@@ -32,6 +32,7 @@ class ExampleConsumer(ShipWithDjangoConsumer):
 
 class UserConsumer(ShipWithDjangoConsumer):
     channel_groups = ['users', 'user_{user.id}']
+    coalesce = True # Progress updates (e.g. of export jobs) sent faster than every WEBSOCKET_COALESCE_INTERVAL replace each other
 
     async def receive_event(self, event, page_id, user, response):
         await self.send_to_all_groups(
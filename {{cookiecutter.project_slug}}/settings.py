@@ -86,6 +86,7 @@ INSTALLED_APPS = PLATFORM_APPS + [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     # Social authentication
     'allauth',
@@ -100,6 +101,7 @@ INSTALLED_APPS = PLATFORM_APPS + [
 ]
 
 MIDDLEWARE = [
+    'modules.context_processors.instrumentation.ContextProcessorTimingMiddleware', # Only active if LOG_CONTEXT_PROCESSOR_TIMINGS is enabled
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -107,6 +109,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'impersonate.middleware.ImpersonateMiddleware',
+    'modules.billing.middleware.EntitlementsMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
@@ -228,6 +231,18 @@ HUEY = {
         'read_timeout' : None,
         'url' : None,
     },
+    'consumer' : {
+        'flush_locks' : True, # Remove the task locks when the consumer starts, e.g. the locks of a worker that was killed while holding them
+    },
+}
+
+# Cache
+# Redis is used (instead of the default in-memory cache), so the cache is shared between the web and task queue processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'redis://{task_queue_config.REDIS_HOST}:{task_queue_config.REDIS_PORT}/1',
+    }
 }
 
 # Authentication
@@ -379,6 +394,9 @@ EMAIL_HOST_USER = email_config.EMAIL_HOST_USER
 EMAIL_HOST_PASSWORD = email_config.EMAIL_HOST_PASSWORD
 EMAIL_USE_TLS = email_config.EMAIL_USE_TLS
 EMAIL_USE_TASK_QUEUE = email_config.EMAIL_USE_TASK_QUEUE
+EMAIL_SMTP_POOL_SIZE = email_config.EMAIL_SMTP_POOL_SIZE
+EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION = email_config.EMAIL_SMTP_MAX_MESSAGES_PER_CONNECTION
+EMAIL_SMTP_KEEPALIVE_SECONDS = email_config.EMAIL_SMTP_KEEPALIVE_SECONDS
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 SENDGRID_API_KEY = email_config.SENDGRID_API_KEY
 